@@ -0,0 +1,157 @@
+import threading
+import time
+import zlib
+import zstandard as zstd
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Compression of the http responses negotiated from the request's Accept-Encoding. zstd is preferred over gzip.
+# Responses are compressed message by message as the application sends them and each message is flushed, so a streamed
+# response is compressed while it streams and the body is never buffered in full.
+# Not compressed are:
+#   responses that already have a Content-Encoding, e.g. the zstd csv stream of the folders
+#   single message responses smaller than COMPRESSION_MINIMUM_SIZE
+#   responses with a media type that is compressed already
+COMPRESSION_MINIMUM_SIZE: int = 1024
+ZSTD_LEVEL: int = 3
+GZIP_LEVEL: int = 6
+UNCOMPRESSIBLE_MEDIA_TYPES: tuple[str, ...] = ("image/", "video/", "audio/", "application/zstd", "application/gzip", "application/zip")
+
+
+def negotiate_encoding(accept_encoding: str) -> str | None:
+    """zstd, gzip or None from an Accept-Encoding header. Encodings with q=0 are refused"""
+    accepted: dict[str, float] = {}
+    for part in accept_encoding.lower().split(","):
+        encoding, _, parameters = part.strip().partition(";")
+        quality: float = 1.0
+        if parameters.strip().startswith("q="):
+            try:
+                quality = float(parameters.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[encoding.strip()] = quality
+    for encoding in ("zstd", "gzip"):
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+class StreamCompressor:
+    """compresses the body messages of one response. Every call returns the compressed bytes that the messages so far can be decoded to"""
+    def __init__(self, encoding: str):
+        if encoding == "zstd":
+            self.compressor = zstd.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+            self.flush_mode, self.finish_mode = zstd.COMPRESSOBJ_FLUSH_BLOCK, zstd.COMPRESSOBJ_FLUSH_FINISH
+        else:
+            self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self.flush_mode, self.finish_mode = zlib.Z_SYNC_FLUSH, zlib.Z_FINISH
+
+    def compress(self, body: bytes, is_last: bool) -> bytes:
+        return self.compressor.compress(body) + self.compressor.flush(self.finish_mode if is_last else self.flush_mode)
+
+
+class CompressionStats:
+    # Process-wide compression metrics per endpoint (the route's path template)
+    _lock: threading.Lock = threading.Lock()
+    _endpoints: dict[str, dict[str, float]] = {}
+
+    @classmethod
+    def record(cls, endpoint: str, encoding: str | None, bytes_in: int, bytes_out: int, seconds: float) -> None:
+        with cls._lock:
+            stats = cls._endpoints.setdefault(endpoint, {"responses": 0, "compressed_responses": 0, "bytes_in": 0, "bytes_out": 0, "seconds": 0.0})
+            stats["responses"] += 1
+            stats["compressed_responses"] += 1 if encoding else 0
+            stats["bytes_in"] += bytes_in
+            stats["bytes_out"] += bytes_out
+            stats["seconds"] += seconds
+
+    @classmethod
+    def stats(cls) -> dict[str, dict[str, float]]:
+        """the metrics per endpoint. ratio is bytes_in/bytes_out and seconds is the time spent compressing"""
+        with cls._lock:
+            return {endpoint: {**stats, "ratio": stats["bytes_in"] / stats["bytes_out"] if stats["bytes_out"] else 1.0}
+                    for endpoint, stats in cls._endpoints.items()}
+
+    @classmethod
+    def clear(cls) -> None:
+        with cls._lock:
+            cls._endpoints.clear()
+
+
+class CompressionMiddleware:
+    def __init__(self, app: ASGIApp, minimum_size: int = COMPRESSION_MINIMUM_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding: str | None = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await CompressedResponder(self.app, encoding, self.minimum_size)(scope, receive, send)
+
+
+class CompressedResponder:
+    # the state of one response. The start message is held back until the first body message shows whether the response is compressed
+    def __init__(self, app: ASGIApp, encoding: str, minimum_size: int):
+        self.app = app
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.start_message: Message | None = None
+        self.compressor: StreamCompressor | None = None
+        self.is_passthrough: bool = False
+        self.bytes_in: int = 0
+        self.bytes_out: int = 0
+        self.seconds: float = 0.0
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        self.scope = scope
+        self.send = send
+        await self.app(scope, receive, self.send_compressed)
+
+    async def send_compressed(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            headers = Headers(raw=message["headers"])
+            media_type: str = headers.get("content-type", "")
+            self.is_passthrough = "content-encoding" in headers or media_type.startswith(UNCOMPRESSIBLE_MEDIA_TYPES)
+            if self.is_passthrough:
+                await self.send(message)
+            else:
+                self.start_message = message
+            return
+        if message["type"] != "http.response.body" or self.is_passthrough:
+            await self.send(message)
+            return
+
+        body: bytes = message.get("body", b"")
+        more_body: bool = message.get("more_body", False)
+        if self.start_message is not None:
+            start_message, self.start_message = self.start_message, None
+            if not more_body and len(body) < self.minimum_size:
+                self.is_passthrough = True
+                await self.send(start_message)
+                await self.send(message)
+                self.record(None, len(body), len(body))
+                return
+            headers = MutableHeaders(raw=start_message["headers"])
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            del headers["Content-Length"]
+            self.compressor = StreamCompressor(self.encoding)
+            await self.send(start_message)
+
+        start = time.perf_counter()
+        compressed: bytes = self.compressor.compress(body, is_last=not more_body)
+        self.seconds += time.perf_counter() - start
+        self.bytes_in += len(body)
+        self.bytes_out += len(compressed)
+        await self.send({"type": "http.response.body", "body": compressed, "more_body": more_body})
+        if not more_body:
+            self.record(self.encoding, self.bytes_in, self.bytes_out)
+
+    def record(self, encoding: str | None, bytes_in: int, bytes_out: int) -> None:
+        route = self.scope.get("route")
+        CompressionStats.record(getattr(route, "path", "unmatched"), encoding, bytes_in, bytes_out, self.seconds)
@@ -0,0 +1,84 @@
+import hashlib
+import threading
+from datetime import datetime
+from email.utils import format_datetime, parsedate_to_datetime
+from secrets import token_hex
+from typing import Callable
+from fastapi import Request
+from fastapi.responses import Response
+from starlette.datastructures import Headers
+from db.metadata_cache import MetadataCache
+
+# Conditional GET of the metadata that the client reads on start up and whenever it opens a rootfolder: simulation domains,
+# retention types, folder types, lead times, cleanup frequencies, cleanup configurations and path protections.
+# The ETag and Last-Modified of a response are the MetadataCache version of its domain or rootfolder, so they change with every
+# commit that changes the metadata. The ETag is prefixed with a token of the process so an ETag from before a restart or from another
+# process never matches. ETags are weak because CompressionMiddleware changes the bytes of the body.
+# A request whose If-None-Match (or If-Modified-Since when there is no If-None-Match) matches the current version gets
+# 304 Not Modified without reading or encoding anything. Otherwise the json body is encoded once per version and kept in ResponseMemo
+# The versions only see the commits of this process. When the database is served by several processes (MetadataCache.is_enabled() is
+# false) the ETag is a hash of the encoded body instead: every request reads and encodes the metadata, but an unchanged body is 
+# still answered with 304 Not Modified by any process. Those responses have no Last-Modified
+PROCESS_TOKEN: str = token_hex(4)
+
+
+class ResponseMemo:
+    # Process-wide json bodies by url path. A body is only returned for the version it was encoded for
+    _lock: threading.Lock = threading.Lock()
+    _bodies: dict[str, tuple[int, bytes]] = {}    # url path -> (generation, body)
+
+    @classmethod
+    def get(cls, path: str, generation: int, encode: Callable[[], bytes]) -> bytes:
+        with cls._lock:
+            memo = cls._bodies.get(path)
+        if memo is not None and memo[0] == generation:
+            return memo[1]
+        body: bytes = encode()
+        with cls._lock:
+            cls._bodies[path] = (generation, body)
+        return body
+
+    @classmethod
+    def clear(cls) -> None:
+        with cls._lock:
+            cls._bodies.clear()
+
+
+def is_not_modified(headers: Headers, opaque_tag: str, last_modified: datetime | None) -> bool:
+    """true if the request's If-None-Match has the ETag (weak comparison), or it has no If-None-Match and If-Modified-Since is not before last_modified"""
+    if_none_match: str | None = headers.get("if-none-match")
+    if if_none_match is not None:
+        return if_none_match.strip() == "*" or opaque_tag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    if_modified_since: str | None = headers.get("if-modified-since")
+    if not if_modified_since or last_modified is None:
+        return False
+    try:
+        since: datetime = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    # Last-Modified has whole seconds
+    return since.tzinfo is not None and last_modified.replace(microsecond=0) <= since
+
+
+def cached_json_response(request: Request, level: str, id: int, encode: Callable[[], Response]) -> Response:
+    """the json response of encode() with the ETag and Last-Modified of the version of the domain or rootfolder (level, id) in MetadataCache.
+    304 Not Modified if the request's conditional headers match the version"""
+    if not MetadataCache.is_enabled():
+        return content_tagged_json_response(request, encode)
+    generation, last_modified = MetadataCache.version(level, id)
+    opaque_tag: str = f'"{PROCESS_TOKEN}-{generation}"'
+    headers: dict[str, str] = {"ETag": f"W/{opaque_tag}", "Last-Modified": format_datetime(last_modified, usegmt=True), "Cache-Control": "no-cache"}
+    if is_not_modified(request.headers, opaque_tag, last_modified):
+        return Response(status_code=304, headers=headers)
+    body: bytes = ResponseMemo.get(request.url.path, generation, lambda: encode().body)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def content_tagged_json_response(request: Request, encode: Callable[[], Response]) -> Response:
+    """the json response of encode() with an ETag of its body. 304 Not Modified if the request's If-None-Match has the ETag"""
+    body: bytes = encode().body
+    opaque_tag: str = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+    headers: dict[str, str] = {"ETag": f"W/{opaque_tag}", "Cache-Control": "no-cache"}
+    if is_not_modified(request.headers, opaque_tag, None):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
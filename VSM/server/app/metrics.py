@@ -0,0 +1,164 @@
+import threading
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+from sqlalchemy import Engine, event
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from app.compression import CompressionStats
+from db.metadata_cache import MetadataCache
+from db.write_queue import WriteQueue
+
+# Per request instrumentation exposed at GET /metrics in the Prometheus text format:
+#   the latency histogram of every route (the route's path template, not the path) by method and status
+#   the number of SQL statements and the time spent in them per route. The statements are counted by a cursor execute hook on
+#   all engines and attributed to the request that runs them through a context variable, which follows the request into the
+#   threadpool of the sync endpoints
+# Every response gets the headers X-DB-Query-Count and Server-Timing: db;dur=<ms> so N+1 query patterns show up in the browser.
+# Statements that run after the response has started, e.g. in a streamed response or a background task, are counted in the
+# route's totals but not in the headers
+LATENCY_BUCKETS: tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+@dataclass
+class RequestMetrics:
+    query_count: int  = 0
+    db_seconds: float = 0.0
+
+_request_metrics: ContextVar[RequestMetrics | None] = ContextVar("request_metrics", default=None)
+
+
+class RequestStats:
+    # Process-wide metrics of the requests and of all SQL statements
+    _lock: threading.Lock = threading.Lock()
+    _latencies: dict[tuple[str, str, int], list[float]] = {}       # (method, route, status) -> bucket counts + [sum, count]
+    _queries: dict[tuple[str, str], list[float]] = {}              # (method, route) -> [query count, db seconds]
+    query_count: int  = 0
+    db_seconds: float = 0.0
+
+    @classmethod
+    def observe_request(cls, method: str, route: str, status: int, seconds: float, metrics: RequestMetrics) -> None:
+        with cls._lock:
+            latency = cls._latencies.setdefault((method, route, status), [0] * len(LATENCY_BUCKETS) + [0.0, 0])
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    latency[i] += 1
+            latency[-2] += seconds
+            latency[-1] += 1
+            queries = cls._queries.setdefault((method, route), [0, 0.0])
+            queries[0] += metrics.query_count
+            queries[1] += metrics.db_seconds
+
+    @classmethod
+    def observe_query(cls, seconds: float) -> None:
+        with cls._lock:
+            cls.query_count += 1
+            cls.db_seconds += seconds
+
+    @classmethod
+    def clear(cls) -> None:
+        with cls._lock:
+            cls._latencies.clear()
+            cls._queries.clear()
+            cls.query_count, cls.db_seconds = 0, 0.0
+
+    @classmethod
+    def render(cls) -> str:
+        """the request, SQL, compression, metadata cache and write queue metrics in the Prometheus text format"""
+        lines: list[str] = []
+        def metric(name: str, kind: str, help: str, samples: list[tuple[str, dict[str, str], float]]) -> None:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for suffix, labels, value in samples:
+                label_text = ",".join(f'{key}="{escape_label(value)}"' for key, value in labels.items())
+                lines.append(f"{name}{suffix}{{{label_text}}} {value}" if label_text else f"{name}{suffix} {value}")
+
+        with cls._lock:
+            histogram_samples = []
+            for (method, route, status), latency in sorted(cls._latencies.items()):
+                labels = {"method": method, "route": route, "status": str(status)}
+                histogram_samples += [("_bucket", {**labels, "le": str(bound)}, latency[i]) for i, bound in enumerate(LATENCY_BUCKETS)]
+                histogram_samples += [("_bucket", {**labels, "le": "+Inf"}, latency[-1]), ("_sum", labels, latency[-2]), ("_count", labels, latency[-1])]
+            queries = sorted(cls._queries.items())
+            query_count, db_seconds = cls.query_count, cls.db_seconds
+
+        metric("vsm_http_request_duration_seconds", "histogram", "Latency of the http requests by route", histogram_samples)
+        metric("vsm_http_request_db_queries_total", "counter", "SQL statements run by the requests of a route",
+               [("", {"method": method, "route": route}, count) for (method, route), (count, _) in queries])
+        metric("vsm_http_request_db_seconds_total", "counter", "Time spent in SQL statements by the requests of a route",
+               [("", {"method": method, "route": route}, seconds) for (method, route), (_, seconds) in queries])
+        metric("vsm_db_queries_total", "counter", "All SQL statements including agents and background tasks", [("", {}, query_count)])
+        metric("vsm_db_seconds_total", "counter", "Time spent in all SQL statements", [("", {}, db_seconds)])
+
+        compression = CompressionStats.stats()
+        for key, name, help in [("bytes_in", "vsm_http_response_uncompressed_bytes_total", "Response bytes before compression"),
+                                ("bytes_out", "vsm_http_response_compressed_bytes_total", "Response bytes after compression"),
+                                ("seconds", "vsm_http_response_compression_seconds_total", "Time spent compressing responses")]:
+            metric(name, "counter", help, [("", {"route": route}, stats[key]) for route, stats in sorted(compression.items())])
+
+        cache = MetadataCache.stats()
+        metric("vsm_metadata_cache_hits_total", "counter", "Metadata cache hits", [("", {}, cache["hits"])])
+        metric("vsm_metadata_cache_misses_total", "counter", "Metadata cache misses", [("", {}, cache["misses"])])
+        metric("vsm_metadata_cache_entries", "gauge", "Metadata cache entries", [("", {}, cache["entries"])])
+
+        writes = WriteQueue.stats()
+        metric("vsm_write_queue_depth", "gauge", "Write jobs waiting for the writer by priority",
+               [("", {"priority": "interactive"}, writes["interactive_depth"]), ("", {"priority": "bulk"}, writes["bulk_depth"])])
+        metric("vsm_write_queue_bulk_lanes", "gauge", "Rootfolders with bulk write jobs waiting", [("", {}, writes["bulk_lanes"])])
+        metric("vsm_write_queue_writers", "gauge", "Writer threads, one for the main database and one for each shard that was written", [("", {}, writes["writers"])])
+        metric("vsm_write_queue_commits_total", "counter", "Group commits of the write queue", [("", {}, writes["commits"])])
+        metric("vsm_write_queue_committed_jobs_total", "counter", "Session jobs committed by the group commits", [("", {}, writes["committed_jobs"])])
+        metric("vsm_write_queue_failed_jobs_total", "counter", "Session jobs that raised or whose commit failed", [("", {}, writes["failed_jobs"])])
+        metric("vsm_write_queue_exclusive_jobs_total", "counter", "Exclusive jobs run by the writer", [("", {}, writes["exclusive_jobs"])])
+        metric("vsm_write_queue_commit_seconds_total", "counter", "Time spent in the group commits", [("", {}, writes["commit_seconds"])])
+        metric("vsm_write_queue_wait_seconds_total", "counter", "Time the jobs waited in the queue", [("", {}, writes["wait_seconds"])])
+        return "\n".join(lines) + "\n"
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_query_timer(connection, cursor, statement, parameters, context, executemany) -> None:
+    # the start time is kept on the statement's execution context so a statement that fails leaves nothing behind
+    context.query_start_time = time.perf_counter()
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _record_query(connection, cursor, statement, parameters, context, executemany) -> None:
+    seconds = time.perf_counter() - context.query_start_time
+    RequestStats.observe_query(seconds)
+    metrics = _request_metrics.get()
+    if metrics is not None:
+        metrics.query_count += 1
+        metrics.db_seconds += seconds
+
+
+class MetricsMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        metrics = RequestMetrics()
+        token = _request_metrics.set(metrics)
+        start: float = time.perf_counter()
+        status: int = 500
+
+        async def send_with_metrics(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = MutableHeaders(raw=message["headers"])
+                headers["X-DB-Query-Count"] = str(metrics.query_count)
+                headers.append("Server-Timing", f'db;dur={metrics.db_seconds * 1000:.1f};desc="{metrics.query_count} queries"')
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            _request_metrics.reset(token)
+            route = scope.get("route")
+            RequestStats.observe_request(scope["method"], getattr(route, "path", "unmatched"), status, time.perf_counter() - start, metrics)
@@ -1,6 +1,6 @@
 from contextlib import asynccontextmanager
 from typing import Optional
-from fastapi import FastAPI, Query, BackgroundTasks
+from fastapi import FastAPI, Query, BackgroundTasks, Request
 from fastapi.middleware.cors import CORSMiddleware
 from sqlmodel import Session
 from datamodel import dtos 
@@ -8,7 +8,12 @@ from datamodel.dtos import RootFolderDTO, FolderNodeDTO, FolderTypeDTO, Simulati
 from datamodel.vts_create_meta_data import insert_vts_metadata_in_db
 from db.database import Database
 from db import db_api
+from db.metadata_cache import MetadataCache
+from db.write_queue import WriteQueue
 from app.app_config import AppConfig
+from app.compression import CompressionMiddleware, CompressionStats
+from app.metrics import MetricsMiddleware, RequestStats
+from app.http_cache import cached_json_response
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -29,6 +34,8 @@ async def lifespan(app: FastAPI):
                 insert_vts_metadata_in_db(session)
                 from testdata.vts_generate_test_data import insert_test_folder_hierarchy_in_db
                 insert_test_folder_hierarchy_in_db(session)
+    else:
+        db.upgrade_db()
     #else:
     #    db.clear_all_tables_and_schemas()
     
@@ -54,6 +61,10 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"]
 )
+# zstd or gzip compression of the responses negotiated by Accept-Encoding. See app/compression.py
+app.add_middleware(CompressionMiddleware)
+# latency, SQL count and SQL time per route. See app/metrics.py and GET /metrics
+app.add_middleware(MetricsMiddleware)
 
 # Handle favicon requests to avoid 404 logs
 @app.get("/favicon.ico")
@@ -71,34 +82,62 @@ async def get_current_test_mode() -> dict:
     }
 
 #-----------------start retrieval of metadata for a simulation domain -------------------
+# The metadata endpoints return db_api's fast json responses with an ETag and Last-Modified and answer conditional requests with 
+# 304 Not Modified, see app/http_cache.py. The response_model documents the json
 @app.get("/v1/simulationdomains/", response_model=list[SimulationDomainDTO])
-def fs_read_simulation_domains() -> list[SimulationDomainDTO]:
-    domains:list[dtos.SimulationDomainDTO] = db_api.read_simulation_domains()
-    return domains
+def fs_read_simulation_domains(request: Request):
+    return cached_json_response(request, MetadataCache.DOMAIN, MetadataCache.SIMULATION_DOMAINS_ID, 
+                                lambda: db_api.json_models_response(SimulationDomainDTO, db_api.read_simulation_domains()))
 
 @app.get("/v1/simulationdomains/{domain_name}", response_model=SimulationDomainDTO)
-def fs_read_simulation_domain_by_name(domain_name: str):
-    return db_api.read_simulation_domain_by_name(domain_name)
+def fs_read_simulation_domain_by_name(domain_name: str, request: Request):
+    return cached_json_response(request, MetadataCache.DOMAIN, MetadataCache.SIMULATION_DOMAINS_ID, 
+                                lambda: db_api.json_model_response(SimulationDomainDTO, db_api.read_simulation_domain_by_name(domain_name)))
 
 @app.get("/v1/simulationdomains/{simulationdomain_id}/retentiontypes/", response_model=list[RetentionTypeDTO])
-def fs_read_retentiontypes_by_domain_id(simulationdomain_id: int):
-    return db_api.read_retentiontypes_by_domain_id(simulationdomain_id)
+def fs_read_retentiontypes_by_domain_id(simulationdomain_id: int, request: Request):
+    return cached_json_response(request, MetadataCache.DOMAIN, simulationdomain_id, 
+                                lambda: db_api.json_models_response(RetentionTypeDTO, db_api.read_retentiontypes_by_domain_id(simulationdomain_id)))
 
 
 @app.get("/v1/simulationdomains/{simulationdomain_id}/foldertypes/", response_model=list[FolderTypeDTO])
-def fs_read_folder_types_pr_domain_id(simulationdomain_id: int):
-    return db_api.read_folder_types_pr_domain_id(simulationdomain_id)
+def fs_read_folder_types_pr_domain_id(simulationdomain_id: int, request: Request):
+    return cached_json_response(request, MetadataCache.DOMAIN, simulationdomain_id, 
+                                lambda: db_api.json_models_response(FolderTypeDTO, db_api.read_folder_types_pr_domain_id(simulationdomain_id)))
 
 # The cycle time for one simulation is the time from initiating the simulation, til cleanup the simulation. 
 @app.get("/v1/simulationdomains/{simulationdomain_id}/leadtimes/", response_model=list[LeadTimeDTO])
-def fs_read_cycle_time_by_domain_id(simulationdomain_id: int):
-    return db_api.read_cycle_time_by_domain_id(simulationdomain_id)
+def fs_read_cycle_time_by_domain_id(simulationdomain_id: int, request: Request):
+    return cached_json_response(request, MetadataCache.DOMAIN, simulationdomain_id, 
+                                lambda: db_api.json_models_response(LeadTimeDTO, db_api.read_cycle_time_by_domain_id(simulationdomain_id)))
 
 
 # The cycle time for one simulation is the time from initiating the simulation, til cleanup the simulation. 
 @app.get("/v1/simulationdomains/{simulationdomain_id}/cleanupfrequencies/", response_model=list[CleanupFrequencyDTO])
-def fs_read_frequency_by_domain_id(simulationdomain_id: int):
-    return db_api.read_frequency_by_domain_id(simulationdomain_id)
+def fs_read_frequency_by_domain_id(simulationdomain_id: int, request: Request):
+    return cached_json_response(request, MetadataCache.DOMAIN, simulationdomain_id, 
+                                lambda: db_api.json_models_response(CleanupFrequencyDTO, db_api.read_frequency_by_domain_id(simulationdomain_id)))
+
+# hit and miss counters of the process-wide cache of retention types, folder types, path protections and cleanup configurations
+@app.get("/v1/metadata_cache/stats")
+def fs_read_metadata_cache_stats() -> dict[str, int]:
+    return MetadataCache.stats()
+
+# compression ratio (bytes_in/bytes_out) and compression time per endpoint for the requests that accepted compression
+@app.get("/v1/compression/stats")
+def fs_read_compression_stats() -> dict[str, dict[str, float]]:
+    return CompressionStats.stats()
+
+# queue depth, group commits, commit latency and time in the queue of the single writer. See db/write_queue.py
+@app.get("/v1/write_queue/stats")
+def fs_read_write_queue_stats() -> dict[str, float]:
+    return WriteQueue.stats()
+
+# request latency histograms, SQL statement counts and times, compression, metadata cache and write queue metrics for Prometheus
+@app.get("/metrics", include_in_schema=False)
+def fs_read_metrics():
+    from fastapi.responses import Response
+    return Response(content=RequestStats.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 #-----------------end retrieval of metadata for a simulation domain -------------------
 
@@ -114,8 +153,9 @@ def fs_read_rootfolders(simulationdomain_id: int, initials: Optional[str] = Quer
 
 # get a rootfolder's cleanup_configuration
 @app.get("/v1/rootfolders/{rootfolder_id}/cleanup_configuration", response_model=CleanupConfigurationDTO)
-def fs_read_rootfolder_cleanup_configuration(rootfolder_id: int):
-    return db_api.get_cleanup_configuration_by_rootfolder_id(rootfolder_id)
+def fs_read_rootfolder_cleanup_configuration(rootfolder_id: int, request: Request):
+    return cached_json_response(request, MetadataCache.ROOTFOLDER, rootfolder_id, 
+                                lambda: db_api.json_model_response(CleanupConfigurationDTO, db_api.read_cleanup_configuration_snapshot(rootfolder_id)))
 
 
 # update a rootfolder's cleanup_configuration
@@ -125,37 +165,57 @@ def fs_update_rootfolder_cleanup_configuration(rootfolder_id: int, cleanup_confi
     return updated_config
 
 
+# the retention types of the rootfolder's domain so the response has the domain's version
 @app.get("/v1/rootfolders/{rootfolder_id}/retentiontypes", response_model=list[RetentionTypeDTO])
-def fs_read_rootfolder_retentiontypes(rootfolder_id: int):
-    return db_api.read_rootfolder_retentiontypes(rootfolder_id)
+def fs_read_rootfolder_retentiontypes(rootfolder_id: int, request: Request):
+    return cached_json_response(request, MetadataCache.DOMAIN, db_api.read_rootfolder_simulationdomain_id(rootfolder_id), 
+                                lambda: db_api.json_models_response(RetentionTypeDTO, db_api.read_rootfolder_retentiontypes(rootfolder_id)))
 
 
 @app.get("/v1/rootfolders/{rootfolder_id}/folders/", response_model=list[FolderNodeDTO])
 def fs_read_folders( rootfolder_id: int ):
-    folders = db_api.read_folders( rootfolder_id )
-    for f in  folders:
-        if f.retention_id is None:
-            f.retention_id = 0
-        if f.path_protection_id is None:
-            f.pathprotection_id = 0
-    return folders
-
-# Endpoint to extract and send all FolderNodeDTOs as CSV
-#@app.get("/v1/rootfolders/{rootfolder_id}/folders/csv")
-#def fs_read_folders_csv(rootfolder_id: int):
-#    return db_api.read_folders_csv(rootfolder_id)
-    
-
-# Endpoint to extract and send all FolderNodeDTOs as compressed CSV using zstd
-#@app.get("/v1/rootfolders/{rootfolder_id}/folders/csv-zstd")
-#def fs_read_folders_csv_zstd(rootfolder_id: int):
-#    return db_api.read_folders_csv_zstd(rootfolder_id)
+    return db_api.read_folders_json( rootfolder_id )
+
+# the rootfolder, its cleanup configuration, path protections and folders and its domain's metadata in one response read in one 
+# transaction. The folders are streamed last
+@app.get("/v1/rootfolders/{rootfolder_id}/bootstrap", response_model=dtos.RootFolderBootstrapDTO)
+def fs_read_rootfolder_bootstrap(rootfolder_id: int):
+    return db_api.read_rootfolder_bootstrap(rootfolder_id)
+
+# the folders that changed since the client's version. since=0 returns all folders. 
+# The client passes the returned version as since in the next request
+@app.get("/v1/rootfolders/{rootfolder_id}/folders/changes", response_model=dtos.FolderChangesDTO)
+def fs_read_folder_changes(rootfolder_id: int, since: int = Query(default=0, ge=0)):
+    return db_api.read_folder_changes(rootfolder_id, since)
+
+# the number of simulations per retention_id for each child of parent_id. parent_id=0 gives the top folder of the rootfolder
+@app.get("/v1/rootfolders/{rootfolder_id}/retention_counts", response_model=list[dtos.FolderRetentionCountsDTO])
+def fs_read_retention_counts(rootfolder_id: int, parent_id: int = Query(default=0, ge=0)):
+    return db_api.read_retention_counts(rootfolder_id, parent_id)
+
+# subtree views of a folder. The folder itself is included in the subtree
+@app.get("/v1/rootfolders/{rootfolder_id}/folders/{folder_id}/simulations", response_model=list[FolderNodeDTO])
+def fs_read_simulations_in_subtree(rootfolder_id: int, folder_id: int):
+    return db_api.read_simulations_in_subtree_json(rootfolder_id, folder_id)
+
+@app.get("/v1/rootfolders/{rootfolder_id}/folders/{folder_id}/summary")
+def fs_read_subtree_summary(rootfolder_id: int, folder_id: int):
+    return db_api.read_subtree_summary(rootfolder_id, folder_id)
+
+@app.get("/v1/rootfolders/{rootfolder_id}/folders/{folder_id}/ancestors", response_model=list[FolderNodeDTO])
+def fs_read_ancestors(rootfolder_id: int, folder_id: int):
+    return db_api.read_ancestors(rootfolder_id, folder_id)
+
+# Stream all folders of a rootfolder as csv. The stream is zstd compressed if the request has "Accept-Encoding: zstd"
+@app.get("/v1/rootfolders/{rootfolder_id}/folders/csv")
+def fs_read_folders_csv(rootfolder_id: int, request: Request):
+    return db_api.read_folders_csv(rootfolder_id, request.headers.get("accept-encoding", ""))
 
 #get all path protections for a specific root folder
 @app.get("/v1/rootfolders/{rootfolder_id}/pathprotections", response_model=list[PathProtectionDTO])
-def fs_read_pathprotections( rootfolder_id: int ) -> list[PathProtectionDTO]:
-    dtos:list[PathProtectionDTO]  = db_api.read_pathprotections( rootfolder_id )
-    return dtos
+def fs_read_pathprotections( rootfolder_id: int, request: Request ):
+    return cached_json_response(request, MetadataCache.ROOTFOLDER, rootfolder_id, 
+                                lambda: db_api.json_models_response(PathProtectionDTO, db_api.read_pathprotections( rootfolder_id )))
 
 
 # Add a new path protection to a specific root folder
@@ -180,6 +240,19 @@ def fs_change_retentions(rootfolder_id: int, retentions: list[FolderRetention])
     result = db_api.change_retentions(rootfolder_id, retentions)
     return result
 
+# change the retention of the simulations selected by a filter. Returns the number of changed simulations and their change version
+@app.post("/v1/rootfolders/{rootfolder_id}/retentions/by_filter", response_model=dtos.RetentionChangeResult)
+def fs_change_retentions_by_filter(rootfolder_id: int, change: dtos.RetentionChangeByFilter) -> dtos.RetentionChangeResult:
+    return db_api.change_retentions_by_filter(rootfolder_id, change)
+
+# change the retentions of an explicit list of simulations sent as parallel arrays of folder ids and retention ids. 
+# See db_api.decode_columnar_retentions for the accepted content types. Returns the number of changed simulations and their change version
+@app.post("/v1/rootfolders/{rootfolder_id}/retentions/columnar", response_model=dtos.RetentionChangeResult)
+async def fs_change_retentions_columnar(rootfolder_id: int, request: Request) -> dtos.RetentionChangeResult:
+    folder_ids, retention_ids = db_api.decode_columnar_retentions(request.headers.get("content-type", ""), await request.body())
+    # the event loop waits for the write queue without holding a thread of the threadpool
+    return await WriteQueue.run_async(lambda session: db_api.change_retentions_columnar_in_session(session, rootfolder_id, folder_ids, retention_ids), WriteQueue.INTERACTIVE, rootfolder_id)
+
 #-----------------end maintenance of rootfolders and information under it -------------------
 
 #-----------------Agents API -------------------
@@ -3,7 +3,7 @@ from datetime import date, datetime
 from cleanup import scheduler
 from sqlmodel import Session, select
 from fastapi import HTTPException
-from db.database import Database
+from db.unit_of_work import db_session
 from datamodel import dtos, retentions
 from db import db_api
 from datamodel import dtos
@@ -13,7 +13,7 @@ from cleanup import cleanup_dtos, scheduler_dtos
 
 def task_scan_insert_or_update_simulations_in_db(task_id: int, simulations: list[dtos.FileInfo]) -> dict[str, str]:
     #validate the task_id as a minimum security check
-    with Session(Database.get_engine()) as session:
+    with db_session() as session:
         task = session.exec(
             select(scheduler_dtos.CleanupTaskDTO).where((scheduler_dtos.CleanupTaskDTO.id == task_id))
         ).first()
@@ -27,7 +27,7 @@ def task_clean_insert_or_update_simulations_in_db(task_id: int, simulations: lis
 
 def task_read_folders_marked_for_cleanup(task_id: int) -> list[dtos.FileInfo]:
     # return the list of FileInfo objects for folders that are marked for cleanup in the given rootfolder
-    with Session(Database.get_engine()) as session:
+    with db_session() as session:
         task = session.exec( select(scheduler_dtos.CleanupTaskDTO).where((scheduler_dtos.CleanupTaskDTO.id == task_id)) ).first()
         if not task:
             raise HTTPException(status_code=404, detail=f"The task with id {task_id} was not found")
@@ -2,8 +2,9 @@ from datetime import datetime, timezone
 from sqlmodel import Session, select
 from fastapi import HTTPException
 from app.clock import SystemClock
-from db.database import Database
+from db.unit_of_work import db_session
 from db import db_api
+from db.write_queue import WriteQueue, queued_write
 from datamodel import dtos
 from cleanup import agent_db_interface
 from cleanup.scheduler_dtos import TaskStatus, ActionType, AgentInfo, CleanupTaskDTO 
@@ -13,6 +14,7 @@ class AgentTaskManager:
     
     #agent interface methods
     @staticmethod
+    @queued_write(WriteQueue.BULK)
     def reserve_task(agent: AgentInfo) -> CleanupTaskDTO:
         agent_action_types:list[str]     = agent.action_types if not agent.action_types is None else []
         agent_storage_ids:list[str]|None = agent.supported_storage_ids if not agent.supported_storage_ids is None else []
@@ -20,7 +22,7 @@ class AgentTaskManager:
         if (len(agent_action_types)==0):
             raise HTTPException(status_code=404, detail=f"The agent {agent.agent_id} failed to provide the action types it can support ")
 
-        with Session(Database.get_engine()) as session:
+        with db_session() as session:
             tasks:list[CleanupTaskDTO]= []   
             if agent_storage_ids is not None and len(agent_storage_ids)>0:
                 tasks = session.exec(
@@ -74,29 +76,32 @@ class AgentTaskManager:
 
     @staticmethod
     def task_progress(task_id: str, progress_message: str|None = None) -> dict[str,str]:
+        # progress messages are small so the progress of concurrent agents is committed together
+        return WriteQueue.run(lambda session: AgentTaskManager.task_progress_in_session(session, task_id, progress_message), WriteQueue.BULK)
+
+    @staticmethod
+    def task_progress_in_session(session: Session, task_id: str, progress_message: str|None = None) -> dict[str,str]:
+        task = session.exec( select(CleanupTaskDTO).where((CleanupTaskDTO.id == task_id)) ).first()
+        if not task:
+            raise HTTPException(status_code=404, detail=f"The task with id {task_id} was not found")
         
-        with Session(Database.get_engine()) as session:
-            task = session.exec( select(CleanupTaskDTO).where((CleanupTaskDTO.id == task_id)) ).first()
-            if not task:
-                raise HTTPException(status_code=404, detail=f"The task with id {task_id} was not found")
-            
-            if task.status  != TaskStatus.RESERVED.value:
-                raise HTTPException(status_code=400, detail=f"The task with id {task_id} is not in RESERVED state and cannot be updated to INPROGRESS") 
+        if task.status  != TaskStatus.RESERVED.value:
+            raise HTTPException(status_code=400, detail=f"The task with id {task_id} is not in RESERVED state and cannot be updated to INPROGRESS") 
 
-            task.status = TaskStatus.RESERVED.value
-            task.status_message = progress_message
-            session.add(task)
-            session.commit()
+        task.status = TaskStatus.RESERVED.value
+        task.status_message = progress_message
+        session.add(task)
 
-            return {"message": f"Task {task_id} updated to status {task.status}"}
+        return {"message": f"Task {task_id} updated to status {task.status}"}
 
     @staticmethod
+    @queued_write(WriteQueue.BULK)
     def task_completion(task_id: int, status: str, status_message: str|None = None) -> dict[str,str]:
         # validate that status is valid
         if status not in [TaskStatus.COMPLETED.value, TaskStatus.FAILED.value]:
             raise HTTPException(status_code=404, detail=f"The task status {status} is not valid. Must be one of {[TaskStatus.COMPLETED.value, TaskStatus.FAILED.value]}")
 
-        with Session(Database.get_engine()) as session:
+        with db_session() as session:
             task = session.exec(
                 select(CleanupTaskDTO).where((CleanupTaskDTO.id == task_id))
             ).first()
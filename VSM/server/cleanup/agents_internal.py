@@ -1,7 +1,10 @@
 from datetime import date, timedelta
-from sqlmodel import Session, select
+from typing import Iterator
+from sqlalchemy import case, update
+from sqlmodel import Session, func, select
 from fastapi import HTTPException
-from db.database import Database
+from db.unit_of_work import db_session
+from db.write_queue import WriteQueue, queued_write
 from datamodel import dtos, retentions
 from cleanup import agent_db_interface
 from cleanup.scheduler_dtos import ActionType, AgentInfo, CleanupTaskDTO, TaskStatus 
@@ -49,6 +52,20 @@ class AgentTemplate(ABC):
         pass
 
 
+# ----------------- set-based updates of folders in chunks -----------------
+# The internal agents update all simulations of a rootfolder. The updates are split in chunks of folder ids and the caller 
+# commits after each chunk so the write lock is only held for one chunk at a time and the web api is not blocked for minutes
+FOLDER_UPDATE_CHUNK_SIZE: int = 20000
+
+def folder_chunks(session: Session, where) -> Iterator:
+    """yields a criteria for each chunk of FOLDER_UPDATE_CHUNK_SIZE folders matching where"""
+    folder_table = dtos.FolderNodeDTO.__table__
+    folder_ids: list[int] = session.execute(select(folder_table.c.id).where(where).order_by(folder_table.c.id)).scalars().all()
+    for start in range(0, len(folder_ids), FOLDER_UPDATE_CHUNK_SIZE):
+        chunk_ids = folder_ids[start:start + FOLDER_UPDATE_CHUNK_SIZE]
+        yield where & folder_table.c.id.between(chunk_ids[0], chunk_ids[-1])
+
+
 # ----------------- internal agents implementations -----------------
 class AgentCalendarCreation(AgentTemplate):
     # this ia a fake agent because it does not require a task and will always be run when called
@@ -75,32 +92,78 @@ class AgentMarkSimulationsPreReview(AgentTemplate):
         self.success_message = f"Cleanup cycle started for rootfolder {self.task.rootfolder_id}"
 
     @staticmethod
+    @queued_write(WriteQueue.BULK, unit_of_work=False)
     def mark_simulations(rootfolder_id: int) -> dict[str, str]:
-        # recalculating retentions for all leaf folders in the rootfolder
+        # recalculating retentions for all leaf folders in the rootfolder with set-based updates.
+        # The result is the same as calling retention_calculator.adjust_from_cleanup_configuration_and_modified_date for each simulation
+        # step 1: endstage, path and other non numeric retentions have no expiration date
+        # step 2: numeric and undefined retentions extend their expiration date to modified_date + lead_time 
+        # step 3: bucket the expiration date into the numeric retentions. This also mark simulations for cleanup if they are ready
+        #         Outside the start of a cleanup round only marked simulations are bucketed and they are not allowed to stay marked
+        # The updates are committed per chunk of folders so the write lock is released and waiting interactive changes run between the chunks
+        # Only folders whose values change are written so that the change versions (see db_api.next_change_version) only mark real changes
         db_api.apply_pathprotections(rootfolder_id)  # ThIS should noT be necessary but just to be sure that faulty transactions did not miss any pathprotections    
         len_folders:int = 0
-        with Session(Database.get_engine()) as session:
-            rootfolder:dtos.RootFolderDTO = session.exec(select(dtos.RootFolderDTO).where(dtos.RootFolderDTO.id == rootfolder_id)).first()
-            cleanup_config:dtos.CleanupConfigurationDTO = rootfolder.get_cleanup_configuration(session) if rootfolder else None
+        # the cleanup configuration is a shared table so it is read, or created, before the rootfolder's folders are written
+        cleanup_config:dtos.CleanupConfigurationDTO = db_api.get_cleanup_configuration_by_rootfolder_id(rootfolder_id)
+        with db_session(rootfolder_id=rootfolder_id) as session:
+            rootfolder:dtos.RootFolderDTO = session.get(dtos.RootFolderDTO, rootfolder_id)
 
             if not rootfolder or not cleanup_config:
                 raise HTTPException(status_code=404, detail="rootfolder or cleanup_config not found")
 
             retention_calculator: retentions.RetentionCalculator = retentions.RetentionCalculator(rootfolder_id, cleanup_config.id, session)
 
-            # recalculate numeric retentions for all simulations.
-            # @TODO This can possibly be optimise by limiting the selection to folders with a numeric retentiontypes
             nodetype_leaf_id: int = db_api.read_folder_type_dict_pr_domain_id(rootfolder.simulationdomain_id)[dtos.FolderTypeEnum.SIMULATION].id
-            folders = session.exec( select(dtos.FolderNodeDTO).where( (dtos.FolderNodeDTO.rootfolder_id == rootfolder_id) & \
-                                                                      (dtos.FolderNodeDTO.nodetype_id == nodetype_leaf_id) ) ).all()
-            
-            # update retention: This also mark simulations for cleanup if they are ready
-            for folder in folders:
-                folder.set_retention(retention_calculator.adjust_from_cleanup_configuration_and_modified_date(folder.get_retention(), folder.modified_date))
-                session.add(folder)
-            
-            session.commit()
-            len_folders = len(folders)
+            folder_table  = dtos.FolderNodeDTO.__table__
+            leaf_filter   = (folder_table.c.rootfolder_id == rootfolder_id) & (folder_table.c.nodetype_id == nodetype_leaf_id)
+            is_calculated = folder_table.c.retention_id.in_(retention_calculator.numeric_retention_ids + [retention_calculator.undefined_retention_id])
+
+            # a numeric retention without expiration date and modified date cannot be calculated. Check it before anything is written
+            missing_dates:int = session.exec(select(func.count()).select_from(folder_table).where(
+                leaf_filter & is_calculated & folder_table.c.expiration_date.is_(None) & folder_table.c.modified_date.is_(None))).one()
+            if missing_dates > 0:
+                raise ValueError(f"{missing_dates} simulations in rootfolder {rootfolder_id} have a numeric retention without expiration_date and modified_date")
+
+            # Step 2: expiration_date = max(expiration_date, modified_date + lead_time)
+            earliest_expiration = db_api.add_days_sql(folder_table.c.modified_date, retention_calculator.leadtimedelta.days)
+            new_expiration_date = case((folder_table.c.modified_date.is_(None), folder_table.c.expiration_date),
+                                       (folder_table.c.expiration_date.is_(None) | (folder_table.c.expiration_date < earliest_expiration), earliest_expiration),
+                                       else_=folder_table.c.expiration_date)
+
+            # Step 3: the numeric retention from the expiration date that was set in step 2
+            bucket_retention_id = retention_calculator.numeric_retention_bucket_sql(folder_table.c.expiration_date)
+            if retention_calculator.is_starting_cleanup_round:
+                bucket_filter = is_calculated
+            else:
+                bucket_filter = is_calculated & (folder_table.c.retention_id == retention_calculator.marked_retention_id)
+                bucket_retention_id = case((bucket_retention_id == retention_calculator.marked_retention_id, retention_calculator.get_retention_id_after_marked()), 
+                                           else_=bucket_retention_id)
+
+            clear_expiration_filter  = ~is_calculated & folder_table.c.expiration_date.isnot(None)
+            extend_expiration_filter = is_calculated & folder_table.c.expiration_date.is_distinct_from(new_expiration_date)
+            rebucket_filter          = bucket_filter & folder_table.c.retention_id.is_distinct_from(bucket_retention_id)
+
+            len_folders = session.exec(select(func.count()).select_from(folder_table).where(leaf_filter)).one()
+            for chunk_filter in folder_chunks(session, leaf_filter):
+                connection = session.connection()
+                # a chunk without changes gets no change version. When steps 1 and 2 change nothing, step 3 sees the current 
+                # values, so one check before the updates is enough
+                if connection.execute(select(folder_table.c.id).where(chunk_filter & (clear_expiration_filter | extend_expiration_filter | rebucket_filter))
+                                      .limit(1)).first() is None:
+                    continue
+                change_version:int = db_api.next_change_version(connection, rootfolder_id)
+                # Step 1: non numeric retentions
+                connection.execute(update(folder_table).where(chunk_filter & clear_expiration_filter)
+                                   .values(expiration_date=None, change_version=change_version))
+                # Step 2 and 3: numeric and undefined retentions
+                connection.execute(update(folder_table).where(chunk_filter & extend_expiration_filter)
+                                   .values(expiration_date=new_expiration_date, change_version=change_version))
+                connection.execute(update(folder_table).where(chunk_filter & rebucket_filter)
+                                   .values(retention_id=bucket_retention_id, change_version=change_version))
+                db_api.refresh_retention_counts(connection, rootfolder_id)
+                session.commit()
+                WriteQueue.yield_to_interactive()
 
         return {"message": f"new cleanup cycle started for : {rootfolder_id}. updated retention of {len_folders} folders" }
 
@@ -116,20 +179,29 @@ class AgentUnmarkSimulationsPostReview(AgentTemplate):
         self.success_message = f"Cleanup cycle finishing for rootfolder {self.task.rootfolder_id}"
 
     @staticmethod
+    @queued_write(WriteQueue.BULK, unit_of_work=False)
     def unmark_simulations_post_review(rootfolder_id: int) -> dict[str, str]:
-        with Session(Database.get_engine()) as session:
-            rootfolder:dtos.RootFolderDTO = session.exec(select(dtos.RootFolderDTO).where(dtos.RootFolderDTO.id == rootfolder_id)).first()
-
-            marked_simulations:list[dtos.FolderNodeDTO] = db_api.read_folders_marked_for_cleanup(rootfolder_id)
-            if len(marked_simulations) > 0:
-                # change the retention to the next retention after marked
+        with db_session(rootfolder_id=rootfolder_id) as session:
+            rootfolder:dtos.RootFolderDTO = session.get(dtos.RootFolderDTO, rootfolder_id)
+            if not rootfolder:
+                raise HTTPException(status_code=404, detail="RootFolder not found")
+
+            marked_retention_id:int = db_api.read_rootfolder_retentiontypes_dict(rootfolder_id)["marked"].id
+            nodetype_leaf_id:int    = db_api.read_folder_type_dict_pr_domain_id(rootfolder.simulationdomain_id)[dtos.FolderTypeEnum.SIMULATION].id
+            folder_table  = dtos.FolderNodeDTO.__table__
+            marked_filter = (folder_table.c.rootfolder_id == rootfolder_id) & (folder_table.c.nodetype_id == nodetype_leaf_id) & (folder_table.c.retention_id == marked_retention_id)
+
+            marked_count:int = session.exec(select(func.count()).select_from(folder_table).where(marked_filter)).one()
+            if marked_count > 0:
+                # change the retention to the next retention after marked so that simulations we did not clean will be marked for the next cleanup round
                 retention_calculator: retentions.RetentionCalculator = retentions.RetentionCalculator(rootfolder_id, rootfolder.cleanup_config_id, session)
                 after_marked_retention_id:int                        = retention_calculator.get_retention_id_after_marked()
-                for folder in marked_simulations:
-                    folder.retention_id = after_marked_retention_id # thois that we not clean will marked for the next cleanup round
-                    session.add(folder)
-
-            session.commit()
+                for chunk_filter in folder_chunks(session, marked_filter):
+                    change_version:int = db_api.next_change_version(session.connection(), rootfolder_id)
+                    session.connection().execute(update(folder_table).where(chunk_filter).values(retention_id=after_marked_retention_id, change_version=change_version))
+                    db_api.refresh_retention_counts(session.connection(), rootfolder_id)
+                    session.commit()
+                    WriteQueue.yield_to_interactive()
 
         return {"message": f"Finished cleanup cycle for rootfolder {rootfolder_id}"}
 
@@ -222,8 +294,8 @@ class AgentNotification(AgentTemplate):
         from fastapi import Query, HTTPException
         from db.database import Database
         from datamodel import dtos
-        with Session(Database.get_engine()) as session:
-            rootfolder:dtos.RootFolderDTO = session.exec(select(dtos.RootFolderDTO).where(dtos.RootFolderDTO.id == self.task.rootfolder_id)).first()
+        with db_session() as session:
+            rootfolder:dtos.RootFolderDTO = session.get(dtos.RootFolderDTO, self.task.rootfolder_id)
             config: dtos.CleanupConfigurationDTO = rootfolder.get_cleanup_configuration(session) if rootfolder is not None else None
             if rootfolder is None or config is None:
                 self.error_message = f"RootFolder with ID {self.task.rootfolder_id} not found."
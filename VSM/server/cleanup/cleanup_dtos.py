@@ -3,7 +3,7 @@ from sqlmodel import Session
 from datetime import date, datetime, timedelta
 from datamodel import dtos
 from db import db_api
-from db.database import Database
+from db.write_queue import WriteQueue
 from app.clock import SystemClock
 
 class CleanupState:
@@ -30,11 +30,9 @@ class CleanupState:
             session.add(self.dto)
             session.commit()
             session.refresh(self.dto)
-        else:    
-            with Session(Database.get_engine()) as session:
-                session.add(self.dto)
-                session.commit()
-                session.refresh(self.dto)
+        else:
+            # without the caller's session the configuration is saved by the WriteQueue
+            WriteQueue.run(self.save_to_db, WriteQueue.INTERACTIVE, self.dto.rootfolder_id, main_database=True)
 
     def is_valid(self) -> bool:
         return self.dto.is_valid()
@@ -1,7 +1,8 @@
 from datetime import timedelta, timezone
 from sqlmodel import Session, func, select
 from fastapi import HTTPException
-from db.database import Database
+from db.unit_of_work import db_session
+from db.write_queue import WriteQueue, queued_write
 from datamodel import dtos
 from cleanup import cleanup_dtos, scheduler_dtos
 from cleanup.scheduler_dtos import TaskStatus, CalendarStatus, ActionType, CleanupCalendarDTO, CleanupTaskDTO
@@ -109,6 +110,7 @@ class CleanupScheduler:
             ]
 
     @staticmethod
+    @queued_write(WriteQueue.BULK)
     def create_calendars_for_cleanup_configuration_ready_to_start() -> str:
         # Fetch all rootfolder cleanup configurations that are ready to start a new cleanup cycle.
         # that includes verify that there are no active calendars for the rootfolder.
@@ -118,7 +120,7 @@ class CleanupScheduler:
 
         now = SystemClock.now()
         
-        with Session(Database.get_engine()) as session:
+        with db_session() as session:
             configs = session.exec( select(dtos.CleanupConfigurationDTO).where(
                     (dtos.CleanupConfigurationDTO.lead_time > 0) &
                     (dtos.CleanupConfigurationDTO.frequency > 0) &
@@ -154,11 +156,12 @@ class CleanupScheduler:
             return f"Generated or found {len(calendars)} calendars (JIT mode)."
     
     @staticmethod
+    @queued_write(WriteQueue.BULK)
     def generate_cleanup_calendar(config: cleanup_dtos.CleanupState, stop_after_cleanup_cycle: bool=False) -> "CleanupCalendarDTO":
         # Generate a cleanup calendar WITHOUT pre-creating tasks.
         # Tasks will be created just-in-time by update_calendars_and_tasks().
 
-        with Session(Database.get_engine()) as session:
+        with db_session() as session:
             # Check if there is already an active calendar for this rootfolder
             calendar: CleanupCalendarDTO = session.exec( select(CleanupCalendarDTO).where(
                     (CleanupCalendarDTO.rootfolder_id == config.dto.rootfolder_id) & 
@@ -167,7 +170,7 @@ class CleanupScheduler:
                 return calendar
 
             # No active calendar so go ahead
-            rootfolder = session.exec(select(dtos.RootFolderDTO).where(dtos.RootFolderDTO.id == config.dto.rootfolder_id)).first()
+            rootfolder = session.get(dtos.RootFolderDTO, config.dto.rootfolder_id)
             if not rootfolder:
                 raise HTTPException(status_code=404, detail="RootFolder not found")
 
@@ -190,6 +193,7 @@ class CleanupScheduler:
             return calendar
 
     @staticmethod
+    @queued_write(WriteQueue.BULK)
     def update_calendars_and_tasks() -> dict[str, any]:
         # Periodically check all active calendars and create/activate tasks just-in-time.
         # JIT task creation logic:
@@ -200,7 +204,7 @@ class CleanupScheduler:
         # Returns:
         #     Dictionary with summary of actions taken
 
-        with Session(Database.get_engine()) as session:
+        with db_session() as session:
             # Get all ACTIVE calendars
             active_calendars = session.exec( select(CleanupCalendarDTO).where( CleanupCalendarDTO.status == CalendarStatus.ACTIVE ) ).all()
             calendars_completed = 0
@@ -304,7 +308,7 @@ class CleanupScheduler:
             int: 1 if task was created, 0 otherwise
         """
         # Get rootfolder and config
-        rootfolder = session.exec( select(dtos.RootFolderDTO).where(dtos.RootFolderDTO.id == calendar.rootfolder_id) ).first()
+        rootfolder = session.get(dtos.RootFolderDTO, calendar.rootfolder_id)
         config     = session.exec( select(dtos.CleanupConfigurationDTO).where( dtos.CleanupConfigurationDTO.rootfolder_id == calendar.rootfolder_id )).first()
         if not rootfolder or not config:
             return 0
@@ -357,9 +361,10 @@ class CleanupScheduler:
         return 1
     
     @staticmethod
+    @queued_write(WriteQueue.INTERACTIVE, main_database=True)
     def deactivate_calendar(rootfolder_id: int) -> None:
         # Deactivate all the rootfolder active calendars and their tasks for a given rootfolder.
-        with Session(Database.get_engine()) as session:
+        with db_session() as session:
             # Get all active calendars for this rootfolder
             active_calendars = session.exec(
                 select(CleanupCalendarDTO).where(
@@ -396,7 +401,7 @@ class CleanupScheduler:
 
     def get_active_calendar_by_rootfolder_id(rootfolder_id: int) -> CleanupCalendarDTO | None:
         # Retrieve the active cleanup calendar for a given rootfolder.
-        with Session(Database.get_engine()) as session:
+        with db_session() as session:
             calendar = session.exec(
                 select(CleanupCalendarDTO).where(
                     (CleanupCalendarDTO.rootfolder_id == rootfolder_id) &
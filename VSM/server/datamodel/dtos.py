@@ -1,5 +1,7 @@
 import os
+import posixpath
 from typing import Literal,Optional
+from sqlalchemy import Index, String, event
 from sqlmodel import Field, SQLModel, Session
 from dataclasses import dataclass
 from datetime import datetime
@@ -92,7 +94,7 @@ class Retention(BaseModel):
         from_attributes=True,
     )
     # Core retention data structure for folder retention information.
-    retention_id: int
+    retention_id: int | None = None
     path_protection_id: int  = 0
     expiration_date: datetime | None = None
 
@@ -129,6 +131,24 @@ class FolderRetention(Retention):
         )
         return ret
 
+# Change the retention of all simulations selected by a filter on the server, so the client does not post one FolderRetention per simulation.
+# Every criterion is optional and they are combined with AND:
+#   folder_id:             the subtree of the folder. 0 is all simulations of the rootfolder
+#   current_retention_ids: the simulations that currently have one of these retentions
+#   modified_after/before: modified_after <= modified_date < modified_before
+class RetentionChangeByFilter(BaseModel):
+    model_config = ConfigDict(alias_generator=to_camel, populate_by_name=True)
+    retention_id: int
+    folder_id: int                           = 0
+    current_retention_ids: list[int] | None  = None
+    modified_after: datetime | None          = None
+    modified_before: datetime | None         = None
+
+class RetentionChangeResult(BaseModel):
+    model_config = ConfigDict(alias_generator=to_camel, populate_by_name=True)
+    count: int              # number of simulations that changed
+    change_version: int     # the change version of the simulations that changed. See GET /v1/rootfolders/{id}/folders/changes
+
 class RetentionTypeBase(CamelSQLMOdel):
     simulationdomain_id: int        = Field(foreign_key="simulationdomaindto.id") 
     name: str                       = Field(default="numeric")  # Store retention name as string (display label like "+90d", "Marked", or enum values)
@@ -335,7 +355,7 @@ class FolderNodeBase(CamelSQLMOdel):
     # we should gravitate towards using the Retention dataclass to enforce consistency between retention_id and pathprotection_id nad possibly expiration_date
     def get_retention(self) -> "Retention":
         from datamodel.retentions import Retention
-        return Retention(self.retention_id, self.path_protection_id, self.expiration_date)
+        return Retention(retention_id=self.retention_id, path_protection_id=self.path_protection_id, expiration_date=self.expiration_date)
     
     def set_retention(self, retention: "Retention"):
         self.retention_id = retention.retention_id
@@ -371,5 +391,84 @@ class FolderNodeBase(CamelSQLMOdel):
             external_retention=external_retention,
         )
 
+# Case-insensitive lookup key for a path: forward slashes, no trailing or duplicate slashes, lowercase.
+# Empty paths have no key so that they do not collide in the unique index
+def to_path_key(path: str | None) -> str | None:
+    if not path:
+        return None
+    return posixpath.normpath(path.replace("\\", "/")).lower()
+
+def to_name_key(name: str | None) -> str | None:
+    return name.lower() if name else None
+
 class FolderNodeDTO(FolderNodeBase, table=True):
-    id: int | None = Field(default=None, primary_key=True)
+    # path_key and name_key are persisted so that lookups can seek on an index instead of scanning with func.lower(...)
+    # They are maintained by the before_insert/before_update listener below and by the bulk inserts in db_api. 
+    # They are not part of the API. 
+    # path_key is compared with byte order in db_api.path_key_in_subtree. That is SQLite's default and the "C" collation on PostgreSQL
+    __table_args__ = (
+        Index("ix_foldernodedto_rootfolder_id_path_key", "rootfolder_id", "path_key", unique=True),
+        Index("ix_foldernodedto_rootfolder_id_parent_id_name_key", "rootfolder_id", "parent_id", "name_key", unique=True),
+        # covering index for the change detection of scanned simulations. See db_api.select_new_or_changed_simulations
+        Index("ix_foldernodedto_rootfolder_id_path_key_fingerprint", "rootfolder_id", "path_key", "modified_date", "retention_id"),
+        # keyset pagination of the folders of a rootfolder. See db_api.read_folder_pages
+        Index("ix_foldernodedto_rootfolder_id_id", "rootfolder_id", "id"),
+        # delta sync of the folders changed since a version. See db_api.read_folder_changes
+        Index("ix_foldernodedto_rootfolder_id_change_version", "rootfolder_id", "change_version"),
+    )
+    id: int | None       = Field(default=None, primary_key=True)
+    path_key: str | None = Field(default=None, exclude=True, sa_type=String().with_variant(String(collation="C"), "postgresql"))
+    name_key: str | None = Field(default=None, exclude=True)
+    change_version: int  = Field(default=0, exclude=True)  # the rootfolder's change version of the last write of the row
+    counted_retention_id: int | None = Field(default=None, exclude=True)  # the retention the simulation is counted with in FolderRetentionCountDTO
+
+    def update_keys(self):
+        self.path_key = to_path_key(self.path)
+        self.name_key = to_name_key(self.name)
+
+@event.listens_for(FolderNodeDTO, "before_insert")
+@event.listens_for(FolderNodeDTO, "before_update")
+def _update_folder_node_keys(mapper, connection, target: FolderNodeDTO):
+    target.update_keys()
+
+# The folders that changed in a rootfolder since the client's version. 
+# is_full_snapshot is True when the folders are all folders of the rootfolder and the client must replace what it has
+class FolderChangesDTO(CamelSQLMOdel):
+    version: int
+    is_full_snapshot: bool
+    folders: list[FolderNodeDTO]
+
+# Everything the webclient reads when it opens a rootfolder, read in one transaction. See db_api.read_rootfolder_bootstrap. 
+# change_version is the version of the folders for the next GET /v1/rootfolders/{rootfolder_id}/folders/changes
+class RootFolderBootstrapDTO(CamelSQLMOdel):
+    rootfolder: RootFolderDTO
+    change_version: int
+    simulation_domain: SimulationDomainDTO
+    cleanup_configuration: CleanupConfigurationDTO | None
+    retention_types: list[RetentionTypeDTO]
+    folder_types: list[FolderTypeDTO]
+    lead_times: list[LeadTimeDTO]
+    cleanup_frequencies: list[CleanupFrequencyDTO]
+    path_protections: list[PathProtectionDTO]
+    folders: list[FolderNodeDTO]
+
+# Materialized number of simulations per retention in the subtree of each inner folder. A simulation is counted in all its ancestors. 
+# Maintained by db_api.refresh_retention_counts
+class FolderRetentionCountDTO(SQLModel, table=True):
+    folder_id: int        = Field(primary_key=True, foreign_key="foldernodedto.id")
+    retention_id: int     = Field(primary_key=True, foreign_key="retentiontypedto.id")
+    rootfolder_id: int    = Field(foreign_key="rootfolderdto.id", index=True)
+    simulation_count: int = Field(default=0)
+
+# The versions of the folders of a rootfolder. It is a folder table so it lives in the rootfolder's shard with the folders, see db/database.py.
+# The row is created by the first write of the rootfolder's folders
+class FolderVersionDTO(SQLModel, table=True):
+    rootfolder_id: int            = Field(primary_key=True, foreign_key="rootfolderdto.id")
+    change_version: int           = Field(default=0)   # the latest change version of the folders in the rootfolder. See db_api.next_change_version
+    retention_counts_version: int = Field(default=-1)  # the change version that FolderRetentionCountDTO is refreshed to. See db_api.refresh_retention_counts
+
+# the number of simulations per retention_id for a folder. For a simulation it is its own retention
+class FolderRetentionCountsDTO(CamelSQLMOdel):
+    folder_id: int
+    nodetype_id: int
+    retention_counts: dict[int, int]
@@ -3,6 +3,8 @@ from bisect import bisect_left
 from dataclasses import dataclass
 from typing import Literal, Optional
 from datetime import date, datetime, timedelta
+import numpy as np
+from sqlalchemy import case, literal
 from sqlmodel import Field, SQLModel, Session
 from dataclasses import dataclass
 from datamodel import dtos
@@ -11,16 +13,61 @@ from cleanup import cleanup_dtos
 from app.clock import SystemClock
 
 
+# sentinel for a missing retention_id in the columnar batch calculation. Retention ids are positive so -1 never collides
+NO_RETENTION_ID: int = -1
+
+_EPOCH: datetime = datetime(1970, 1, 1)
+_MICROSECOND: timedelta = timedelta(microseconds=1)
+_NAT_AS_INT64: int = np.iinfo(np.int64).min
+
+def to_datetime64(dates: list[datetime | None]) -> np.ndarray:
+    """list of naive datetimes to a datetime64[us] array. None becomes NaT"""
+    # going through int64 microseconds is several times faster than letting numpy convert the datetime objects
+    return np.fromiter(((date - _EPOCH) // _MICROSECOND if date is not None else _NAT_AS_INT64 for date in dates), 
+                       dtype=np.int64, count=len(dates)).view("datetime64[us]")
+
+def from_datetime64(dates: np.ndarray) -> list[datetime | None]:
+    """datetime64 array to a list of datetimes. NaT becomes None"""
+    return dates.astype("datetime64[us]").astype(object).tolist()
+
+
+class PathProtectionMatcher:
+    """
+    Finds the most specific path protection for a path with one hash lookup per path segment. 
+    The cost is O(path depth) regardless of the number of protections.
+    """
+    def __init__(self, sorted_protections: list[tuple[str, int]]):
+        # sorted_protections are normalized paths with the most specific first. The first protection of a path wins like in the linear scan
+        self.protection_ids: dict[str, int] = {}
+        for pattern, protection_id in sorted_protections:
+            self.protection_ids.setdefault(pattern, protection_id)
+
+    def match(self, path: str) -> int | None:
+        """the id of the longest protected prefix of the normalized path with '/' boundary ("R1" does not match "R10/...") or None"""
+        if not self.protection_ids:
+            return None
+        protection_id = self.protection_ids.get(path)
+        # walk up the path one segment at a time
+        separator = path.rfind('/')
+        while protection_id is None and separator >= 0:
+            protection_id = self.protection_ids.get(path[:separator])
+            separator = path.rfind('/', 0, separator)
+        return protection_id
+
+
 class RetentionCalculator:
     # use ids for __init__ in order to avoid circular import due to RootFolderDTO
-    def __init__(self, rootfolder_id: int, cleanup_config_id: int, session:Session):
-        from db.db_api import read_pathprotections, read_rootfolder_retentiontypes_dict # avoid circular import
+    def __init__(self, rootfolder_id: int, cleanup_config_id: int, session:Session|None):
+        from db.db_api import read_pathprotections, read_rootfolder_retentiontypes_dict, read_cleanup_configuration_snapshot # avoid circular import
+        # the retention types and path protections are read through the db_api metadata cache. The cleanup configuration is read 
+        # from the caller's session if there is one, so a progress or start date that the caller's transaction changed is used
+        retention_type_dict: dict[str, RetentionTypeDTO] = read_rootfolder_retentiontypes_dict(rootfolder_id)
+
         # info for path retentions
-        self.path_retention_dict:dict[str, RetentionTypeDTO] = read_rootfolder_retentiontypes_dict(rootfolder_id)
+        self.path_retention_dict:dict[str, RetentionTypeDTO] = retention_type_dict
         self.path_retention_id:int = self.path_retention_dict["path"].id if "path" in self.path_retention_dict else 0
         self.default_path_protection_id: int = 0 # @TODO wil this be used?
 
-        #self.match_prefix_id = make_prefix_id_matcher(protections)
         protections:list[dtos.PathProtectionDTO] = read_pathprotections(rootfolder_id)
         self.sorted_protections: list[tuple[str, int]] = [(dto.path.lower().replace('\\', '/').rstrip('/'), dto.id) for dto in protections]
 
@@ -29,6 +76,7 @@ class RetentionCalculator:
             key=lambda item: item[0].count('/'),
             reverse=True
         )
+        self.protection_matcher = PathProtectionMatcher(self.sorted_protections)
 
 
         # Info for all other retentions
@@ -36,8 +84,13 @@ class RetentionCalculator:
         if not cleanup_config_id or cleanup_config_id <= 0:
             raise ValueError("The cleanup_config_id:{cleanup_config_id} must be valid")
         
-        cleanup_state: cleanup_dtos.CleanupState = cleanup_dtos.CleanupState.load_by_id(session, cleanup_config_id) 
-        retention_type_dict: dict[str, RetentionTypeDTO] = read_rootfolder_retentiontypes_dict(rootfolder_id)
+        if session is not None:
+            cleanup_state: cleanup_dtos.CleanupState = cleanup_dtos.CleanupState.load_by_id(session, cleanup_config_id)
+        else:
+            cleanup_config: dtos.CleanupConfigurationDTO = read_cleanup_configuration_snapshot(rootfolder_id)
+            if cleanup_config.id != cleanup_config_id:
+                raise ValueError(f"The cleanup_config_id:{cleanup_config_id} is not the cleanup configuration of rootfolder {rootfolder_id}")
+            cleanup_state: cleanup_dtos.CleanupState = cleanup_dtos.CleanupState(cleanup_config)
 
         if not retention_type_dict or not cleanup_state.is_valid():
             raise ValueError("cleanup_round_start_date, at least one numeric retention type and lead_time must be set for RetentionCalculator to work")
@@ -58,7 +111,7 @@ class RetentionCalculator:
 
         self.leadtimedelta              = timedelta(days=cleanup_state.dto.lead_time)
 
-        self.retention_type_str_dict:dict[str, RetentionTypeDTO] = read_rootfolder_retentiontypes_dict(rootfolder_id)
+        self.retention_type_str_dict:dict[str, RetentionTypeDTO] = retention_type_dict
         self.retention_type_id_dict      = {retention.id: retention for retention in self.retention_type_str_dict.values()}
         self.path_retention_id           = self.retention_type_str_dict["path"].id   if self.retention_type_str_dict.get("path", None) is not None else 0  
         self.marked_retention_id         = self.retention_type_str_dict["marked"].id if self.retention_type_str_dict.get("marked", None) is not None else 0  
@@ -74,6 +127,11 @@ class RetentionCalculator:
         self.numeric_retention_ids       = [retention.id              for retention in numeric_retention_types]
         self.numeric_retention_durations = [retention.days_to_cleanup for retention in numeric_retention_types]
 
+        # the same information as arrays for calculate_retentions_from_scan_batch
+        self.numeric_retention_ids_array       = np.array(self.numeric_retention_ids, dtype=np.int64)
+        self.numeric_retention_durations_array = np.array(self.numeric_retention_durations, dtype=np.int64)
+        self.endstage_retention_ids_array      = np.array([retention.id for retention in self.get_endstage_retentions()], dtype=np.int64)
+
     def is_numeric(self, retention_id:int) -> bool:
         return retention_id in self.numeric_retention_id_dict   
 
@@ -171,6 +229,14 @@ class RetentionCalculator:
             #    print("Warning: retention_id is set to 'marked' in RetentionCalculator adjust_from_cleanup_configuration_and_modified_date")
 
         return retention
+    def numeric_retention_bucket_sql(self, expiration_date_column):
+        """SQL CASE with the numeric retention id for an expiration date. The same bucketing as bisect_left in adjust_from_cleanup_configuration_and_modified_date"""
+        # days_to_expiration <= duration is the same as expiration_date < cleanup_round_start_date + duration + 1 day 
+        # because days_to_expiration is the floor of the number of days. The last numeric retention takes everything above the thresholds
+        whens = [(expiration_date_column < self.cleanup_round_start_date + timedelta(days=duration + 1), retention_id)
+                 for duration, retention_id in zip(self.numeric_retention_durations[:-1], self.numeric_retention_ids[:-1])]
+        return case(*whens, else_=self.numeric_retention_ids[-1]) if whens else literal(self.numeric_retention_ids[-1])
+
     def get_retention_id_after_marked(self) -> Optional[RetentionTypeDTO]:
         # skip marked at index 0. 
         # This works because 1) the "marked" retention is mandatory for the cleanup solution and has days_to_cleanup = 0 
@@ -196,14 +262,18 @@ class RetentionCalculator:
     #it returns the id to the PathProtectionDTO and prioritizes the most specific path (most segments) if any.
     def match(self, path:str) -> Optional[Retention]:
         """
-        Returns a function that, given a path, returns the id of the longest
+        Returns Retention(path retention, pathprotection_id) of the longest
         protection that is a prefix of the path (with '/' boundary) or None.
         """
-        path = (path or "").rstrip('/').lower().replace('\\', '/')
-        for pat, pid in self.sorted_protections:  # short-circuits on first (longest) match
-            if path == pat or path.startswith(pat + "/"):  # avoids "R1" matching "R10/..."
-                return Retention( self.path_retention_id, pid)
-        return None
+        protection_id = self.protection_matcher.match((path or "").rstrip('/').lower().replace('\\', '/'))
+        return None if protection_id is None else Retention(retention_id=self.path_retention_id, path_protection_id=protection_id)
+
+    def match_batch(self, paths: list[str]) -> np.ndarray:
+        """the path protection id that match() finds for each path as an int64 array. 0 if the path is not protected"""
+        if not self.sorted_protections:
+            return np.zeros(len(paths), dtype=np.int64)
+        return np.fromiter((self.protection_matcher.match((path or "").rstrip('/').lower().replace('\\', '/')) or 0 for path in paths), 
+                           dtype=np.int64, count=len(paths))
 
     def calculate_retention_from_scan(self, db_retention: Retention, db_modified_date: date, sim_external_retention, sim_modified_date: date, folder_path: str) -> tuple[Retention, date]:
         """
@@ -248,7 +318,7 @@ class RetentionCalculator:
             new_retention = path_retention
         elif sim_retention_id is not None and self.is_endstage(sim_retention_id):
             # Simulation has an endstage retention (clean, issue, or missing) - apply it
-            new_retention = Retention(sim_retention_id)
+            new_retention = Retention(retention_id=sim_retention_id)
         elif db_retention.retention_id is not None and self.is_endstage(db_retention.retention_id):  #@TODO fishy . Have to review the logic
             # DB retention is in endstage 
 
@@ -272,4 +342,90 @@ class RetentionCalculator:
                 new_retention, db_modified_date
             )
         
-        return new_retention, new_modified_date
\ No newline at end of file
+        return new_retention, new_modified_date
+    def calculate_retentions_from_scan_batch(self, db_retention_ids: np.ndarray, db_path_protection_ids: np.ndarray, db_expiration_dates: np.ndarray,
+                                             db_modified_dates: np.ndarray, sim_external_retentions: list[ExternalRetentionTypes | None],
+                                             sim_modified_dates: np.ndarray, folder_paths: list[str]) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Columnar version of calculate_retention_from_scan for a batch of simulations. 
+        The result is the same as calling calculate_retention_from_scan for each simulation in the batch.
+
+        Args:
+            db_retention_ids: int64 array of the current retention ids. NO_RETENTION_ID for a missing retention
+            db_path_protection_ids: int64 array of the current path protection ids
+            db_expiration_dates: datetime64 array of the current expiration dates. NaT for None
+            db_modified_dates: datetime64 array of the current modified dates. NaT for None
+            sim_external_retentions: external retention types from the scanned simulations (can contain None)
+            sim_modified_dates: datetime64 array of the modified dates from the scanned simulations
+            folder_paths: paths for checking path protection
+
+        Returns:
+            Tuple of arrays (retention_ids, path_protection_ids, expiration_dates, modified_dates)
+        """
+        retention_ids       = np.array(db_retention_ids, dtype=np.int64)
+        path_protection_ids = np.array(db_path_protection_ids, dtype=np.int64)
+        expiration_dates    = np.array(db_expiration_dates, dtype="datetime64[us]")
+        db_modified_dates   = np.array(db_modified_dates, dtype="datetime64[us]")
+        sim_modified_dates  = np.array(sim_modified_dates, dtype="datetime64[us]")
+        not_a_time          = np.datetime64("NaT", "us")
+
+        # Convert external retentions to internal type IDs. Only a handful of distinct values so they are converted once each
+        internal_ids: dict[ExternalRetentionTypes, int | None] = {external: self.to_internal_type_id(external) for external in set(sim_external_retentions) if external is not None}
+        sim_retention_ids = np.array([NO_RETENTION_ID if external is None or internal_ids[external] is None else internal_ids[external] 
+                                      for external in sim_external_retentions], dtype=np.int64)
+
+        # Check for path protection (highest priority). 0 means no protection
+        matched_protection_ids = self.match_batch(folder_paths)
+
+        # Apply retention priority logic as masks. Each mask excludes the higher priority masks
+        is_path_protected = matched_protection_ids != 0
+        is_sim_endstage   = ~is_path_protected & np.isin(sim_retention_ids, self.endstage_retention_ids_array)
+        is_db_endstage    = ~is_path_protected & ~is_sim_endstage & np.isin(retention_ids, self.endstage_retention_ids_array)
+
+        retention_ids       = np.where(is_path_protected, self.path_retention_id, retention_ids)
+        retention_ids       = np.where(is_sim_endstage, sim_retention_ids, retention_ids)
+        retention_ids       = np.where(is_db_endstage, NO_RETENTION_ID, retention_ids)
+        path_protection_ids = np.where(is_path_protected, matched_protection_ids, np.where(is_sim_endstage | is_db_endstage, 0, path_protection_ids))
+        expiration_dates    = np.where(is_path_protected | is_sim_endstage | is_db_endstage, not_a_time, expiration_dates)
+
+        # Handle modified_date changes as in adjust_from_cleanup_configuration_and_modified_date
+        #   - no modified_date in the db: use the scanned modified_date and a missing retention becomes undefined
+        #   - a new modified_date: use it and the retention becomes undefined unless it is path protected
+        db_modified_missing = np.isnat(db_modified_dates)
+        modified_changed    = ~db_modified_missing & ~np.isnat(sim_modified_dates) & (sim_modified_dates != db_modified_dates)
+        modified_dates      = np.where(db_modified_missing | modified_changed, sim_modified_dates, db_modified_dates) # used for the expiration date
+        retention_ids       = np.where(db_modified_missing & (retention_ids == NO_RETENTION_ID), self.undefined_retention_id, retention_ids)
+        retention_ids       = np.where(modified_changed & (retention_ids != self.path_retention_id), self.undefined_retention_id, retention_ids)
+
+        # endstage, path and other non numeric retentions keep their retention_id and have no expiration date
+        is_calculated    = (retention_ids == NO_RETENTION_ID) | np.isin(retention_ids, self.numeric_retention_ids_array) | (retention_ids == self.undefined_retention_id)
+        expiration_dates = np.where(is_calculated, expiration_dates, not_a_time)
+
+        # numeric or unknown retentions: extend the expiration date to modified_date + lead time
+        has_modified_date  = is_calculated & ~np.isnat(modified_dates)
+        earliest_expiration = modified_dates + np.timedelta64(self.leadtimedelta)
+        expiration_dates   = np.where(has_modified_date & np.isnat(expiration_dates), earliest_expiration,
+                             np.where(has_modified_date, np.maximum(expiration_dates, earliest_expiration), expiration_dates))
+
+        if np.any(is_calculated & np.isnat(expiration_dates)):
+            raise ValueError("retention.expiration_date is None in RetentionCalculator calculate_retentions_from_scan_batch")
+
+        # bucket the expiration dates into the numeric retentions: first index where retention_duration[idx] >= days_to_expiration 
+        # and the last numeric retention if days_to_expiration is greater than every threshold
+        cleanup_round_start_date = np.datetime64(self.cleanup_round_start_date, "us")
+        days_to_expiration = (np.where(is_calculated, expiration_dates, cleanup_round_start_date) - cleanup_round_start_date) // np.timedelta64(1, "D")
+        bucket_index       = np.minimum(np.searchsorted(self.numeric_retention_durations_array, days_to_expiration, side="left"),
+                                        len(self.numeric_retention_durations_array) - 1)
+        bucket_ids         = self.numeric_retention_ids_array[bucket_index]
+
+        if self.is_starting_cleanup_round: 
+            # this is the phase where all retention are adjusted according to their expiration_date
+            retention_ids = np.where(is_calculated, bucket_ids, retention_ids)
+        else:
+            # outside the start of a cleanup round only missing and marked retentions are changed and they must not become marked
+            is_user_controlled = is_calculated & (retention_ids != NO_RETENTION_ID) & (retention_ids != self.marked_retention_id)
+            bucket_ids         = np.where(bucket_ids == self.marked_retention_id, self.get_retention_id_after_marked(), bucket_ids)
+            retention_ids      = np.where(is_calculated & ~is_user_controlled, bucket_ids, retention_ids)
+
+        # the scanned modified_date is always the new modified_date
+        return retention_ids, path_protection_ids, expiration_dates, sim_modified_dates
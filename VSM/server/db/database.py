@@ -1,31 +1,150 @@
-from typing import Optional
+import glob
+import os
+import threading
+from typing import Callable, Optional
+from urllib.parse import quote
 from sqlmodel import SQLModel, Session, create_engine, select
-from sqlalchemy import Engine
+from sqlalchemy import Engine, Table, event
 from app.app_config import AppConfig
 
+# The database has two engines:
+#   _engine, the writer engine: agents, ingestion and all changes. get_engine() returns it, so it is also the engine of everything 
+#            that has not been moved to the reader engine
+#   _read_engine, a pool of read-only connections for the reads of the api. get_read_engine() returns it
+# Both apply the AppConfig.SQLiteProfile pragmas to every new connection. With the wal profile the readers see the last commit 
+# while a writer is writing, instead of waiting for the writer's lock. 
+# The writer engine has a pool of connections and not one connection, because db_api functions open their own session while 
+# the caller's session is open. SQLite allows one writer at a time and the busy timeout makes the other writers wait for it
+#
+# The backend is the dialect of AppConfig.get_db_url(): a SQLite file or a PostgreSQL server. engine_factories creates the two 
+# engines of each backend. On PostgreSQL the readers are read-only transactions and the writers do not wait for each other's lock
+# A SQLite database is served by one server process. A PostgreSQL database can be served by several processes, so is_single_process 
+# is false and the process-wide caches that are only invalidated by this process's commits are bypassed, see db/metadata_cache.py
+#
+# In the sharded storage mode (AppConfig.get_storage_mode()) the folder tables of each rootfolder, see shard_tables(), are in their own
+# SQLite file next to the main database: db.sqlite keeps the shared tables and db_rootfolder_<id>.sqlite the folders of rootfolder <id>. 
+# get_engine(rootfolder_id) and get_read_engine(rootfolder_id) return the engines of the rootfolder's shard. They are created on first use 
+# together with the shard's tables. A shard connection attaches the main database read-only as "vsm", so the folder queries can join 
+# the shared tables unchanged, BEGIN IMMEDIATE on a shard only takes the shard's write lock and a write to a shared table from a shard 
+# connection fails instead of taking the main database's lock. The writers of different shards and of the main database therefore 
+# run in parallel, see db/write_queue.py. Folder ids are unique within a shard only, so folders are always looked up by rootfolder.
+# In the single storage mode, and without a rootfolder, the engines are those of the main database
 class Database:
     _instance: Optional["Database"] = None
     _engine: Optional[Engine] = None
-    sqlite_url: str = ""
+    _read_engine: Optional[Engine] = None
+    db_url: str = ""
+    is_sharded: bool = False
+    is_single_process: bool = True
+    _shard_engines: dict[int, tuple[Engine, Engine]] = {}
+    _shard_lock: threading.Lock = threading.Lock()
 
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(Database, cls).__new__(cls)
             # Get the database URL from AppConfig based on test mode
             config = AppConfig()
-            sqlite_url = config.get_db_url()
-            cls._instance._initialize(sqlite_url)
-            print(f"create new db instance at: {cls._instance.sqlite_url}")
+            db_url = config.get_db_url()
+            cls._instance._initialize(db_url)
+            print(f"create new db instance at: {cls._instance.db_url}")
         return cls._instance
 
-    def _initialize(self, sqlite_url: str):
-        self._engine = create_engine(sqlite_url, echo=False)
-        self.sqlite_url = sqlite_url
+    def _initialize(self, db_url: str):
+        backend: str = db_url.split(":", 1)[0].split("+", 1)[0]
+        if backend not in engine_factories:
+            raise ValueError(f"unsupported database {db_url}. Use one of {list(engine_factories)}")
+        self.is_sharded = AppConfig.get_storage_mode() == "sharded"
+        if self.is_sharded and (backend != "sqlite" or AppConfig.get_sqlite_profile().journal_mode != "wal"):
+            # the shards read the main database while its writer commits, which only wal allows
+            raise ValueError(f"the sharded storage mode requires a SQLite database with the wal profile, not {db_url}")
+        self.is_single_process = backend == "sqlite"
+        self._engine, self._read_engine = engine_factories[backend](db_url)
+        self._shard_engines = {}
+        self.db_url = db_url
 
     #only call this if we need to create the tables
     def create_db_and_tables(self):
         if self.get_engine() is not None:
-            SQLModel.metadata.create_all(self._engine)
+            create_tables(self._engine, main_tables() if self.is_sharded else None)
+            Database.clear_metadata_cache()
+
+    # the metadata cache in db_api is keyed by ids, so it must be dropped whenever the database is created or deleted
+    @staticmethod
+    def clear_metadata_cache():
+        from db.metadata_cache import MetadataCache # placed here to avoid circular imports
+        MetadataCache.clear()
+
+    # Bring an existing database up to the current schema.
+    # create_all only creates missing tables, so columns and indexes added to existing tables are handled here
+    def upgrade_db(self):
+        if self.get_engine() is None:
+            return
+
+        from sqlalchemy import inspect, text
+        from datamodel.dtos import FolderNodeDTO, FolderVersionDTO, RootFolderDTO, to_path_key, to_name_key
+        inspector = inspect(self._engine)
+        if self.is_sharded:
+            # the shards are created with the current schema. The folders of a single file database are not moved into shards
+            if inspector.has_table(FolderNodeDTO.__tablename__):
+                raise ValueError(f"{self.db_url} has the folders of the single storage mode. Use the single storage mode or a new database")
+            if inspector.has_table(RootFolderDTO.__tablename__):
+                create_tables(self._engine, main_tables())
+            return
+        if not inspector.has_table(FolderNodeDTO.__tablename__):
+            return
+        # tables that were added to the model after the database was created
+        create_tables(self._engine)
+
+        # path_key and name_key on FolderNodeDTO are backfilled in python so that they are normalized exactly as on insert
+        existing_columns = {column["name"] for column in inspector.get_columns(FolderNodeDTO.__tablename__)}
+        missing_columns  = [column for column in ["path_key", "name_key"] if column not in existing_columns]
+        with self._engine.begin() as connection:
+            for column in missing_columns:
+                connection.execute(text(f"ALTER TABLE {FolderNodeDTO.__tablename__} ADD COLUMN {column} VARCHAR"))
+
+            if missing_columns:
+                rows = connection.execute(text(f"SELECT id, path, name FROM {FolderNodeDTO.__tablename__}")).all()
+                if rows:
+                    connection.execute(
+                        text(f"UPDATE {FolderNodeDTO.__tablename__} SET path_key = :path_key, name_key = :name_key WHERE id = :id"),
+                        [{"id": id, "path_key": to_path_key(path), "name_key": to_name_key(name)} for id, path, name in rows]
+                    )
+                print(f"upgrade_db: added {missing_columns} to {FolderNodeDTO.__tablename__} and backfilled {len(rows)} rows")
+
+            # columns whose values for existing rows are a constant. change versions of existing rows start at 0
+            added_columns = [(FolderNodeDTO.__tablename__, "change_version",           "INTEGER NOT NULL DEFAULT 0"),
+                             (FolderNodeDTO.__tablename__, "counted_retention_id",     "INTEGER")]
+            for table, column, column_type in added_columns:
+                if column not in {existing["name"] for existing in inspector.get_columns(table)}:
+                    connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}"))
+                    print(f"upgrade_db: added {column} to {table}")
+
+            # the versions of the rootfolders were columns of RootFolderDTO. Rootfolders without versions start at change version 0 and
+            # their retention counts are built by the first refresh
+            rootfolder_columns = {column["name"] for column in inspector.get_columns(RootFolderDTO.__tablename__)}
+            versions = "change_version, retention_counts_version" if {"change_version", "retention_counts_version"} <= rootfolder_columns else "0, -1"
+            added_versions = connection.execute(text(
+                f"INSERT INTO {FolderVersionDTO.__tablename__} (rootfolder_id, change_version, retention_counts_version) "
+                f"SELECT id, {versions} FROM {RootFolderDTO.__tablename__} WHERE id NOT IN (SELECT rootfolder_id FROM {FolderVersionDTO.__tablename__})")).rowcount
+            if added_versions > 0:
+                print(f"upgrade_db: added the versions of {added_versions} rootfolders to {FolderVersionDTO.__tablename__}")
+
+            # the unique indexes over the backfilled keys cannot be created if folders of a rootfolder have paths that only differ
+            # in case or separators. Those keys are reported and the index is created without the unique constraint so the server
+            # still starts. A later upgrade makes the index unique once the duplicates are removed
+            existing_indexes: dict[str, bool] = {index["name"]: bool(index["unique"]) for index in inspect(connection).get_indexes(FolderNodeDTO.__tablename__)}
+            for index in FolderNodeDTO.__table__.indexes:
+                duplicates = find_duplicate_keys(connection, index) if index.unique else []
+                if duplicates:
+                    print(f"upgrade_db: {len(duplicates)} duplicate keys in {FolderNodeDTO.__tablename__} prevent the unique index {index.name}. "
+                          f"It is created without the unique constraint until they are removed: {duplicates[:20]}")
+                    connection.execute(text(f"CREATE INDEX IF NOT EXISTS {index.name} ON {FolderNodeDTO.__tablename__} "
+                                            f"({', '.join(column.name for column in index.columns)})"))
+                    continue
+                if index.unique and existing_indexes.get(index.name) is False:
+                    connection.execute(text(f"DROP INDEX {index.name}"))
+                    print(f"upgrade_db: {index.name} is unique again")
+                index.create(connection, checkfirst=True)
 
     @classmethod
     def get_db(cls) -> "Database":
@@ -34,8 +153,56 @@ class Database:
         return cls._instance
 
     @classmethod
-    def get_engine(cls) -> Engine:
-        return Database.get_db()._engine
+    def get_engine(cls, rootfolder_id: int | None = None) -> Engine:
+        """the writer engine of the database with the folders of the rootfolder. Without a rootfolder it is the main database"""
+        db: Database = Database.get_db()
+        if rootfolder_id is None or not db.is_sharded:
+            return db._engine
+        return db.get_shard_engines(rootfolder_id)[0]
+
+    @classmethod
+    def get_read_engine(cls, rootfolder_id: int | None = None) -> Engine:
+        """the engine of the read-only connections. Changes must use get_engine()"""
+        db: Database = Database.get_db()
+        if rootfolder_id is None or not db.is_sharded:
+            return db._read_engine
+        return db.get_shard_engines(rootfolder_id)[1]
+
+    @classmethod
+    def shard_id(cls, rootfolder_id: int | None) -> int | None:
+        """the rootfolder whose shard holds the folders of the rootfolder, or None if they are in the main database"""
+        return rootfolder_id if Database.get_db().is_sharded else None
+
+    def get_shard_engines(self, rootfolder_id: int) -> tuple[Engine, Engine]:
+        # the (writer, reader) engines of the shard of the rootfolder. The shard of an unknown rootfolder is not created
+        engines: tuple[Engine, Engine] | None = self._shard_engines.get(rootfolder_id)
+        if engines is not None:
+            return engines
+        with Database._shard_lock:
+            if rootfolder_id not in self._shard_engines:
+                from datamodel.dtos import RootFolderDTO
+                with Session(self._read_engine) as session:
+                    if session.get(RootFolderDTO, rootfolder_id) is None:
+                        from fastapi import HTTPException
+                        raise HTTPException(status_code=404, detail=f"rootfolder {rootfolder_id} not found")
+                engines = create_sqlite_shard_engines(self.db_file(), self.shard_file(rootfolder_id))
+                create_tables(engines[0], shard_tables())
+                self._shard_engines[rootfolder_id] = engines
+            return self._shard_engines[rootfolder_id]
+
+    def db_file(self) -> str:
+        return self.db_url.replace("sqlite:///", "")
+
+    def shard_file(self, rootfolder_id: int) -> str:
+        base, extension = os.path.splitext(self.db_file())
+        return f"{base}_rootfolder_{rootfolder_id}{extension}"
+
+    def dispose_shard_engines(self) -> None:
+        with Database._shard_lock:
+            for engine, read_engine in self._shard_engines.values():
+                engine.dispose()
+                read_engine.dispose()
+            self._shard_engines = {}
     
     def is_empty(self) -> bool:
         """
@@ -48,8 +215,11 @@ class Database:
         # The foillowing import is placed here to avoid circular imports. 
         # List of all table models that should be checked (including metadata tables). 
         # even if the below doess not containt all DTO mapped to a table the check is solid enough
+        # The folders of the sharded storage mode are not in the main database, but there are no folders without a rootfolder
         from datamodel.dtos import RootFolderDTO, FolderNodeDTO, FolderTypeDTO, SimulationDomainDTO,CleanupFrequencyDTO, LeadTimeDTO, CleanupConfigurationDTO, RetentionTypeDTO
         table_models = [RootFolderDTO, FolderNodeDTO, FolderTypeDTO, RetentionTypeDTO, SimulationDomainDTO, CleanupFrequencyDTO, LeadTimeDTO, CleanupConfigurationDTO, RetentionTypeDTO]
+        if self.is_sharded:
+            table_models.remove(FolderNodeDTO)
         
         try:
             with Session(self._engine) as session:
@@ -74,23 +244,132 @@ class Database:
             
         try:
             # Drop all tables defined in SQLModel metadata
-            SQLModel.metadata.drop_all(self._engine)
+            drop_tables(self._engine)
+            self.delete_shard_files()
+            Database.clear_metadata_cache()
             print("All tables and schemas have been cleared from the database")
         except Exception as e:
             print(f"Error clearing tables and schemas: {e}")
             raise
     def delete_db (self):
-        #delte the db-file
-        import os
-        if self.sqlite_url.startswith("sqlite:///"):
-            db_file = self.sqlite_url.replace("sqlite:///", "")
-            if os.path.exists(db_file):
-                os.remove(db_file)
+        #delte the db-file and the wal files. The pooled connections are closed first, because a connection that is closed after 
+        # the files were deleted would remove the wal file of a new database with the same name
+        for engine in (self._engine, self._read_engine):
+            if engine is not None:
+                engine.dispose()
+        if self.db_url.startswith("sqlite:///"):
+            self.delete_shard_files()
+            db_file = self.db_file()
+            for file in (db_file, f"{db_file}-wal", f"{db_file}-shm"):
+                if os.path.exists(file):
+                    os.remove(file)
                 #print(f"Database file {db_file} deleted.")
             #else:
             #    print(f"Database file {db_file} does not exist.")
+        elif self._engine is not None and self._engine.dialect.name == "postgresql":
+            # the database belongs to the server so only the tables are dropped
+            drop_tables(self._engine)
         else:
-            print("Database deletion is only supported for SQLite databases.")
+            print("Database deletion is only supported for SQLite and PostgreSQL databases.")
+        Database.clear_metadata_cache()
+
+    def delete_shard_files(self) -> None:
+        """delete the shards of all rootfolders, also those that this process has not opened"""
+        self.dispose_shard_engines()
+        if not self.db_url.startswith("sqlite:///"):
+            return
+        base, extension = os.path.splitext(self.db_file())
+        for shard_file in glob.glob(f"{glob.escape(base)}_rootfolder_*{glob.escape(extension)}"):
+            for file in (shard_file, f"{shard_file}-wal", f"{shard_file}-shm"):
+                if os.path.exists(file):
+                    os.remove(file)
+
+# The tables that the sharded storage mode keeps in the shard of each rootfolder: the folders and the state that is written with them
+def shard_tables() -> list[Table]:
+    from datamodel.dtos import FolderNodeDTO, PathProtectionDTO, FolderRetentionCountDTO, FolderVersionDTO
+    return [FolderNodeDTO.__table__, PathProtectionDTO.__table__, FolderRetentionCountDTO.__table__, FolderVersionDTO.__table__]
+
+def main_tables() -> list[Table]:
+    """the tables of the main database in the sharded storage mode"""
+    folder_tables: list[Table] = shard_tables()
+    return [table for table in SQLModel.metadata.tables.values() if table not in folder_tables]
+
+# The folders use 0 for "no retention", "no path protection" and "no parent" and SQLite does not enforce foreign keys. The tables
+# are created without the foreign key constraints so that PostgreSQL accepts the same rows. The constraints stay in the model for the joins
+def create_tables(engine: Engine, tables: list[Table] | None = None) -> None:
+    """create the tables of the model, or the given tables, that do not exist"""
+    for table in SQLModel.metadata.tables.values():
+        for constraint in table.foreign_key_constraints:
+            constraint.ddl_if(dialect="sqlite")
+    SQLModel.metadata.create_all(engine, tables=tables)
+
+def drop_tables(engine: Engine) -> None:
+    """drop the tables of the model. The foreign keys of the model have cycles, so PostgreSQL drops the tables with their dependents"""
+    if engine.dialect.name != "postgresql":
+        SQLModel.metadata.drop_all(engine)
+        return
+    from sqlalchemy import text
+    with engine.begin() as connection:
+        for table in SQLModel.metadata.tables.values():
+            connection.execute(text(f'DROP TABLE IF EXISTS "{table.name}" CASCADE'))
+
+def find_duplicate_keys(connection, index) -> list[tuple]:
+    """the values of the index's columns that more than one row has. Rows with a NULL key never collide"""
+    from sqlalchemy import func, select as core_select
+    columns = list(index.columns)
+    statement = (core_select(*columns, func.count()).where(*[column.isnot(None) for column in columns])
+                 .group_by(*columns).having(func.count() > 1).order_by(*columns))
+    return [tuple(row) for row in connection.execute(statement).all()]
+
+def create_sqlite_engines(url: str) -> tuple[Engine, Engine]:
+    profile: AppConfig.SQLiteProfile = AppConfig.get_sqlite_profile()
+    engine = create_engine(url, echo=False)
+    read_engine = create_engine(url, echo=False, pool_size=profile.reader_pool_size, max_overflow=profile.reader_pool_size)
+    apply_sqlite_profile(engine, profile, read_only=False)
+    apply_sqlite_profile(read_engine, profile, read_only=True)
+    return engine, read_engine
+
+def create_sqlite_shard_engines(db_file: str, shard_file: str) -> tuple[Engine, Engine]:
+    # the uri filename lets the connections ATTACH the main database with mode=ro
+    engine, read_engine = create_sqlite_engines(f"sqlite:///file:{quote(os.path.abspath(shard_file))}?uri=true")
+    main_uri: str = f"file:{quote(os.path.abspath(db_file))}?mode=ro"
+    for shard_engine in (engine, read_engine):
+        @event.listens_for(shard_engine, "connect")
+        def _attach_main_database(dbapi_connection, connection_record) -> None:
+            cursor = dbapi_connection.cursor()
+            cursor.execute("ATTACH DATABASE ? AS vsm", (main_uri,))
+            cursor.close()
+    return engine, read_engine
+
+def create_postgresql_engines(url: str) -> tuple[Engine, Engine]:
+    # pool_pre_ping replaces connections that the server closed while they were idle in the pool
+    pool_size: int = AppConfig.POSTGRESQL_POOL_SIZE
+    engine = create_engine(url, echo=False, pool_pre_ping=True, pool_size=pool_size, max_overflow=pool_size)
+    read_engine = create_engine(url, echo=False, pool_pre_ping=True, pool_size=pool_size, max_overflow=pool_size,
+                                connect_args={"options": "-c default_transaction_read_only=on"})
+    return engine, read_engine
+
+# the engines (writer, reader) of a database url by the dialect of the url
+engine_factories: dict[str, Callable[[str], tuple[Engine, Engine]]] = {
+    "sqlite":     create_sqlite_engines,
+    "postgresql": create_postgresql_engines,
+}
+
+def apply_sqlite_profile(engine: Engine, profile: AppConfig.SQLiteProfile, read_only: bool) -> None:
+    """set the pragmas of the profile on every new connection of the engine. Connections of a read_only engine cannot write"""
+    @event.listens_for(engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record) -> None:
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA busy_timeout={profile.busy_timeout_ms}")
+        if not read_only:
+            # the journal mode is stored in the database file so the readers get it from the writer
+            cursor.execute(f"PRAGMA journal_mode={profile.journal_mode}")
+        cursor.execute(f"PRAGMA synchronous={profile.synchronous}")
+        cursor.execute(f"PRAGMA cache_size=-{profile.cache_size_kib}")
+        cursor.execute(f"PRAGMA mmap_size={profile.mmap_size}")
+        if read_only:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
 
 if __name__ == "__main__":
     db:Database = Database.get_db()
@@ -1,10 +1,24 @@
+import io
+import csv
+import json
 import os
-from datetime import datetime
-from typing import Literal, Optional
-from sqlalchemy import func
-from sqlmodel import Session, func, select
+import posixpath
+from itertools import chain, islice
+from collections import Counter
+import zstandard as zstd
+import orjson
+import numpy as np
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Iterable, Literal, Optional
+from sqlalchemy import func, insert, update, delete, bindparam, case, null, literal, text, event, Table, MetaData, Column, Integer, String, DateTime
+from sqlmodel import SQLModel, Session, func, select
 from fastapi import Query, HTTPException
+from fastapi.responses import Response, StreamingResponse
 from db.database import Database
+from db.metadata_cache import MetadataCache
+from db.write_queue import WriteQueue, queued_write
+from db.unit_of_work import db_session
 from datamodel import dtos
 
 
@@ -14,7 +28,7 @@ simulation_domain_name: Literal["vts"]
 simulation_domain_names = ["vts"]  # Define the allowed domain names
 
 def read_simulation_domains() -> list[dtos.SimulationDomainDTO]:
-    with Session(Database.get_engine()) as session:
+    with db_session(read_only=True) as session:
         simulation_domains = session.exec(select(dtos.SimulationDomainDTO)).all()
         if not simulation_domains:
             raise HTTPException(status_code=404, detail="SimulationDomain not found")
@@ -25,24 +39,28 @@ def read_simulation_domains_dict():
 
 
 def read_simulation_domain_by_name(domain_name: str):
-    with Session(Database.get_engine()) as session:
+    with db_session(read_only=True) as session:
         simulation_domain = session.exec(select(dtos.SimulationDomainDTO).where(dtos.SimulationDomainDTO.name == domain_name)).first()
         if not simulation_domain:
             raise HTTPException(status_code=404, detail=f"SimulationDomain for {domain_name}not found")
         return simulation_domain
 
+# the retention types, folder types, path protections and cleanup configurations are cached by MetadataCache. 
+# The cached lists are shared so the read functions return copies of the lists and the dtos must not be modified
 def read_retentiontypes_by_domain_id(simulationdomain_id: int):
-    with Session(Database.get_engine()) as session:
-        retention_types = session.exec(select(dtos.RetentionTypeDTO).where(dtos.RetentionTypeDTO.simulationdomain_id == simulationdomain_id)).all()
-        if not retention_types or len(retention_types) == 0:
-            raise HTTPException(status_code=404, detail="retentiontypes not found")
-        return retention_types
+    def load() -> list[dtos.RetentionTypeDTO]:
+        with db_session(read_only=True) as session:
+            retention_types = session.exec(select(dtos.RetentionTypeDTO).where(dtos.RetentionTypeDTO.simulationdomain_id == simulationdomain_id)).all()
+            if not retention_types or len(retention_types) == 0:
+                raise HTTPException(status_code=404, detail="retentiontypes not found")
+            return retention_types
+    return list(MetadataCache.get(MetadataCache.DOMAIN_RETENTION_TYPES, simulationdomain_id, load))
 
 def read_retentiontypes_dict_by_domain_id(simulationdomain_id: int) -> dict[str, dtos.RetentionTypeDTO]:
     return {retention.name.lower(): retention for retention in read_retentiontypes_by_domain_id(simulationdomain_id)}
 
 def read_frequency_by_domain_id(simulationdomain_id: int):
-    with Session(Database.get_engine()) as session:
+    with db_session(read_only=True) as session:
         frequency = session.exec(select(dtos.CleanupFrequencyDTO).where(dtos.CleanupFrequencyDTO.simulationdomain_id == simulationdomain_id)).all()
         if not frequency or len(frequency) == 0:
             raise HTTPException(status_code=404, detail="Frequency not found")
@@ -53,17 +71,19 @@ def read_frequency_name_dict_by_domain_id(simulationdomain_id: int):
 
 
 def read_folder_types_pr_domain_id(simulationdomain_id: int):    
-    with Session(Database.get_engine()) as session:
-        folder_types = session.exec(select(dtos.FolderTypeDTO).where(dtos.FolderTypeDTO.simulationdomain_id == simulationdomain_id)).all()
-        if not folder_types or len(folder_types) == 0:
-            raise HTTPException(status_code=404, detail="foldertypes not found")
-        return folder_types
+    def load() -> list[dtos.FolderTypeDTO]:
+        with db_session(read_only=True) as session:
+            folder_types = session.exec(select(dtos.FolderTypeDTO).where(dtos.FolderTypeDTO.simulationdomain_id == simulationdomain_id)).all()
+            if not folder_types or len(folder_types) == 0:
+                raise HTTPException(status_code=404, detail="foldertypes not found")
+            return folder_types
+    return list(MetadataCache.get(MetadataCache.DOMAIN_FOLDER_TYPES, simulationdomain_id, load))
 
 def read_folder_type_dict_pr_domain_id(simulationdomain_id: int) -> dict[str, dtos.FolderTypeDTO]:
     return {folder_type.name.lower(): folder_type for folder_type in read_folder_types_pr_domain_id(simulationdomain_id)}
 
 def read_cycle_time_by_domain_id(simulationdomain_id: int):
-    with Session(Database.get_engine()) as session:
+    with db_session(read_only=True) as session:
         cycle_time = session.exec(select(dtos.LeadTimeDTO).where(dtos.LeadTimeDTO.simulationdomain_id == simulationdomain_id)).all()
         if not cycle_time or len(cycle_time) == 0:
             raise HTTPException(status_code=404, detail="LeadTime not found")
@@ -85,7 +105,7 @@ def read_rootfolders_by_domain_and_initials(simulationdomain_id: int, initials:
     if simulationdomain_id is None or simulationdomain_id == 0:
         raise HTTPException(status_code=404, detail="root_folders not found. you must provide simulation domain and initials")
 
-    with Session(Database.get_engine()) as session:
+    with db_session(read_only=True) as session:
         if type(initials) == str and initials is not None:
             rootfolders = session.exec(
                 select(dtos.RootFolderDTO).where( (dtos.RootFolderDTO.simulationdomain_id == simulationdomain_id) &
@@ -103,7 +123,7 @@ def exist_rootfolder(rootfolder:dtos.RootFolderDTO):
     if (rootfolder is None) or (rootfolder.simulationdomain_id is None) or (rootfolder.simulationdomain_id == 0):
         raise HTTPException(status_code=404, detail="You must provide a valid simulationdomain_id to create a rootfolder")
 
-    with Session(Database.get_engine()) as session:
+    with db_session(read_only=True) as session:
         #verify if the rootfolder already exists        
         existing_rootfolder:dtos.RootFolderDTO = session.exec(select(dtos.RootFolderDTO).where(
                 (dtos.RootFolderDTO.simulationdomain_id == rootfolder.simulationdomain_id) & 
@@ -111,11 +131,12 @@ def exist_rootfolder(rootfolder:dtos.RootFolderDTO):
             )).first()
         return existing_rootfolder is not None
 
+@queued_write(WriteQueue.INTERACTIVE)
 def insert_rootfolder(rootfolder:dtos.RootFolderDTO):
     if (rootfolder is None) or (rootfolder.simulationdomain_id is None) or (rootfolder.simulationdomain_id == 0):
         raise HTTPException(status_code=404, detail="You must provide a valid simulationdomain_id to create a rootfolder")
 
-    with Session(Database.get_engine()) as session:
+    with db_session() as session:
         #verify if the rootfolder already exists
         existing_rootfolder:dtos.RootFolderDTO = session.exec(select(dtos.RootFolderDTO).where(
                 (dtos.RootFolderDTO.simulationdomain_id == rootfolder.simulationdomain_id) & 
@@ -133,8 +154,8 @@ def insert_rootfolder(rootfolder:dtos.RootFolderDTO):
         return rootfolder
     
 def read_rootfolder_by_id(rootfolder_id: int):
-    with Session(Database.get_engine()) as session:
-        rootfolder = session.exec(select(dtos.RootFolderDTO).where(dtos.RootFolderDTO.id == rootfolder_id)).first()
+    with db_session(read_only=True) as session:
+        rootfolder = session.get(dtos.RootFolderDTO, rootfolder_id)
         if not rootfolder:
             raise HTTPException(status_code=404, detail="rootfolder not found")
         return rootfolder
@@ -143,20 +164,24 @@ def read_rootfolder_retentiontypes(rootfolder_id: int):
     retention_types:list[dtos.RetentionTypeDTO] = list(read_rootfolder_retentiontypes_dict(rootfolder_id).values())
     return retention_types
 
-def read_rootfolder_retentiontypes_dict(rootfolder_id: int)-> dict[str, dtos.RetentionTypeDTO]:
-    with Session(Database.get_engine()) as session:
-        rootfolder = session.exec(select(dtos.RootFolderDTO).where(dtos.RootFolderDTO.id == rootfolder_id)).first()
-        if not rootfolder:
-            raise HTTPException(status_code=404, detail="rootfolder not found")
+def read_rootfolder_simulationdomain_id(rootfolder_id: int) -> int:
+    def load() -> int:
+        with db_session(read_only=True) as session:
+            simulationdomain_id:int|None = session.exec(select(dtos.RootFolderDTO.simulationdomain_id).where(dtos.RootFolderDTO.id == rootfolder_id)).first()
+            if simulationdomain_id is None:
+                raise HTTPException(status_code=404, detail="rootfolder not found")
+            return simulationdomain_id
+    return MetadataCache.get(MetadataCache.ROOTFOLDER_DOMAIN, rootfolder_id, load)
 
-        retention_types:dict[str,dtos.RetentionTypeDTO] = read_retentiontypes_dict_by_domain_id(rootfolder.simulationdomain_id)
-        if not retention_types:
-            raise HTTPException(status_code=404, detail="retentiontypes not found")
-        
-        if not retention_types.get("path", None):
-            raise HTTPException(status_code=500, detail=f"Unable to retrieve node_type_id=vts_simulation for {rootfolder.id}")
-        
-        return retention_types
+def read_rootfolder_retentiontypes_dict(rootfolder_id: int)-> dict[str, dtos.RetentionTypeDTO]:
+    retention_types:dict[str,dtos.RetentionTypeDTO] = read_retentiontypes_dict_by_domain_id(read_rootfolder_simulationdomain_id(rootfolder_id))
+    if not retention_types:
+        raise HTTPException(status_code=404, detail="retentiontypes not found")
+    
+    if not retention_types.get("path", None):
+        raise HTTPException(status_code=500, detail=f"Unable to retrieve node_type_id=vts_simulation for {rootfolder_id}")
+    
+    return retention_types
 
 def read_rootfolder_numeric_retentiontypes_dict(rootfolder_id: int) -> dict[str, dtos.RetentionTypeDTO]:
     retention_types_dict:dict[str, dtos.RetentionTypeDTO] = read_rootfolder_retentiontypes_dict(rootfolder_id)
@@ -164,7 +189,7 @@ def read_rootfolder_numeric_retentiontypes_dict(rootfolder_id: int) -> dict[str,
     return {key:retention for key,retention in retention_types_dict.items() if retention.days_to_cleanup is not None}
 
 def read_folders( rootfolder_id: int ):
-    with Session(Database.get_engine()) as session:
+    with db_session(read_only=True, rootfolder_id=rootfolder_id) as session:
         folders = session.exec(select(dtos.FolderNodeDTO).where(dtos.FolderNodeDTO.rootfolder_id == rootfolder_id)).all()
         return folders
 
@@ -182,25 +207,48 @@ def to_utc(dt, default_timezone="UTC"):
         dt = dt.replace(tzinfo=tz)
     return dt.astimezone(timezone.utc)
 
+# Add whole days to a DateTime column in SQL. 
+# SQLite stores datetimes as text "YYYY-MM-DD HH:MM:SS.ffffff" so only the date part is shifted and the time of day is kept as it is. 
+# This keeps the microseconds and the text format that SQLAlchemy uses so the result compares correctly with other datetimes
+def add_days_sql(datetime_column, days: int):
+    if Database.get_engine().dialect.name == "sqlite":
+        return func.date(func.substr(datetime_column, 1, 10), f"{days:+d} days").op("||")(func.substr(datetime_column, 11))
+    return datetime_column + timedelta(days=days)
+
+# the cleanup configuration of the rootfolder. A rootfolder without one gets a default configuration, which is created by the WriteQueue
 def get_cleanup_configuration_by_rootfolder_id(rootfolder_id: int)-> dtos.CleanupConfigurationDTO:
-    with Session(Database.get_engine()) as session:
-        rootfolder:dtos.RootFolderDTO = session.exec(select(dtos.RootFolderDTO).where(dtos.RootFolderDTO.id == rootfolder_id)).first()
+    with db_session(read_only=True) as session:
+        rootfolder:dtos.RootFolderDTO = session.get(dtos.RootFolderDTO, rootfolder_id)
         if not rootfolder:
             raise HTTPException(status_code=404, detail="rootfolder not found")
+        cleanup_configuration = session.get(dtos.CleanupConfigurationDTO, rootfolder.cleanup_config_id) if rootfolder.cleanup_config_id is not None else None
 
-        cleanup_configuration = rootfolder.get_cleanup_configuration(session)
-        if not cleanup_configuration:
-            raise HTTPException(status_code=404, detail="cleanup_configuration not found")
-        cleanup_configuration.start_date = cleanup_configuration.start_date
+    if cleanup_configuration is None:
+        cleanup_configuration = insert_default_cleanup_configuration(rootfolder_id)
     return cleanup_configuration
 
+@queued_write(WriteQueue.INTERACTIVE, main_database=True)
+def insert_default_cleanup_configuration(rootfolder_id: int) -> dtos.CleanupConfigurationDTO:
+    with db_session() as session:
+        rootfolder:dtos.RootFolderDTO = session.get(dtos.RootFolderDTO, rootfolder_id)
+        if not rootfolder:
+            raise HTTPException(status_code=404, detail="rootfolder not found")
+        return rootfolder.get_cleanup_configuration(session)
+
+# the committed cleanup configuration of the rootfolder for calculations that only read it. 
+# The dto is shared through MetadataCache so use get_cleanup_configuration_by_rootfolder_id to change the configuration.
+# It does not have the changes of the caller's transaction or of other processes, see MetadataCache
+def read_cleanup_configuration_snapshot(rootfolder_id: int) -> dtos.CleanupConfigurationDTO:
+    return MetadataCache.get(MetadataCache.ROOTFOLDER_CLEANUP_CONFIG, rootfolder_id, lambda: get_cleanup_configuration_by_rootfolder_id(rootfolder_id))
+
 #insert the cleanup configuration for a rootfolder and update the rootfolder to point to the cleanup configuration
+@queued_write(WriteQueue.INTERACTIVE, main_database=True)
 def insert_or_update_cleanup_configuration(rootfolder_id:int, cleanup_config: dtos.CleanupConfigurationDTO):
     if (rootfolder_id is None) or (rootfolder_id == 0):
         raise HTTPException(status_code=404, detail="You must provide a valid rootfolder_id to create a cleanup configuration")
-    with Session(Database.get_engine()) as session:
+    with db_session() as session:
         #verify if the rootfolder already exists
-        rootfolder:dtos.RootFolderDTO = session.exec(select(dtos.RootFolderDTO).where((dtos.RootFolderDTO.id == rootfolder_id))).first()
+        rootfolder:dtos.RootFolderDTO = session.get(dtos.RootFolderDTO, rootfolder_id)
         if not rootfolder:
             raise HTTPException(status_code=404, detail=f"Failed to find rootfolder with id {rootfolder_id} to create a cleanup configuration")
 
@@ -224,7 +272,8 @@ def insert_or_update_cleanup_configuration(rootfolder_id:int, cleanup_config: dt
 
         cleanup_config.id       = existing_cleanup_cfg.id if existing_cleanup_cfg else None
         cleanup_config.progress = existing_cleanup_cfg.progress        
-        return cleanup_config
+    MetadataCache.invalidate_rootfolder(rootfolder_id)
+    return cleanup_config
     
 # def update_cleanup_configuration_by_rootfolder_id(rootfolder_id: int, cleanup_configuration: dtos.CleanupConfigurationDTO):
 #     #is_valid = cleanup_configuration.is_valid()
@@ -249,120 +298,327 @@ def insert_or_update_cleanup_configuration(rootfolder_id:int, cleanup_config: dt
 #         return {"message": f"for rootfolder {rootfolder_id}: update of cleanup configuration {cleanup_config.id} "}
 
 
-# # --------------- start not in use now - will be used for optimization -------------------
-
-# import io
-# import csv
-# import csv
-# from zstandard import ZstdCompressor
-
-# # read folders into csv for efficient transmission
-# def read_folders_csv(rootfolder_id:int):
-#     def generate_csv():
-#         engine = Database.get_engine()
-#         conn = engine.raw_connection()
-#         if conn is None:
-#             return io.StringIO()
-#         else :
-#             cursor = conn.cursor()
-            
-#             # Get column names
-#             cursor.execute("PRAGMA table_info(foldernodedto)")
-#             columns = [row[1] for row in cursor.fetchall()]
-            
-#             # Create CSV header
-#             output = io.StringIO()
-#             writer = csv.writer(output)
-#             writer.writerow(columns)
-#             yield output.getvalue()
-            
-#             # Stream data in chunks
-#             chunk_size = 10000
-#             offset = 0
-            
-#             while True:
-#                 cursor.execute(f"SELECT * FROM foldernodedto LIMIT {chunk_size} OFFSET {offset}")
-#                 rows = cursor.fetchall()
-                
-#                 if not rows:
-#                     conn.close()
-#                     conn=None
-#                     break
-                
-#                 # Write chunk to CSV
-#                 output = io.StringIO()
-#                 writer = csv.writer(output)
-#                 writer.writerows(rows)
-#                 yield output.getvalue()
-                
-#                 offset += chunk_size
-        
-#     return StreamingResponse(
-#         generate_csv(), 
-#         media_type="text/csv", 
-#         headers={"Content-Disposition": "attachment; filename=folders.csv"}
-#     )
-# def read_folders_csv_zstd(rootfolder_id: int):
-#     def generate_compressed_csv():
-#         compressor = ZstdCompressor(level=3)
-#         engine = Database.get_engine()
-        
-#         conn = engine.raw_connection()
-#         if conn is None:
-#             return io.StringIO()
-#         else :
-#             cursor = conn.cursor()
-            
-#             # Get column names and create header
-#             cursor.execute("PRAGMA table_info(foldernodedto)")
-#             columns = [row[1] for row in cursor.fetchall()]
-            
-#             output = io.StringIO()
-#             writer = csv.writer(output)
-#             writer.writerow(columns)
-#             yield compressor.compress(output.getvalue().encode('utf-8'))
-            
-#             # Stream data in chunks
-#             chunk_size = 10000
-#             offset = 0
-            
-#             while True:
-#                 cursor.execute(f"SELECT * FROM foldernodedto LIMIT {chunk_size} OFFSET {offset}")
-#                 rows = cursor.fetchall()
-                
-#                 if not rows:
-#                     conn.close()
-#                     conn=None
-#                     break
-                
-#                 # Write chunk to CSV and compress
-#                 output = io.StringIO()
-#                 writer = csv.writer(output)
-#                 writer.writerows(rows)
-#                 yield compressor.compress(output.getvalue().encode('utf-8'))
-                
-#                 offset += chunk_size
-        
-#     return StreamingResponse(
-#         generate_compressed_csv(), 
-#         media_type="application/zstd",
-#         headers={
-#             "Content-Disposition": "attachment; filename=folders.csv.zst",
-#             "Content-Encoding": "zstd"
-#         }
-#     )
-# # --------------- end start not in use now - will be used for optimization -------------------
+#-----------------start fast json list responses -------------------
+# Large list responses bypass FastAPI's response_model validation and serialization: the columns of the model are selected as 
+# tuples with SQLAlchemy Core and encoded with orjson. The keys are the camelCase aliases of the model and the fields that the model 
+# excludes are left out, so the json is the same as for the response_model. The cached metadata lists are encoded from the cache
+def json_fields(model: type[SQLModel]) -> list[tuple[str, str]]:
+    """(field name, camelCase alias) of the fields that the model serializes in the order of the model"""
+    return [(name, field.alias or name) for name, field in model.model_fields.items() if not field.exclude]
+
+def json_rows(model: type[SQLModel], rows: Iterable[tuple]) -> list[dict]:
+    """the json objects of rows with the values of json_fields(model) in that order"""
+    aliases: list[str] = [alias for _, alias in json_fields(model)]
+    return [dict(zip(aliases, row)) for row in rows]
+
+def json_rows_response(model: type[SQLModel], rows: Iterable[tuple]) -> Response:
+    return Response(content=orjson.dumps(json_rows(model, rows)), media_type="application/json")
+
+def json_models_response(model: type[SQLModel], instances: Iterable[SQLModel]) -> Response:
+    names: list[str] = [name for name, _ in json_fields(model)]
+    return json_rows_response(model, ([getattr(instance, name) for name in names] for instance in instances))
+
+def json_model_response(model: type[SQLModel], instance: SQLModel) -> Response:
+    return Response(content=orjson.dumps({alias: getattr(instance, name) for name, alias in json_fields(model)}), media_type="application/json")
+
+def select_json_columns(model: type[SQLModel], coalesce_zero: tuple[str, ...] = ()):
+    """select of the json_fields(model) columns. The columns in coalesce_zero are returned as 0 instead of null"""
+    table = model.__table__
+    return select(*[func.coalesce(table.c[name], 0) if name in coalesce_zero else table.c[name] for name, _ in json_fields(model)])
+
+def read_folders_json(rootfolder_id: int) -> Response:
+    # the folders of the rootfolder as GET /v1/rootfolders/{rootfolder_id}/folders/ returns them: no retention is 0 
+    folder_table = dtos.FolderNodeDTO.__table__
+    with db_session(read_only=True, rootfolder_id=rootfolder_id) as session:
+        rows = session.execute(select_json_columns(dtos.FolderNodeDTO, coalesce_zero=("retention_id", "path_protection_id"))
+                               .where(folder_table.c.rootfolder_id == rootfolder_id)).all()
+    return json_rows_response(dtos.FolderNodeDTO, rows)
+#-----------------end fast json list responses -------------------
+
+#-----------------start streaming of the folders of a rootfolder -------------------
+# The folders are streamed as compact csv rows, zstd compressed when the client accepts it. 
+# The rows are read with keyset pagination on (rootfolder_id, id): each page is read in its own short transaction starting after 
+# the last id of the previous page. Every page is a range scan on ix_foldernodedto_rootfolder_id_id, no read transaction is held 
+# while the client consumes the stream and the memory use is one page regardless of the size of the rootfolder
+FOLDER_STREAM_PAGE_SIZE: int = 10000
+FOLDER_STREAM_COLUMNS: list[str] = ["id", "parent_id", "name", "path", "path_ids", "nodetype_id", "retention_id", "path_protection_id", "modified_date", "expiration_date"]
+
+def read_folder_pages(rootfolder_id: int, page_size: int = None, columns: list | None = None):
+    """yields the rows of the columns, FOLDER_STREAM_COLUMNS by default, for the folders of the rootfolder in pages ordered by id.
+    The columns must include id"""
+    page_size = page_size or FOLDER_STREAM_PAGE_SIZE
+    folder_table = dtos.FolderNodeDTO.__table__
+    columns = columns if columns is not None else [folder_table.c[column] for column in FOLDER_STREAM_COLUMNS]
+    statement = select(*columns).where(
+        (folder_table.c.rootfolder_id == rootfolder_id) & (folder_table.c.id > bindparam("last_id"))
+    ).order_by(folder_table.c.id).limit(page_size)
+
+    last_id: int = 0
+    while True:
+        with Database.get_read_engine(rootfolder_id).connect() as connection:
+            rows = connection.execute(statement, {"last_id": last_id}).all()
+        if not rows:
+            return
+        yield rows
+        if len(rows) < page_size:
+            return
+        last_id = rows[-1].id
+
+def generate_folders_csv(rootfolder_id: int, compress: bool):
+    # header with the same camelCase names as the json of FolderNodeDTO. Datetimes are iso formatted and None is an empty field
+    from pydantic.alias_generators import to_camel
+    compressor = zstd.ZstdCompressor(level=3).compressobj() if compress else None
+    def encode(text: str, is_last: bool = False) -> bytes:
+        if compressor is None:
+            return text.encode("utf-8")
+        # flush a zstd block per page so that the client can decompress the stream as it arrives
+        return compressor.compress(text.encode("utf-8")) + compressor.flush(zstd.COMPRESSOBJ_FLUSH_FINISH if is_last else zstd.COMPRESSOBJ_FLUSH_BLOCK)
+
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator="\n")
+    writer.writerow([to_camel(column) for column in FOLDER_STREAM_COLUMNS])
+    for rows in read_folder_pages(rootfolder_id):
+        writer.writerows([[value.isoformat() if isinstance(value, datetime) else value for value in row] for row in rows])
+        yield encode(output.getvalue())
+        output.seek(0)
+        output.truncate()
+    yield encode(output.getvalue(), is_last=True)
+
+def read_folders_csv(rootfolder_id: int, accept_encoding: str = "") -> StreamingResponse:
+    # the rootfolder is checked before the streaming starts because the status code cannot be changed after the first chunk
+    read_rootfolder_simulationdomain_id(rootfolder_id)
+
+    compress: bool = "zstd" in accept_encoding.lower()
+    headers = {"Content-Disposition": f"attachment; filename=folders_{rootfolder_id}.csv", "Vary": "Accept-Encoding"}
+    if compress:
+        headers["Content-Encoding"] = "zstd"
+    return StreamingResponse(generate_folders_csv(rootfolder_id, compress), media_type="text/csv", headers=headers)
+#-----------------end streaming of the folders of a rootfolder -------------------
+
+#-----------------start bootstrap of a rootfolder in the webclient -------------------
+# The metadata and folders that the webclient reads when it opens a rootfolder as one RootFolderBootstrapDTO json response, 
+# instead of one request per list. The metadata is read in one read transaction so its lists are consistent with each other, and
+# it is sent first so the client can start rendering before the folders arrive. 
+# The folders follow as they are read: a page at a time with the keyset pagination of read_folder_pages, so the memory use is one 
+# page and no transaction is held while the client consumes the stream. CompressionMiddleware compresses the stream as it is sent.
+# A folder page can be newer than the changeVersion of the metadata. The client's next delta sync from changeVersion returns those
+# folders again, so it converges to the state of the database
+def begin_read_transaction(connection) -> None:
+    """begin a transaction in which all reads of the connection see the same snapshot of the database"""
+    if connection.dialect.name == "sqlite":
+        # pysqlite only begins a transaction before a write, so without it every select sees the latest commit
+        connection.exec_driver_sql("BEGIN")
+    else:
+        connection.execution_options(isolation_level="REPEATABLE READ")
+
+def read_bootstrap_metadata(connection, rootfolder_id: int) -> dict:
+    """the RootFolderBootstrapDTO json without the folders"""
+    rootfolder_table = dtos.RootFolderDTO.__table__
+    version_table    = dtos.FolderVersionDTO.__table__
+    row = connection.execute(select_json_columns(dtos.RootFolderDTO).add_columns(func.coalesce(version_table.c.change_version, 0))
+                             .select_from(rootfolder_table.outerjoin(version_table, version_table.c.rootfolder_id == rootfolder_table.c.id))
+                             .where(rootfolder_table.c.id == rootfolder_id)).first()
+    if row is None:
+        raise HTTPException(status_code=404, detail="rootfolder not found")
+    rootfolder: dict = json_rows(dtos.RootFolderDTO, [row[:-1]])[0]
+
+    def read(model: type[SQLModel], column: str, value: int) -> list[dict]:
+        return json_rows(model, connection.execute(select_json_columns(model).where(model.__table__.c[column] == value)).all())
+    domain_id: int = rootfolder["simulationdomainId"]
+    cleanup_configurations: list[dict] = read(dtos.CleanupConfigurationDTO, "id", rootfolder["cleanupConfigId"])
+    return {"rootfolder":            rootfolder,
+            "changeVersion":         row[-1],
+            "simulationDomain":      read(dtos.SimulationDomainDTO, "id", domain_id)[0],
+            "cleanupConfiguration":  cleanup_configurations[0] if cleanup_configurations else None,
+            "retentionTypes":        read(dtos.RetentionTypeDTO, "simulationdomain_id", domain_id),
+            "folderTypes":           read(dtos.FolderTypeDTO, "simulationdomain_id", domain_id),
+            "leadTimes":             read(dtos.LeadTimeDTO, "simulationdomain_id", domain_id),
+            "cleanupFrequencies":    read(dtos.CleanupFrequencyDTO, "simulationdomain_id", domain_id),
+            "pathProtections":       read(dtos.PathProtectionDTO, "rootfolder_id", rootfolder_id)}
+
+def read_rootfolder_bootstrap(rootfolder_id: int) -> StreamingResponse:
+    # the metadata is read before the streaming starts so an unknown rootfolder is a 404.
+    # A shard's connection reads the shared tables too, so the metadata is read from the rootfolder's database
+    with Database.get_read_engine(rootfolder_id).connect() as connection:
+        begin_read_transaction(connection)
+        metadata: dict = read_bootstrap_metadata(connection, rootfolder_id)
+    return StreamingResponse(generate_bootstrap(rootfolder_id, metadata), media_type="application/json")
+
+def generate_bootstrap(rootfolder_id: int, metadata: dict):
+    # the metadata object is left open for the folders list
+    yield orjson.dumps(metadata)[:-1] + b',"folders":['
+    columns = select_json_columns(dtos.FolderNodeDTO, coalesce_zero=("retention_id", "path_protection_id")).selected_columns
+    for i, rows in enumerate(read_folder_pages(rootfolder_id, columns=list(columns))):
+        page: bytes = orjson.dumps(json_rows(dtos.FolderNodeDTO, rows))[1:-1]
+        yield page if i == 0 else b"," + page
+    yield b"]}"
+#-----------------end bootstrap of a rootfolder in the webclient -------------------
+
+#-----------------start change versions of the folders of a rootfolder -------------------
+# Every write of FolderNodeDTO rows stamps the rows with a new change version of their rootfolder so that a client can fetch 
+# only the folders that changed since its last version. 
+# The version is allocated by incrementing FolderVersionDTO.change_version in the writing transaction. The writes to a rootfolder are 
+# serialized by the lock on the version row (the database lock in SQLite) so the versions are committed in increasing order. 
+# FolderVersionDTO is a folder table, so in the sharded storage mode the versions are written with the folders in the rootfolder's shard.
+#   ORM writes are stamped by the before_flush listener below. 
+#   Core and bulk writes must add change_version=next_change_version(...) to the values they write. 
+# Folders are never deleted so no tombstones are needed
+def next_change_version(connection, rootfolder_id: int) -> int:
+    version_table = dtos.FolderVersionDTO.__table__
+    change_version: int | None = connection.execute(
+        update(version_table).where(version_table.c.rootfolder_id == rootfolder_id)
+        .values(change_version=version_table.c.change_version + 1).returning(version_table.c.change_version)
+    ).scalar_one_or_none()
+    if change_version is None:
+        # the first write of the rootfolder's folders creates its versions
+        rootfolder_table = dtos.RootFolderDTO.__table__
+        if connection.execute(select(rootfolder_table.c.id).where(rootfolder_table.c.id == rootfolder_id)).first() is None:
+            raise HTTPException(status_code=404, detail=f"rootfolder {rootfolder_id} not found")
+        upsert = upsert_insert(version_table).values(rootfolder_id=rootfolder_id, change_version=1)
+        change_version = connection.execute(upsert.on_conflict_do_update(
+            index_elements=[version_table.c.rootfolder_id], set_={"change_version": version_table.c.change_version + 1}
+        ).returning(version_table.c.change_version)).scalar_one()
+    return change_version
+
+@event.listens_for(Session, "before_flush")
+def _stamp_folder_change_versions(session: Session, flush_context, instances) -> None:
+    change_versions: dict[int, int] = {}
+    for folder in chain(session.new, session.dirty):
+        if isinstance(folder, dtos.FolderNodeDTO) and (folder in session.new or session.is_modified(folder)):
+            if folder.rootfolder_id not in change_versions:
+                change_versions[folder.rootfolder_id] = next_change_version(session.connection(), folder.rootfolder_id)
+            folder.change_version = change_versions[folder.rootfolder_id]
+
+def read_folder_changes(rootfolder_id: int, since: int) -> dtos.FolderChangesDTO:
+    # The folders written after the client's version since. since=0 is a full snapshot of the rootfolder. 
+    # So is a since ahead of the rootfolder's version which means that the database was recreated after the client's last sync. 
+    # The version is read before the folders and the folders are limited to it, so a write that commits in between is returned by the next sync
+    read_rootfolder_simulationdomain_id(rootfolder_id)
+    with db_session(read_only=True, rootfolder_id=rootfolder_id) as session:
+        version: int = session.exec(select(dtos.FolderVersionDTO.change_version).where(dtos.FolderVersionDTO.rootfolder_id == rootfolder_id)).first() or 0
+
+        is_full_snapshot: bool = since <= 0 or since > version
+        change_filter = (dtos.FolderNodeDTO.rootfolder_id == rootfolder_id) & (dtos.FolderNodeDTO.change_version <= version)
+        if not is_full_snapshot:
+            change_filter = change_filter & (dtos.FolderNodeDTO.change_version > since)
+        folders = session.exec(select(dtos.FolderNodeDTO).where(change_filter).order_by(dtos.FolderNodeDTO.id)).all()
+        return dtos.FolderChangesDTO(version=version, is_full_snapshot=is_full_snapshot, folders=folders)
+#-----------------end change versions of the folders of a rootfolder -------------------
+
+#-----------------start retention counts of the folders of a rootfolder -------------------
+# FolderRetentionCountDTO holds the number of simulations per retention in the subtree of every inner folder. 
+# It is maintained incrementally from the change versions: a refresh reads the simulations written since the version that the counts 
+# were refreshed to and moves each simulation whose retention changed from its counted_retention_id to its retention_id in all its ancestors. 
+# The writers in db_api and the cleanup agents refresh at the end of their transaction. Other ORM writes are picked up by the next refresh 
+# and at the latest when the counts are read
+def upsert_insert(table):
+    """insert statement that supports on_conflict_do_update on SQLite and PostgreSQL"""
+    if Database.get_engine().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    return dialect_insert(table)
+
+def refresh_retention_counts(connection, rootfolder_id: int) -> int:
+    """refresh the retention counts of the rootfolder in the caller's transaction. Returns the number of simulations whose retention changed"""
+    version_table    = dtos.FolderVersionDTO.__table__
+    folder_table     = dtos.FolderNodeDTO.__table__
+    count_table      = dtos.FolderRetentionCountDTO.__table__
+    versions = connection.execute(select(version_table.c.change_version, version_table.c.retention_counts_version)
+                                  .where(version_table.c.rootfolder_id == rootfolder_id)).first()
+    if versions is None or versions.retention_counts_version >= versions.change_version:
+        return 0
+
+    # claim the versions so that two concurrent refreshes cannot count the same changes twice
+    claimed:int = connection.execute(update(version_table).where(
+        (version_table.c.rootfolder_id == rootfolder_id) & (version_table.c.retention_counts_version == versions.retention_counts_version)
+    ).values(retention_counts_version=versions.change_version)).rowcount
+    if claimed == 0:
+        return 0
+
+    # Step 1: the simulations written since the last refresh whose retention differs from the counted retention
+    simulation_type_id:int = read_folder_type_dict_pr_domain_id(read_rootfolder_simulationdomain_id(rootfolder_id))[dtos.FolderTypeEnum.SIMULATION].id
+    changed_filter = (folder_table.c.rootfolder_id == rootfolder_id) & \
+                     (folder_table.c.change_version > versions.retention_counts_version) & (folder_table.c.change_version <= versions.change_version) & \
+                     (folder_table.c.nodetype_id == simulation_type_id) & folder_table.c.retention_id.is_distinct_from(folder_table.c.counted_retention_id)
+    changed = connection.execute(select(folder_table.c.path_ids, folder_table.c.retention_id, folder_table.c.counted_retention_id).where(changed_filter)).all()
+    if not changed:
+        return 0
+
+    # Step 2: the change of the counts in every ancestor. path_ids ends with the simulation's own id. 0 means no retention
+    #         Simulations in the same folder share their ancestors so they are grouped by the path_ids of their parent first
+    moves: Counter[tuple[str, int | None, int | None]] = Counter(
+        (path_ids.rpartition("/")[0], retention_id, counted_retention_id) for path_ids, retention_id, counted_retention_id in changed)
+    deltas: dict[tuple[int, int], int] = {}
+    for (parent_path_ids, retention_id, counted_retention_id), count in moves.items():
+        for ancestor_id in parent_path_ids.split("/"):
+            if ancestor_id in ("", "0"):
+                continue
+            if counted_retention_id:
+                deltas[(int(ancestor_id), counted_retention_id)] = deltas.get((int(ancestor_id), counted_retention_id), 0) - count
+            if retention_id:
+                deltas[(int(ancestor_id), retention_id)] = deltas.get((int(ancestor_id), retention_id), 0) + count
+
+    # Step 3: add the deltas to the counts and record the retentions that are now counted
+    rows = [{"folder_id": folder_id, "retention_id": retention_id, "rootfolder_id": rootfolder_id, "simulation_count": delta}
+            for (folder_id, retention_id), delta in deltas.items() if delta != 0]
+    if rows:
+        upsert = upsert_insert(count_table)
+        connection.execute(upsert.on_conflict_do_update(
+            index_elements=[count_table.c.folder_id, count_table.c.retention_id],
+            set_={"simulation_count": count_table.c.simulation_count + upsert.excluded.simulation_count}
+        ), rows)
+    connection.execute(update(folder_table).where(changed_filter).values(counted_retention_id=folder_table.c.retention_id))
+    return len(changed)
+
+def retention_counts_are_current(rootfolder_id: int) -> bool:
+    version_table = dtos.FolderVersionDTO.__table__
+    with db_session(read_only=True, rootfolder_id=rootfolder_id) as session:
+        versions = session.execute(select(version_table.c.change_version, version_table.c.retention_counts_version)
+                                   .where(version_table.c.rootfolder_id == rootfolder_id)).first()
+    return versions is None or versions.retention_counts_version >= versions.change_version
+
+def read_retention_counts(rootfolder_id: int, parent_id: int = 0) -> list[dtos.FolderRetentionCountsDTO]:
+    # the retention counts of the children of parent_id, that is the folders that become visible when the parent is expanded. 
+    # parent_id=0 is the top folder of the rootfolder. The cost is proportional to the number of children and their counts
+    read_rootfolder_simulationdomain_id(rootfolder_id)
+    folder_table = dtos.FolderNodeDTO.__table__
+    count_table  = dtos.FolderRetentionCountDTO.__table__
+    # the writers refresh the counts at the end of their transaction. If an ORM write left them behind they are refreshed by the WriteQueue
+    if not retention_counts_are_current(rootfolder_id):
+        WriteQueue.run(lambda session: refresh_retention_counts(session.connection(), rootfolder_id), WriteQueue.INTERACTIVE, rootfolder_id)
+
+    with db_session(read_only=True, rootfolder_id=rootfolder_id) as session:
+        children_filter = (folder_table.c.rootfolder_id == rootfolder_id) & (folder_table.c.parent_id == parent_id)
+        children = session.execute(select(folder_table.c.id, folder_table.c.nodetype_id, folder_table.c.retention_id)
+                                   .where(children_filter).order_by(folder_table.c.id)).all()
+        counts = session.execute(select(count_table.c.folder_id, count_table.c.retention_id, count_table.c.simulation_count).select_from(
+            count_table.join(folder_table, folder_table.c.id == count_table.c.folder_id)
+        ).where(children_filter & (count_table.c.simulation_count > 0))).all()
+
+    # a simulation has no counts of its own. It counts as one simulation with its retention
+    retention_counts: dict[int, dict[int, int]] = {child.id: {} for child in children}
+    for folder_id, retention_id, simulation_count in counts:
+        retention_counts[folder_id][retention_id] = simulation_count
+    simulation_type_id:int = read_folder_type_dict_pr_domain_id(read_rootfolder_simulationdomain_id(rootfolder_id))[dtos.FolderTypeEnum.SIMULATION].id
+    return [dtos.FolderRetentionCountsDTO(
+                folder_id        = child.id,
+                nodetype_id      = child.nodetype_id,
+                retention_counts = {child.retention_id: 1} if child.nodetype_id == simulation_type_id and child.retention_id else retention_counts[child.id])
+            for child in children]
+#-----------------end retention counts of the folders of a rootfolder -------------------
 
 def read_pathprotections( rootfolder_id: int )-> list[dtos.PathProtectionDTO]:
-    with Session(Database.get_engine()) as session:
-        paths = session.exec(select(dtos.PathProtectionDTO).where(dtos.PathProtectionDTO.rootfolder_id == rootfolder_id)).all()
-        return paths
+    def load() -> list[dtos.PathProtectionDTO]:
+        with db_session(read_only=True, rootfolder_id=rootfolder_id) as session:
+            return session.exec(select(dtos.PathProtectionDTO).where(dtos.PathProtectionDTO.rootfolder_id == rootfolder_id)).all()
+    return list(MetadataCache.get(MetadataCache.ROOTFOLDER_PATH_PROTECTIONS, rootfolder_id, load))
 
-# @TODO we should consider to enforce the changed path protection on existing folders
-# at present it is the clients responsibility to so and communicate it in "def change_retentions"
+# adding or deleting a path protection re-applies the path protections to the subtree of the protected folder
+@queued_write(WriteQueue.INTERACTIVE)
 def add_pathprotection(rootfolder_id:int, path_protection:dtos.PathProtectionDTO):
     #print(f"Adding path protection {path_protection}")
-    with Session(Database.get_engine()) as session:
+    with db_session(rootfolder_id=rootfolder_id) as session:
         # Check if path protection already exists for this path in this rootfolder
         existing_protection = session.exec(
             select(dtos.PathProtectionDTO).where(
@@ -382,13 +638,22 @@ def add_pathprotection(rootfolder_id:int, path_protection:dtos.PathProtectionDTO
         )
         
         session.add(new_protection)
+        session.flush()
+
+        # apply the new protection to its subtree
+        rootfolder = session.get(dtos.RootFolderDTO, rootfolder_id)
+        subtree_path_key:str|None = session.exec(select(dtos.FolderNodeDTO.path_key).where(dtos.FolderNodeDTO.id == new_protection.folder_id)).first()
+        if rootfolder and subtree_path_key is not None:
+            apply_pathprotections_in_session(session, rootfolder, subtree_path_key)
+
         session.commit()
         session.refresh(new_protection)
         path_protection.id = new_protection.id
         path_protection.rootfolder_id = rootfolder_id
+    MetadataCache.invalidate_rootfolder(rootfolder_id)
+    return path_protection
 
-        return path_protection
-
+@queued_write(WriteQueue.INTERACTIVE)
 def add_pathprotection_by_paths(rootfolder_id:int, paths:list[str]):
     # step 1: find the folder nodes by path
     # step 2: create list[dtos.PathProtectionDTO] with rootfolder_id, folder_id, path
@@ -397,23 +662,23 @@ def add_pathprotection_by_paths(rootfolder_id:int, paths:list[str]):
     if not paths:
         raise HTTPException(status_code=400, detail="No paths provided")
     
-    with Session(Database.get_engine()) as session:
+    with db_session(rootfolder_id=rootfolder_id) as session:
         # Verify rootfolder exists
-        rootfolder = session.exec(select(dtos.RootFolderDTO).where(dtos.RootFolderDTO.id == rootfolder_id)).first()
+        rootfolder = session.get(dtos.RootFolderDTO, rootfolder_id)
         if not rootfolder:
             raise HTTPException(status_code=404, detail="RootFolder not found")
         
         # Step 1: Find the folder nodes by path (case-insensitive)
-        lower_case_paths = [path.lower() for path in paths]
+        path_keys = [dtos.to_path_key(path) for path in paths]
         existing_folders = session.exec(
             select(dtos.FolderNodeDTO).where(
                 (dtos.FolderNodeDTO.rootfolder_id == rootfolder_id) &
-                (func.lower(dtos.FolderNodeDTO.path).in_(lower_case_paths))
+                (dtos.FolderNodeDTO.path_key.in_(path_keys))
             )
         ).all()
         
         # Create a mapping from path to folder for fast lookup
-        path_to_folder = {folder.path.lower(): folder for folder in existing_folders}
+        path_to_folder = {folder.path_key: folder for folder in existing_folders}
         
         # Track results
         added_protections = []
@@ -421,7 +686,7 @@ def add_pathprotection_by_paths(rootfolder_id:int, paths:list[str]):
         
         # Step 2 & 3: Create and add path protections
         for path in paths:
-            folder = path_to_folder.get(path.lower())
+            folder = path_to_folder.get(dtos.to_path_key(path))
             
             if not folder:
                 failed_paths.append({"path": path, "reason": "Folder not found"})
@@ -451,9 +716,15 @@ def add_pathprotection_by_paths(rootfolder_id:int, paths:list[str]):
             session.add(new_protection)
             added_protections.append({"path": folder.path, "folder_id": folder.id, "already_existed": False})
 
-        
+        # apply the new protections to their subtrees before committing
+        session.flush()
+        for protection in added_protections:
+            if not protection["already_existed"]:
+                apply_pathprotections_in_session(session, rootfolder, dtos.to_path_key(protection["path"]))
+
         # Commit all new protections
         session.commit()
+        MetadataCache.invalidate_rootfolder(rootfolder_id)
         
         return {
             "message": f"Added {len(added_protections)} path protection(s) for rootfolder {rootfolder_id}",
@@ -463,119 +734,164 @@ def add_pathprotection_by_paths(rootfolder_id:int, paths:list[str]):
         }
 
 
-def apply_pathprotections(rootfolder_id:int)-> dict[str, int]:
+@queued_write(WriteQueue.BULK)
+def apply_pathprotections(rootfolder_id:int, folder_id:int|None = None)-> dict[str, int]:
     # ensure that all existing path protections for the root folder has been applied to the folders
-    # step 1: find the path retention id
-    # step 2: get the simulation nodetype id (only simulation nodes get retention, not innernodes)
-    # step 3: find all path protections for the rootfolder
-    # step 4: sort them by path depth so the most specific path protections takes priority
-    #         Sort by increasing number of segments and apply in that order
-    #         Most specific protections are applied last, overriding higher-level path protections
-    # step 5: Apply path protection by setting retention_id to path retention id and pathprotection_id
-    # step 6: If there is any folder with path retention whose pathprotection_id is no longer valid (protection was deleted).
-    #         Then their retention must be reset to undefined_retention_id
-    # step 7: return number of folders modified
-    
-    with Session(Database.get_engine()) as session:
+    # if folder_id is given then only the subtree of that folder is (re)applied. Used when a path protection is added or deleted
+    with db_session(rootfolder_id=rootfolder_id) as session:
         # Verify rootfolder exists
-        rootfolder = session.exec(select(dtos.RootFolderDTO).where(dtos.RootFolderDTO.id == rootfolder_id)).first()
+        rootfolder = session.get(dtos.RootFolderDTO, rootfolder_id)
         if not rootfolder:
             raise HTTPException(status_code=404, detail="RootFolder not found")
-        
-        # Step 1: Find the path retention id
-        path_retention_dict:dict[str, dtos.RetentionTypeDTO] = read_rootfolder_retentiontypes_dict(rootfolder_id)
-        path_retention_id:int = path_retention_dict["path"].id if "path" in path_retention_dict else 0
-        undefined_retention_id:int = path_retention_dict["?"].id if "?" in path_retention_dict else 0
-        if path_retention_id == 0:
-            raise HTTPException(status_code=500, detail=f"Path retention type not found for rootfolder {rootfolder_id}")
-        
-        # Step 2: Get the simulation nodetype id (only SIMULATION nodes, not INNERNODE)
-        nodetype_simulation_id:int = read_folder_type_dict_pr_domain_id(rootfolder.simulationdomain_id)[dtos.FolderTypeEnum.SIMULATION].id
-        
-        # Step 3: Find all path protections for the rootfolder
-        path_protections = session.exec( select(dtos.PathProtectionDTO).where( dtos.PathProtectionDTO.rootfolder_id == rootfolder_id) ).all()        
-        if not path_protections:
-            return {"message": f"No path protections found for rootfolder {rootfolder_id}", "folders_modified": 0}
-        
-        # Step 4: Sort by path depth (number of segments) - least specific first, most specific last
-        sorted_protections = sorted(path_protections, key=lambda p: p.path.count('/'))
-        
-        # Step 5: Apply path protections to all SIMULATION folders under each protected path
-        folders_modified = 0
-        
-        for protection in sorted_protections:
-            # Find all SIMULATION folders that start with this path (case-insensitive)
-            # Using LIKE with wildcards to match the path and all subpaths
-            matching_folders = session.exec(
-                select(dtos.FolderNodeDTO).where(
-                    (dtos.FolderNodeDTO.rootfolder_id == rootfolder_id) &
-                    (dtos.FolderNodeDTO.nodetype_id == nodetype_simulation_id) &
-                    ((func.lower(dtos.FolderNodeDTO.path) == protection.path.lower()) |
-                     (func.lower(dtos.FolderNodeDTO.path).like(f"{protection.path.lower()}/%")))
-                )
-            ).all()
-            
-            # Apply protection to matching folders
-            for folder in matching_folders:
-                folder.retention_id = path_retention_id
-                folder.path_protection_id = protection.id
-                session.add(folder)
-                folders_modified += 1
-        
-        # Commit all changes
-        session.commit()
 
-        # Step 6: Find folders with path retention where their pathprotection_id is not in the current list of path protections
-        #         Set their retention to undefined_retention_id
-        folders_reset = 0
-        
-        # Get the list of valid path protection IDs
-        valid_protection_ids = [p.id for p in path_protections]
-        
-        # Find all folders with path retention whose pathprotection_id is not in the valid list
-        # These are folders that were protected but their protection has been removed
-        folders_to_reset = session.exec(
-            select(dtos.FolderNodeDTO).where(
-                (dtos.FolderNodeDTO.rootfolder_id == rootfolder_id) &
-                (dtos.FolderNodeDTO.retention_id == path_retention_id) &
-                (dtos.FolderNodeDTO.path_protection_id.notin_(valid_protection_ids))
-            )
-        ).all()
-        
-        # Reset these folders to undefined retention
-        for folder in folders_to_reset:
-            folder.retention_id = undefined_retention_id
-            folder.path_protection_id = None
-            session.add(folder)
-            folders_reset += 1
-        
-        session.commit()
+        subtree_path_key:str|None = None
+        if folder_id is not None:
+            subtree_path_key = session.exec(select(dtos.FolderNodeDTO.path_key).where(
+                (dtos.FolderNodeDTO.id == folder_id) & (dtos.FolderNodeDTO.rootfolder_id == rootfolder_id))).first()
+            if subtree_path_key is None:
+                raise HTTPException(status_code=404, detail="Folder not found")
 
-        # Step 7: Return number of folders modified
-        message = f"Applied {len(path_protections)} path protection(s) to {folders_modified} folder(s) in rootfolder {rootfolder_id}"
-        if folders_reset > 0:
-            message += f", reset {folders_reset} folder(s) no longer covered by protections"
-        
-        return {
-            "message": message,
-            "protections_applied": len(path_protections),
-            "folders_modified": folders_modified,
-            "folders_reset": folders_reset
-        }
+        result = apply_pathprotections_in_session(session, rootfolder, subtree_path_key)
+        session.commit()
+        return result
 
 
-# @TODO we should consider to enforce the changed path protection on existing folders
-# at present it is the clients responsibility to so and communicate it in "def change_retentions"
+def apply_pathprotections_in_session(session: Session, rootfolder: dtos.RootFolderDTO, subtree_path_key: str|None = None) -> dict[str, int]:
+    # step 1: find the path and undefined retention id
+    # step 2: get the simulation nodetype id (only simulation nodes get retention, not innernodes)
+    # step 3: rank the protections covering each simulation by the depth of the protected folder and keep the most specific one.
+    #         Each protection seeks its subtree range on the (rootfolder_id, path_key) index, so the cost is the size of the protected subtrees
+    #         With a subtree_path_key only the folders in that subtree are considered together with the protections that can cover them:
+    #         protections on the ancestors of the subtree and protections inside the subtree
+    # step 4: set retention_id to path retention id and path_protection_id in one update statement. Unchanged folders are not written
+    # step 5: If there is any folder with path retention whose path_protection_id is no longer valid (protection was deleted).
+    #         Then their retention must be reset to undefined_retention_id
+    #         A change version is only allocated when step 4 or 5 has folders to write, so a run that changes nothing does not
+    #         advance the rootfolder's change version (see next_change_version)
+    # step 6: return number of folders modified
+    rootfolder_id:int = rootfolder.id
+
+    # Step 1: Find the path retention id. 
+    # The lookups use the caller's session because the caller may already hold the write lock
+    path_retention_dict:dict[str, int] = {name.lower(): id for id, name in session.exec(
+        select(dtos.RetentionTypeDTO.id, dtos.RetentionTypeDTO.name).where(dtos.RetentionTypeDTO.simulationdomain_id == rootfolder.simulationdomain_id))}
+    path_retention_id:int = path_retention_dict.get("path", 0)
+    undefined_retention_id:int = path_retention_dict.get("?", 0)
+    if path_retention_id == 0:
+        raise HTTPException(status_code=500, detail=f"Path retention type not found for rootfolder {rootfolder_id}")
+
+    # Step 2: Get the simulation nodetype id (only SIMULATION nodes, not INNERNODE)
+    nodetype_simulation_id:int = session.exec(select(dtos.FolderTypeDTO.id).where(
+        (dtos.FolderTypeDTO.simulationdomain_id == rootfolder.simulationdomain_id) & 
+        (func.lower(dtos.FolderTypeDTO.name) == dtos.FolderTypeEnum.SIMULATION.value))).first()
+
+    # Step 3: the most specific protection for each simulation folder
+    folder_table     = dtos.FolderNodeDTO.__table__
+    protection_table = dtos.PathProtectionDTO.__table__
+    protected_folder = folder_table.alias("protected_folder")
+
+    protection_filter = (protection_table.c.rootfolder_id == rootfolder_id)
+    folder_filter     = (folder_table.c.rootfolder_id == rootfolder_id) & (folder_table.c.nodetype_id == nodetype_simulation_id)
+    if subtree_path_key is not None:
+        protection_filter = protection_filter & (protected_folder.c.path_key.in_(ancestor_path_keys(subtree_path_key)) |
+                                                 path_key_in_subtree(subtree_path_key, protected_folder.c.path_key))
+        folder_filter     = folder_filter & path_key_in_subtree(subtree_path_key, folder_table.c.path_key)
+
+    ranked_protections = select(
+        folder_table.c.id.label("folder_id"),
+        protection_table.c.id.label("protection_id"),
+        func.row_number().over(partition_by=folder_table.c.id, order_by=func.length(protected_folder.c.path_key).desc()).label("rank")
+    ).select_from(
+        protection_table.join(protected_folder, protected_folder.c.id == protection_table.c.folder_id)
+                        .join(folder_table, folder_filter & path_key_in_subtree(protected_folder.c.path_key, folder_table.c.path_key))
+    ).where(protection_filter).subquery("ranked_protections")
+
+    def has_folders(where) -> bool:
+        return session.connection().execute(select(folder_table.c.id).where(where).limit(1)).first() is not None
+
+    # Step 4: Apply path protections to the folders that are not already protected by their most specific protection
+    change_version:int|None = None
+    folders_modified:int = 0
+    protect_filter = (folder_table.c.id == ranked_protections.c.folder_id) & \
+                     (ranked_protections.c.rank == 1) & \
+                     ((folder_table.c.retention_id != path_retention_id) |
+                      folder_table.c.path_protection_id.is_distinct_from(ranked_protections.c.protection_id))
+    if has_folders(protect_filter):
+        change_version = next_change_version(session.connection(), rootfolder_id)
+        folders_modified = session.connection().execute(
+            update(folder_table).where(protect_filter)
+            .values(retention_id=path_retention_id, path_protection_id=ranked_protections.c.protection_id, change_version=change_version)
+        ).rowcount
+
+    # Step 5: Reset folders with path retention whose path_protection_id is not in the current list of path protections
+    #         These are folders that were protected but their protection has been removed
+    reset_filter = (folder_table.c.rootfolder_id == rootfolder_id) & \
+                   (folder_table.c.retention_id == path_retention_id) & \
+                   folder_table.c.path_protection_id.notin_(select(protection_table.c.id).where(protection_table.c.rootfolder_id == rootfolder_id))
+    if subtree_path_key is not None:
+        reset_filter = reset_filter & path_key_in_subtree(subtree_path_key, folder_table.c.path_key)
+    folders_reset:int = 0
+    if has_folders(reset_filter):
+        if change_version is None:
+            change_version = next_change_version(session.connection(), rootfolder_id)
+        folders_reset = session.connection().execute(
+            update(folder_table).where(reset_filter).values(retention_id=undefined_retention_id, path_protection_id=0, change_version=change_version)
+        ).rowcount
+
+    refresh_retention_counts(session.connection(), rootfolder_id)
+
+    # Step 6: Return number of folders modified
+    protections_count:int = session.exec(select(func.count(dtos.PathProtectionDTO.id)).where(dtos.PathProtectionDTO.rootfolder_id == rootfolder_id)).one()
+    message = f"Applied {protections_count} path protection(s) to {folders_modified} folder(s) in rootfolder {rootfolder_id}"
+    if folders_reset > 0:
+        message += f", reset {folders_reset} folder(s) no longer covered by protections"
+
+    return {
+        "message": message,
+        "protections_applied": protections_count,
+        "folders_modified": folders_modified,
+        "folders_reset": folders_reset
+    }
+
+
+# Criteria for a folder and all folders below it using the indexed path_key.
+# The subtree of "a/b" lies in the key range ["a/b", "a/b0") because "0" is the character after "/". 
+# The range is seeked on the (rootfolder_id, path_key) index and siblings like "a/b-1" inside the range are filtered out.
+# This is equivalent to path_key = 'a/b' OR path_key LIKE 'a/b/%' 
+# path_key can also be a column so that subtrees can be joined. key_column defaults to FolderNodeDTO.path_key
+def path_key_in_subtree(path_key, key_column = None):
+    key_column = dtos.FolderNodeDTO.path_key if key_column is None else key_column
+    return (key_column >= path_key) & (key_column < path_key + "0") & \
+           ((key_column == path_key) | (key_column >= path_key + "/"))
+
+def ancestor_path_keys(path_key: str) -> list[str]:
+    """path keys of all folders above path_key. For "/a/b/c" it is ["/a/b", "/a", "/"]"""
+    ancestors: list[str] = []
+    while path_key not in ("/", ""):
+        path_key = posixpath.dirname(path_key)
+        ancestors.append(path_key)
+    return ancestors
+
+@queued_write(WriteQueue.INTERACTIVE)
 def delete_pathprotection(rootfolder_id: int, protection_id: int):
-    with Session(Database.get_engine()) as session:
+    with db_session(rootfolder_id=rootfolder_id) as session:
         # Find the path protection by ID and rootfolder_id
         protection = session.exec( select(dtos.PathProtectionDTO).where((dtos.PathProtectionDTO.id == protection_id) & (dtos.PathProtectionDTO.rootfolder_id == rootfolder_id)) ).first()
         if not protection:
             raise HTTPException(status_code=404, detail="Path protection not found")
         
         session.delete(protection)
+        session.flush()
+
+        # re-apply the remaining protections to the subtree that was protected
+        rootfolder = session.get(dtos.RootFolderDTO, rootfolder_id)
+        subtree_path_key:str|None = session.exec(select(dtos.FolderNodeDTO.path_key).where(dtos.FolderNodeDTO.id == protection.folder_id)).first()
+        if subtree_path_key is not None:
+            apply_pathprotections_in_session(session, rootfolder, subtree_path_key)
+
         session.commit()
-        return {"message": f"Path protection {protection_id} deleted"}
+    MetadataCache.invalidate_rootfolder(rootfolder_id)
+    return {"message": f"Path protection {protection_id} deleted"}
 
 def read_simulations_by_retention_type(rootfolder_id: int, retention_type: dtos.RetentionTypeEnum, require_pathprotection: bool = False) -> list[dtos.FolderNodeDTO]:
     """
@@ -589,8 +905,8 @@ def read_simulations_by_retention_type(rootfolder_id: int, retention_type: dtos.
     Returns:
         List of FolderNodeDTO matching the criteria
     """
-    with Session(Database.get_engine()) as session:
-        rootfolder = session.exec(select(dtos.RootFolderDTO).where(dtos.RootFolderDTO.id == rootfolder_id)).first()
+    with db_session(read_only=True, rootfolder_id=rootfolder_id) as session:
+        rootfolder = session.get(dtos.RootFolderDTO, rootfolder_id)
         if not rootfolder:
             raise HTTPException(status_code=404, detail="RootFolder not found")
 
@@ -615,51 +931,191 @@ def read_simulations_by_retention_type(rootfolder_id: int, retention_type: dtos.
         folders = session.exec(query).all()
         return folders
 
+# The retention changes of the webclient are interactive session jobs of the WriteQueue, so changes that arrive together are committed
+# together. The *_in_session functions do not commit
 def change_retentions(rootfolder_id: int, retentions: list[dtos.FolderRetention]) -> list[dtos.FolderRetention]:
+    return WriteQueue.run(lambda session: change_retentions_in_session(session, rootfolder_id, retentions), WriteQueue.INTERACTIVE, rootfolder_id)
+
+def change_retentions_in_session(session: Session, rootfolder_id: int, retentions: list[dtos.FolderRetention]) -> list[dtos.FolderRetention]:
     from datamodel.retentions import RetentionCalculator    
-    with Session(Database.get_engine()) as session:
-        rootfolder = session.exec(select(dtos.RootFolderDTO).where(dtos.RootFolderDTO.id == rootfolder_id)).first()
-        if not rootfolder:
-            raise HTTPException(status_code=404, detail="RootFolder not found")
+    rootfolder = session.get(dtos.RootFolderDTO, rootfolder_id)
+    if not rootfolder:
+        raise HTTPException(status_code=404, detail="RootFolder not found")
 
-        # Get retention types for calculations
-        #retention_calculator: RetentionCalculator = RetentionCalculator(read_rootfolder_retentiontypes_dict(rootfolder_id), cleanup_config) 
-        retention_calculator: RetentionCalculator = RetentionCalculator(rootfolder.id, rootfolder.cleanup_config_id, session)
+    # Get retention types for calculations
+    #retention_calculator: RetentionCalculator = RetentionCalculator(read_rootfolder_retentiontypes_dict(rootfolder_id), cleanup_config) 
+    retention_calculator: RetentionCalculator = RetentionCalculator(rootfolder.id, rootfolder.cleanup_config_id, session)
 
-        # Update expiration dates. 
-        # Since RetentionUpdateDTO IS-A Retention, we can pass it directly to the calculator
-        for retention in retentions:
-            retention.update_retention_fields(
-                retention_calculator.adjust_expiration_date_from_cleanup_configuration_and_retentiontype(retention.getRetention())
-            )
-           
-        # Prepare bulk update data - much more efficient than Python loops
-        # update with the retention information and reset the days_to_cleanup to 0 
-        bulk_updates = [
-            {
-                "id": retention.folder_id,
-                "retention_id": retention.retention_id,
-                "pathprotection_id": retention.path_protection_id,
-                "expiration_date": retention.expiration_date
-            }
-            for retention in retentions
-        ]
-        session.bulk_update_mappings(dtos.FolderNodeDTO, bulk_updates)
-        session.commit()
+    # Update expiration dates. 
+    # Since RetentionUpdateDTO IS-A Retention, we can pass it directly to the calculator
+    for retention in retentions:
+        retention.update_retention_fields(
+            retention_calculator.adjust_expiration_date_from_cleanup_configuration_and_retentiontype(retention.getRetention())
+        )
+       
+    # Prepare bulk update data - much more efficient than Python loops
+    # update with the retention information and reset the days_to_cleanup to 0 
+    change_version:int = next_change_version(session.connection(), rootfolder_id)
+    bulk_updates = [
+        {
+            "id": retention.folder_id,
+            "retention_id": retention.retention_id,
+            "pathprotection_id": retention.path_protection_id,
+            "expiration_date": retention.expiration_date,
+            "change_version": change_version
+        }
+        for retention in retentions
+    ]
+    session.bulk_update_mappings(dtos.FolderNodeDTO, bulk_updates)
+    refresh_retention_counts(session.connection(), rootfolder_id)
 
-        #get all FolderNodeDTO that were updated
-        #updated_folders:list[dtos.FolderNodeDTO] = session.exec(
-        #    select(dtos.FolderNodeDTO).where(dtos.FolderNodeDTO.id.in_([retention.folder_id for retention in retentions]))
-        #).all()
+    #get all FolderNodeDTO that were updated
+    #updated_folders:list[dtos.FolderNodeDTO] = session.exec(
+    #    select(dtos.FolderNodeDTO).where(dtos.FolderNodeDTO.id.in_([retention.folder_id for retention in retentions]))
+    #).all()
 
-        #retentions: list[dtos.FolderRetention] = [dtos.FolderRetention.from_folder_node_dto(folder) for folder in updated_folders]    
-        
-        return retentions
+    #retentions: list[dtos.FolderRetention] = [dtos.FolderRetention.from_folder_node_dto(folder) for folder in updated_folders]    
+    
+    return retentions
+
+# Set-based version of change_retentions for the simulations selected by a RetentionChangeByFilter
+# step 1: validate the target retention. Path retention is owned by the path protections so it can not be set here
+# step 2: the expiration date of the target retention. It is the same for all simulations so it is calculated once 
+# step 3: update the selected simulations in one statement. Path protected simulations keep their retention and
+#         simulations that already have the target retention and expiration date are not written so they keep their change version
+def change_retentions_by_filter(rootfolder_id: int, change: dtos.RetentionChangeByFilter) -> dtos.RetentionChangeResult:
+    return WriteQueue.run(lambda session: change_retentions_by_filter_in_session(session, rootfolder_id, change), WriteQueue.INTERACTIVE, rootfolder_id)
+
+def change_retentions_by_filter_in_session(session: Session, rootfolder_id: int, change: dtos.RetentionChangeByFilter) -> dtos.RetentionChangeResult:
+    from datamodel.retentions import RetentionCalculator    
+    rootfolder = session.get(dtos.RootFolderDTO, rootfolder_id)
+    if not rootfolder:
+        raise HTTPException(status_code=404, detail="RootFolder not found")
+
+    # Step 1: validate the target retention
+    retention_names: dict[int, str] = {retention.id: retention.name for retention in read_rootfolder_retentiontypes(rootfolder_id)}
+    if change.retention_id not in retention_names:
+        raise HTTPException(status_code=404, detail=f"Retention type {change.retention_id} not found for rootfolder {rootfolder_id}")
+    if retention_names[change.retention_id].lower() == dtos.RetentionTypeEnum.PATH.value:
+        raise HTTPException(status_code=400, detail="Path retention is set by adding a path protection")
+
+    # Step 2: the expiration date of the target retention
+    retention_calculator: RetentionCalculator = RetentionCalculator(rootfolder.id, rootfolder.cleanup_config_id, session)
+    expiration_date: datetime | None = retention_calculator.adjust_expiration_date_from_cleanup_configuration_and_retentiontype(
+        dtos.Retention(retention_id=change.retention_id)).expiration_date
+
+    # Step 3: update the selected simulations
+    folder_table = dtos.FolderNodeDTO.__table__
+    leaf_nodetype_id: int = read_folder_type_dict_pr_domain_id(rootfolder.simulationdomain_id)[dtos.FolderTypeEnum.SIMULATION].id
+    selection = (folder_table.c.rootfolder_id == rootfolder_id) & (folder_table.c.nodetype_id == leaf_nodetype_id) & \
+                (func.coalesce(folder_table.c.path_protection_id, 0) == 0)
+    if change.folder_id:
+        selection = selection & path_key_in_subtree(read_subtree_root(session, rootfolder_id, change.folder_id).path_key, folder_table.c.path_key)
+    if change.current_retention_ids is not None:
+        selection = selection & folder_table.c.retention_id.in_(change.current_retention_ids)
+    if change.modified_after is not None:
+        selection = selection & (folder_table.c.modified_date >= change.modified_after)
+    if change.modified_before is not None:
+        selection = selection & (folder_table.c.modified_date < change.modified_before)
+    is_changed = folder_table.c.retention_id.is_distinct_from(change.retention_id) | folder_table.c.expiration_date.is_distinct_from(expiration_date)
+
+    change_version: int = next_change_version(session.connection(), rootfolder_id)
+    count: int = session.connection().execute(
+        update(folder_table).where(selection & is_changed)
+        .values(retention_id=change.retention_id, expiration_date=expiration_date, change_version=change_version)
+    ).rowcount
+    refresh_retention_counts(session.connection(), rootfolder_id)
+    return dtos.RetentionChangeResult(count=count, change_version=change_version)
+
+# Columnar version of change_retentions for clients that send an explicit list of simulations. The body is two parallel arrays
+# of folder ids and retention ids, decoded with numpy instead of one pydantic FolderRetention per simulation:
+#   application/json:         {"folderIds": [...], "retentionIds": [...]}
+#   application/octet-stream: n folder ids followed by n retention ids as little endian int64
+COLUMNAR_RETENTIONS_DTYPE = np.dtype("<i8")
+
+def decode_columnar_retentions(content_type: str, body: bytes) -> tuple[np.ndarray, np.ndarray]:
+    media_type: str = content_type.split(";")[0].strip().lower()
+    if media_type == "application/octet-stream":
+        if len(body) % (2 * COLUMNAR_RETENTIONS_DTYPE.itemsize) != 0:
+            raise HTTPException(status_code=400, detail="The body must hold the same number of folder ids and retention ids")
+        folder_ids, retention_ids = np.frombuffer(body, dtype=COLUMNAR_RETENTIONS_DTYPE).reshape(2, -1)
+    elif media_type == "application/json":
+        try:
+            columns = json.loads(body)
+            folder_ids    = np.asarray(columns["folderIds"], dtype=np.int64)
+            retention_ids = np.asarray(columns["retentionIds"], dtype=np.int64)
+        except (ValueError, TypeError, KeyError) as error:
+            raise HTTPException(status_code=400, detail=f"Invalid columnar retentions: {error}")
+        if folder_ids.ndim != 1 or folder_ids.shape != retention_ids.shape:
+            raise HTTPException(status_code=400, detail="folderIds and retentionIds must be arrays of the same length")
+    else:
+        raise HTTPException(status_code=415, detail=f"Unsupported content type {content_type}")
+    return folder_ids, retention_ids
+
+# Temporary staging table of the (folder_id, retention_id) pairs of a columnar change. See simulation_staging_table
+retention_staging_table = Table(
+    "retention_staging", MetaData(),
+    Column("folder_id", Integer, primary_key=True),
+    Column("retention_id", Integer, nullable=False),
+    prefixes=["TEMPORARY"],
+)
+
+# step 1: validate the retentions and calculate the expiration date of each distinct retention like change_retentions
+# step 2: stage the pairs with copy_rows. A folder id that occurs more than once gets its last retention
+# step 3: update the simulations of the rootfolder whose retention or expiration date changes with one UPDATE .. FROM the staged pairs.
+#         Like change_retentions_by_filter, path protected simulations and inner nodes are not changed
+def change_retentions_columnar(rootfolder_id: int, folder_ids: np.ndarray, retention_ids: np.ndarray) -> dtos.RetentionChangeResult:
+    return WriteQueue.run(lambda session: change_retentions_columnar_in_session(session, rootfolder_id, folder_ids, retention_ids), WriteQueue.INTERACTIVE, rootfolder_id)
+
+def change_retentions_columnar_in_session(session: Session, rootfolder_id: int, folder_ids: np.ndarray, retention_ids: np.ndarray) -> dtos.RetentionChangeResult:
+    from datamodel.retentions import RetentionCalculator    
+    rootfolder = session.get(dtos.RootFolderDTO, rootfolder_id)
+    if not rootfolder:
+        raise HTTPException(status_code=404, detail="RootFolder not found")
+
+    # Step 1: the expiration date of each distinct retention
+    distinct_retention_ids: list[int] = np.unique(retention_ids).tolist()
+    retention_names: dict[int, str] = {retention.id: retention.name for retention in read_rootfolder_retentiontypes(rootfolder_id)}
+    unknown_retention_ids = set(distinct_retention_ids) - retention_names.keys()
+    if unknown_retention_ids:
+        raise HTTPException(status_code=404, detail=f"Retention types {sorted(unknown_retention_ids)} not found for rootfolder {rootfolder_id}")
+    if any(retention_names[retention_id].lower() == dtos.RetentionTypeEnum.PATH.value for retention_id in distinct_retention_ids):
+        raise HTTPException(status_code=400, detail="Path retention is set by adding a path protection")
+    retention_calculator: RetentionCalculator = RetentionCalculator(rootfolder.id, rootfolder.cleanup_config_id, session)
+    expiration_dates: dict[int, datetime] = {}
+    for retention_id in distinct_retention_ids:
+        expiration_date = retention_calculator.adjust_expiration_date_from_cleanup_configuration_and_retentiontype(dtos.Retention(retention_id=retention_id)).expiration_date
+        if expiration_date is not None:
+            expiration_dates[retention_id] = expiration_date
+
+    # Step 2: stage the pairs. The last pair of a folder id is found with numpy so the pairs can be copied without conflicts
+    connection = session.connection()
+    retention_staging_table.create(connection, checkfirst=True)
+    connection.execute(delete(retention_staging_table))
+    reversed_folder_ids = folder_ids[::-1]
+    _, last_in_reversed = np.unique(reversed_folder_ids, return_index=True)
+    copy_rows(connection, retention_staging_table, zip(reversed_folder_ids[last_in_reversed].tolist(), retention_ids[::-1][last_in_reversed].tolist()))
+
+    # Step 3: update the folders. Non numeric retentions have no expiration date
+    folder_table = dtos.FolderNodeDTO.__table__
+    leaf_nodetype_id: int = read_folder_type_dict_pr_domain_id(rootfolder.simulationdomain_id)[dtos.FolderTypeEnum.SIMULATION].id
+    new_expiration_date = case(expiration_dates, value=retention_staging_table.c.retention_id, else_=None) if expiration_dates else null()
+    change_version: int = next_change_version(connection, rootfolder_id)
+    count: int = connection.execute(
+        update(folder_table).where(
+            (folder_table.c.id == retention_staging_table.c.folder_id) & (folder_table.c.rootfolder_id == rootfolder_id) &
+            (folder_table.c.nodetype_id == leaf_nodetype_id) & (func.coalesce(folder_table.c.path_protection_id, 0) == 0) &
+            (folder_table.c.retention_id.is_distinct_from(retention_staging_table.c.retention_id) | folder_table.c.expiration_date.is_distinct_from(new_expiration_date))
+        ).values(retention_id=retention_staging_table.c.retention_id, expiration_date=new_expiration_date, change_version=change_version)
+    ).rowcount
+    connection.execute(delete(retention_staging_table))
+    refresh_retention_counts(connection, rootfolder_id)
+    return dtos.RetentionChangeResult(count=count, change_version=change_version)
 
 # -------------------------- db operation related to cleanup_cycle action ---------
 def read_folders_marked_for_cleanup(rootfolder_id: int) -> list[dtos.FolderNodeDTO]:
-    with Session(Database.get_engine()) as session:
-        rootfolder = session.exec(select(dtos.RootFolderDTO).where(dtos.RootFolderDTO.id == rootfolder_id)).first()
+    with db_session(read_only=True, rootfolder_id=rootfolder_id) as session:
+        rootfolder = session.get(dtos.RootFolderDTO, rootfolder_id)
         if not rootfolder:
             raise HTTPException(status_code=404, detail="RootFolder not found")
 
@@ -677,14 +1133,83 @@ def read_folders_marked_for_cleanup(rootfolder_id: int) -> list[dtos.FolderNodeD
         return folders
 
 # used for testing
-def read_folder( folder_id: int ) -> dtos.FolderNodeDTO:
-    with Session(Database.get_engine()) as session:
-        folder = session.exec(select(dtos.FolderNodeDTO).where(dtos.FolderNodeDTO.id == folder_id)).first()
+def read_folder( rootfolder_id: int, folder_id: int ) -> dtos.FolderNodeDTO:
+    with db_session(read_only=True, rootfolder_id=rootfolder_id) as session:
+        folder = session.exec(select(dtos.FolderNodeDTO).where((dtos.FolderNodeDTO.id == folder_id) & (dtos.FolderNodeDTO.rootfolder_id == rootfolder_id))).first()
         if not folder:
             raise HTTPException(status_code=404, detail="Folder not found")
         return folder
 
 
+# -------------------------- subtree queries ---------
+# A subtree is selected with path_key_in_subtree, i.e. a range seek on the (rootfolder_id, path_key) index, 
+# so the cost is proportional to the size of the subtree and not the rootfolder.
+# The ancestors of a folder are read directly from its path_ids
+
+def read_subtree_root(session: Session, rootfolder_id: int, folder_id: int) -> dtos.FolderNodeDTO:
+    folder = session.exec(select(dtos.FolderNodeDTO).where((dtos.FolderNodeDTO.id == folder_id) & (dtos.FolderNodeDTO.rootfolder_id == rootfolder_id))).first()
+    if not folder:
+        raise HTTPException(status_code=404, detail="Folder not found")
+    return folder
+
+def simulations_in_subtree_filter(session: Session, rootfolder_id: int, folder_id: int):
+    folder = read_subtree_root(session, rootfolder_id, folder_id)
+    rootfolder = session.get(dtos.RootFolderDTO, rootfolder_id)
+    leaf_nodetype_id: int = read_folder_type_dict_pr_domain_id(rootfolder.simulationdomain_id)[dtos.FolderTypeEnum.SIMULATION].id
+    return (dtos.FolderNodeDTO.rootfolder_id == rootfolder_id) & path_key_in_subtree(folder.path_key) & (dtos.FolderNodeDTO.nodetype_id == leaf_nodetype_id)
+
+def read_simulations_in_subtree(rootfolder_id: int, folder_id: int) -> list[dtos.FolderNodeDTO]:
+    with db_session(read_only=True, rootfolder_id=rootfolder_id) as session:
+        simulations = session.exec(select(dtos.FolderNodeDTO).where(
+            simulations_in_subtree_filter(session, rootfolder_id, folder_id)
+        ).order_by(dtos.FolderNodeDTO.path_key)).all()
+        return simulations
+
+def read_simulations_in_subtree_json(rootfolder_id: int, folder_id: int) -> Response:
+    with db_session(read_only=True, rootfolder_id=rootfolder_id) as session:
+        rows = session.execute(select_json_columns(dtos.FolderNodeDTO).where(
+            simulations_in_subtree_filter(session, rootfolder_id, folder_id)
+        ).order_by(dtos.FolderNodeDTO.path_key)).all()
+    return json_rows_response(dtos.FolderNodeDTO, rows)
+
+def read_subtree_summary(rootfolder_id: int, folder_id: int) -> dict[str, int | dict[str, int]]:
+    # count the nodes and simulations under folder_id (inclusive) and the number of simulations per retention type 
+    with db_session(read_only=True, rootfolder_id=rootfolder_id) as session:
+        folder = read_subtree_root(session, rootfolder_id, folder_id)
+        rootfolder = session.get(dtos.RootFolderDTO, rootfolder_id)
+        leaf_nodetype_id: int = read_folder_type_dict_pr_domain_id(rootfolder.simulationdomain_id)[dtos.FolderTypeEnum.SIMULATION].id
+        retention_names: dict[int, str] = {retention.id: retention.name for retention in read_rootfolder_retentiontypes(rootfolder_id)}
+
+        counts = session.exec(select(dtos.FolderNodeDTO.nodetype_id, dtos.FolderNodeDTO.retention_id, func.count()).where(
+            (dtos.FolderNodeDTO.rootfolder_id == rootfolder_id) & path_key_in_subtree(folder.path_key)
+        ).group_by(dtos.FolderNodeDTO.nodetype_id, dtos.FolderNodeDTO.retention_id)).all()
+
+        node_count: int = sum(count for _, _, count in counts)
+        simulations_by_retention: dict[str, int] = {}
+        for nodetype_id, retention_id, count in counts:
+            if nodetype_id == leaf_nodetype_id:
+                name = retention_names.get(retention_id, "?")
+                simulations_by_retention[name] = simulations_by_retention.get(name, 0) + count
+
+        return {
+            "folder_id": folder.id,
+            "node_count": node_count,
+            "simulation_count": sum(simulations_by_retention.values()),
+            "simulations_by_retention": simulations_by_retention
+        }
+
+def read_ancestors(rootfolder_id: int, folder_id: int) -> list[dtos.FolderNodeDTO]:
+    # the ancestors of folder_id ordered from the top folder and down to the parent of folder_id
+    with db_session(read_only=True, rootfolder_id=rootfolder_id) as session:
+        folder = read_subtree_root(session, rootfolder_id, folder_id)
+        ancestor_ids: list[int] = [int(id) for id in folder.path_ids.split("/") if id and int(id) not in (0, folder.id)]
+        if not ancestor_ids:
+            return []
+
+        ancestors = {ancestor.id: ancestor for ancestor in session.exec(select(dtos.FolderNodeDTO).where(dtos.FolderNodeDTO.id.in_(ancestor_ids))).all()}
+        return [ancestors[id] for id in ancestor_ids if id in ancestors]
+
+
 # -------------------------- insertion of simulation by agents ---------
 
 
@@ -699,33 +1224,168 @@ def read_folder( folder_id: int ) -> dtos.FolderNodeDTO:
 #  - the expiration date and numeric retentions will:
 #       if cleanup is active then recalculate them 
 #       if cleanup is inactive then ignore them 
+#  - the scan is ingested as one unit of work: the simulations and the re-applied path protections are committed together or not at all.
+#    In the sharded storage mode the unit only holds the rootfolder's shard, so the writes of other rootfolders do not wait for it
+@queued_write(WriteQueue.BULK)
 def insert_or_update_simulations_in_db(rootfolder_id: int, simulations: list[dtos.FileInfo]) -> dict[str, str]:
-    #here we can remove all existing simulation if nothing changes for them
-    ret1:dict[str, str] = insert_or_update_simulation_in_db_internal(rootfolder_id, simulations)
+    #here we remove all existing simulation if nothing changes for them so that a rescan only pays for the changes
+    changed_simulations: list[dtos.FileInfo] = select_new_or_changed_simulations(rootfolder_id, simulations)
+    if changed_simulations:
+        ret1:dict[str, str] = insert_or_update_simulation_in_db_internal(rootfolder_id, changed_simulations)
+    else:
+        ret1:dict[str, str] = {"message": f"For rootfolder {rootfolder_id}: inserted or changed simulations: 0"}
+    ret1["changed_count"]   = len(changed_simulations)
+    ret1["unchanged_count"] = len(simulations) - len(changed_simulations)
     ret2:dict[str, str] = apply_pathprotections(rootfolder_id) # this should no be necessary but
     return {**ret1, **ret2}
 
 
+# Change detection for scan ingestion.
+# A simulation carries no new information if its folder exists with the same modified_date and a retention of the same
+# external retention type (numeric, clean, issue or missing). All other simulations are new or changed.
+# The fingerprint can contain NULLs (a folder or simulation without modified_date, a simulation without external retention)
+# so it is compared with IS NOT DISTINCT FROM, where NULL matches NULL.
+# The fingerprint (rootfolder_id, path_key, modified_date, retention_id) is covered by an index on FolderNodeDTO so the 
+# check is one index-only join against the staged simulations and it is always consistent with the folders.
+def select_new_or_changed_simulations(rootfolder_id: int, simulations: list[dtos.FileInfo]) -> list[dtos.FileInfo]:
+    if not simulations:
+        return []
+
+    retention_types: dict[str, dtos.RetentionTypeDTO] = read_rootfolder_retentiontypes_dict(rootfolder_id)
+    external_retention_by_id: dict[int, str] = {retention.id: retention.get_external_retention_type().value for retention in retention_types.values()}
+
+    folder_table = dtos.FolderNodeDTO.__table__
+    folder_external_retention = case(external_retention_by_id, value=folder_table.c.retention_id, else_=dtos.ExternalRetentionTypes.NUMERIC.value)
+    with db_session(rootfolder_id=rootfolder_id) as session:
+        with staged_simulations(session, simulations) as staging:
+            unchanged_seqs: set[int] = set(session.execute(
+                select(staging.c.seq).select_from(
+                    staging.join(folder_table, (folder_table.c.rootfolder_id == rootfolder_id) & (folder_table.c.path_key == staging.c.path_key))
+                ).where(
+                    folder_table.c.modified_date.is_not_distinct_from(staging.c.modified_date) &
+                    folder_external_retention.is_not_distinct_from(staging.c.external_retention)
+                )
+            ).scalars().all())
+        session.commit()
+
+    return [sim for seq, sim in enumerate(simulations) if seq not in unchanged_seqs]
+
+
+
+# Temporary staging table used to match a batch of simulations against FolderNodeDTO with set based joins
+# instead of an IN (...) clause with one bound parameter pr simulation. seq is the index of the simulation in the batch.
+# SQLite keeps temporary tables private to the connection so concurrent batches do not see each other' rows
+simulation_staging_table = Table(
+    "simulation_staging", MetaData(),
+    Column("seq", Integer, primary_key=True),
+    Column("path_key", String, nullable=False),
+    Column("modified_date", DateTime),
+    Column("external_retention", String),
+    prefixes=["TEMPORARY"],
+)
+STAGING_CHUNK_SIZE: int = 10000
+
+# Temporary staging table of the new folders of insert_new_nodes_by_copy. The rows are complete, including their reserved id
+folder_staging_table = Table(
+    "folder_staging", MetaData(),
+    Column("id", Integer, primary_key=True, autoincrement=False),
+    Column("parent_id", Integer, nullable=False),
+    Column("name", String, nullable=False),
+    Column("name_key", String, nullable=False),
+    Column("path", String, nullable=False),
+    Column("path_key", String, nullable=False),
+    Column("path_ids", String, nullable=False),
+    Column("nodetype_id", Integer, nullable=False),
+    prefixes=["TEMPORARY"],
+)
+
+def insert_new_nodes_by_copy(connection, rootfolder_id: int, change_version: int, new_nodes: list[dict], existing_path_ids: dict[int, str]) -> None:
+    """insert the new nodes of insert_simulations_in_db on PostgreSQL: reserve their ids from the id sequence in one query, COPY the
+    complete rows into folder_staging and insert them with one INSERT .. SELECT. A parent is always before its children in new_nodes"""
+    folder_table = dtos.FolderNodeDTO.__table__
+    new_ids: list[int] = connection.execute(
+        text("SELECT nextval(pg_get_serial_sequence(:table, 'id')) FROM generate_series(1, :count)"),
+        {"table": folder_table.name, "count": len(new_nodes)}
+    ).scalars().all()
+    new_path_ids: list[str] = []
+    def staged_rows() -> Iterable[tuple]:
+        for node, node_id in zip(new_nodes, new_ids):
+            parent_ref = node["parent_ref"]
+            if parent_ref < 0:
+                parent = (new_ids[-parent_ref - 1], new_path_ids[-parent_ref - 1])
+            elif parent_ref == 0:
+                parent = (0, "0")
+            else:
+                parent = (parent_ref, existing_path_ids[parent_ref])
+            new_path_ids.append(generate_path_ids(parent[1], node_id))
+            yield (node_id, parent[0], node["name"], node["name_key"], node["path"], node["path_key"], new_path_ids[-1], node["nodetype_id"])
+
+    folder_staging_table.create(connection, checkfirst=True)
+    connection.execute(delete(folder_staging_table))
+    copy_rows(connection, folder_staging_table, staged_rows())
+    staged = folder_staging_table.c
+    connection.execute(insert(folder_table).from_select(
+        ["id", "rootfolder_id", "parent_id", "name", "name_key", "path", "path_key", "path_ids", "nodetype_id", "retention_id", "path_protection_id", "change_version"],
+        select(staged.id, literal(rootfolder_id), staged.parent_id, staged.name, staged.name_key, staged.path, staged.path_key, staged.path_ids,
+               staged.nodetype_id, literal(0), literal(0), literal(change_version))
+    ))
+    connection.execute(delete(folder_staging_table))
+
+def copy_rows(connection, table: Table, rows: Iterable[tuple]) -> None:
+    """insert the rows, tuples in the order of the table's columns, into a staging table. 
+    PostgreSQL streams them with COPY FROM STDIN, other databases insert them in chunks of STAGING_CHUNK_SIZE"""
+    columns: list[str] = [column.name for column in table.columns]
+    if connection.dialect.name == "postgresql":
+        # COPY runs on the driver's connection in the transaction of the session
+        with connection.connection.driver_connection.cursor() as cursor:
+            with cursor.copy(f"COPY {table.name} ({', '.join(columns)}) FROM STDIN") as copy:
+                for row in rows:
+                    copy.write_row(row)
+        return
+    rows = iter(rows)
+    while chunk := [dict(zip(columns, row)) for row in islice(rows, STAGING_CHUNK_SIZE)]:
+        connection.execute(insert(table), chunk)
+
+@contextmanager
+def staged_simulations(session: Session, simulations: list[dtos.FileInfo]):
+    # Stream the path keys of the simulations into the staging table and yield the table for joins.
+    # The staging table is emptied again when the block exits
+    connection = session.connection()
+    simulation_staging_table.create(connection, checkfirst=True)
+    connection.execute(delete(simulation_staging_table))
+    copy_rows(connection, simulation_staging_table,
+              ((seq, 
+                dtos.to_path_key(sim.filepath), 
+                sim.modified_date, 
+                None if sim.external_retention is None else dtos.ExternalRetentionTypes(sim.external_retention).value) 
+               for seq, sim in enumerate(simulations)))
+    try:
+        yield simulation_staging_table
+    finally:
+        connection.execute(delete(simulation_staging_table))
+
 
 #the function is slow so before calling this function remove all simulation that does not provide new information. new simulation, new modified date, new retention
 def insert_or_update_simulation_in_db_internal(rootfolder_id: int, simulations: list[dtos.FileInfo]) -> dict[str, str]:
-    with Session(Database.get_engine()) as session:
-        rootfolder = session.exec(select(dtos.RootFolderDTO).where(dtos.RootFolderDTO.id == rootfolder_id)).first()
+    with db_session(rootfolder_id=rootfolder_id) as session:
+        rootfolder = session.get(dtos.RootFolderDTO, rootfolder_id)
         if not rootfolder:
             raise HTTPException(status_code=404, detail="RootFolder not found")
 
-        # and the filepaths from the list of simulations
-        existing_folders_query = session.exec(
-            select(dtos.FolderNodeDTO).where(
-                (dtos.FolderNodeDTO.rootfolder_id == rootfolder_id) &
-                (dtos.FolderNodeDTO.path.in_([sim.filepath.lower() for sim in simulations]))
-            )
-        ).all()
-        
-        # Create a mapping from filepath to existing folder for fast lookup
-        existing_folders: set[str]               = set([folder.path.lower() for folder in existing_folders_query])
-        insert_simulations: list[dtos.FileInfo]  = [sim for sim in simulations if sim.filepath.lower() not in existing_folders]
-        existing_folders                         = None # to preserve memory
+        # find the simulations that have no folder yet with an anti join against the staged filepaths
+        folder_table = dtos.FolderNodeDTO.__table__
+        with staged_simulations(session, simulations) as staging:
+            missing_seqs = session.execute(
+                select(staging.c.seq).select_from(
+                    staging.outerjoin(folder_table, (folder_table.c.rootfolder_id == rootfolder_id) & (folder_table.c.path_key == staging.c.path_key))
+                ).where(folder_table.c.id.is_(None)).order_by(staging.c.seq)
+            ).scalars().all()
+        insert_simulations: list[dtos.FileInfo]  = [simulations[seq] for seq in missing_seqs]
+        missing_seqs = None # to preserve memory
+
+        # the scan runs in one unit of work (see db/unit_of_work.py): insert_simulations_in_db joins this session and commit() only
+        # flushes, so the new folders are committed together with the rest of the scan when the unit ends
+        session.commit()
 
         insertion_results: dict[str, int]   = insert_simulations_in_db(rootfolder, insert_simulations)
         insert_simulations = None
@@ -736,8 +1396,9 @@ def insert_or_update_simulation_in_db_internal(rootfolder_id: int, simulations:
             raise HTTPException(status_code=500, detail=f"Failed to insert some new paths: {insertion_results.get('failed_paths', [])}")
 
         update_results: dict[str, int] = update_simulation_attributes_in_db_internal(session, rootfolder, simulations)
+        refresh_retention_counts(session.connection(), rootfolder_id)
 
-        # Commit all changes
+        # flush all changes. The unit of work commits them
         session.commit()
 
         return {"message": f"For rootfolder {rootfolder_id}: inserted or changed simulations: {len(simulations)}"}
@@ -747,31 +1408,24 @@ def insert_or_update_simulation_in_db_internal(rootfolder_id: int, simulations:
 # The function is slow so before calling this function remove all simulation that does not provide new information. new simulation, new modified date, new retention
 # The update implements the attribute changes described in insert_or_update_simulation_in_db
 def update_simulation_attributes_in_db_internal(session: Session, rootfolder: dtos.RootFolderDTO, simulations: list[dtos.FileInfo]):
-    from datamodel.retentions import RetentionCalculator
+    from datamodel.retentions import RetentionCalculator, NO_RETENTION_ID, to_datetime64, from_datetime64
 
-    # retrieve the simulations in the rootfolder and ensure that the order is the same as in the simulations list 
+    # retrieve the simulations in the rootfolder in the same order as in the simulations list by joining with the staged 
+    # simulations and ordering by their position in the list. 
     # This is important for the subsequent update operation to maintain consistency.
-    lower_case_filepaths = [sim.filepath.lower() for sim in simulations]
-    # Replace the query + ordering block with:
-    rows = session.exec(
-        select(dtos.FolderNodeDTO).where(
-            (dtos.FolderNodeDTO.rootfolder_id == rootfolder.id) &
-            (func.lower(dtos.FolderNodeDTO.path).in_(lower_case_filepaths))
-        ) ).all()
-
-    # Execute the ordered query to get results in the same order as simulations
-    if len(rows) != len(simulations):
-        raise HTTPException(status_code=500, detail=f"Mismatch in existing folders ({len(rows)}) and simulations ({len(simulations)}) for rootfolder {rootfolder.id}")
+    folder_table = dtos.FolderNodeDTO.__table__
+    with staged_simulations(session, simulations) as staging:
+        existing_folders = session.execute(
+            select(staging.c.seq, folder_table.c.id, folder_table.c.path, folder_table.c.modified_date,
+                   folder_table.c.retention_id, folder_table.c.path_protection_id, folder_table.c.expiration_date).select_from(
+                staging.join(folder_table, (folder_table.c.rootfolder_id == rootfolder.id) & (folder_table.c.path_key == staging.c.path_key))
+            ).order_by(staging.c.seq)
+        ).all()
 
-    #order as simulations
-    existing_map = {f.path.lower(): f for f in rows}
-    try:
-        existing_folders = [existing_map[p] for p in lower_case_filepaths]
-    except KeyError:
-            raise HTTPException(status_code=500, detail="Mismatch in existing folders and simulations")
-    
-    #verify ordering as i am a little uncertain about the behaviour of the query
-    equals_ordering = all(folder.path.lower() == sim.filepath.lower() for folder, sim in zip(existing_folders, simulations))
+    # every simulation must have exactly one folder and the seq must follow the order of simulations
+    if len(existing_folders) != len(simulations):
+        raise HTTPException(status_code=500, detail=f"Mismatch in existing folders ({len(existing_folders)}) and simulations ({len(simulations)}) for rootfolder {rootfolder.id}")
+    equals_ordering = all(folder.seq == seq for seq, folder in enumerate(existing_folders))
     if not equals_ordering:
         raise HTTPException(status_code=500, detail=f"Ordering of existing folders does not match simulations for rootfolder {rootfolder.id}")
 
@@ -779,25 +1433,31 @@ def update_simulation_attributes_in_db_internal(session: Session, rootfolder: dt
     #Prepare calculation of retention: non-numeric including pathprotection and numeric dtos.  
     retention_calculator: RetentionCalculator = RetentionCalculator(rootfolder.id, rootfolder.cleanup_config_id, session)
 
-    # Prepare bulk update data for existing folders
-    bulk_updates = []
-    for db_folder, sim in zip(existing_folders, simulations):
-        # Calculate retention using consolidated logic in RetentionCalculator
-        new_retention, new_modified_date = retention_calculator.calculate_retention_from_scan(
-            db_retention=db_folder.get_retention(),
-            db_modified_date=db_folder.modified_date,
-            sim_external_retention=sim.external_retention,
-            sim_modified_date=sim.modified_date,
-            folder_path=db_folder.path
-        )
+    # Calculate retentions for the whole batch using the columnar version of RetentionCalculator.calculate_retention_from_scan
+    retention_ids, path_protection_ids, expiration_dates, modified_dates = retention_calculator.calculate_retentions_from_scan_batch(
+        db_retention_ids       = np.array([NO_RETENTION_ID if folder.retention_id is None else folder.retention_id for folder in existing_folders], dtype=np.int64),
+        db_path_protection_ids = np.array([folder.path_protection_id or 0 for folder in existing_folders], dtype=np.int64),
+        db_expiration_dates    = to_datetime64([folder.expiration_date for folder in existing_folders]),
+        db_modified_dates      = to_datetime64([folder.modified_date for folder in existing_folders]),
+        sim_external_retentions= [sim.external_retention for sim in simulations],
+        sim_modified_dates     = to_datetime64([sim.modified_date for sim in simulations]),
+        folder_paths           = [folder.path for folder in existing_folders]
+    )
 
-        bulk_updates.append({
+    # Prepare bulk update data for existing folders
+    change_version:int = next_change_version(session.connection(), rootfolder.id)
+    bulk_updates = [
+        {
             "id": db_folder.id,
-            "modified_date": new_modified_date,
-            "expiration_date": new_retention.expiration_date,
-            "retention_id": new_retention.retention_id,
-            "pathprotection_id": new_retention.path_protection_id
-        })
+            "modified_date": modified_date,
+            "expiration_date": expiration_date,
+            "retention_id": retention_id,
+            "path_protection_id": path_protection_id,
+            "change_version": change_version
+        }
+        for db_folder, retention_id, path_protection_id, expiration_date, modified_date in zip(
+            existing_folders, retention_ids.tolist(), path_protection_ids.tolist(), from_datetime64(expiration_dates), from_datetime64(modified_dates))
+    ]
     
     # Execute bulk update
     session.bulk_update_mappings(dtos.FolderNodeDTO, bulk_updates)
@@ -842,7 +1502,7 @@ def find_existing_node(session: Session, rootfolder_id: int, parent_id: int, nam
         select(dtos.FolderNodeDTO).where(
             (dtos.FolderNodeDTO.rootfolder_id == rootfolder_id) &
             (dtos.FolderNodeDTO.parent_id == parent_id) &
-            (func.lower(dtos.FolderNodeDTO.name) == name.lower())
+            (dtos.FolderNodeDTO.name_key == dtos.to_name_key(name))
         )
     ).first()
 
@@ -864,59 +1524,171 @@ def generate_path_ids(parent_path_ids: str, node_id: int) -> str:
     else:
         return f"{parent_path_ids}/{node_id}"
 
-#todo implement hierarchical inserts
+# Bulk hierarchical insert of the folder structure for all simulation filepaths.
+# This function only creates the folder structure, attributes will be updated separately.
+#   step 1: load the existing (parent_id, lower(name)) -> (id, path_ids) map for the rootfolder in one query
+#   step 2: walk all filepaths in memory and collect the missing nodes. Each missing node is only created once even if
+#           many simulations share it.
+#   step 3: insert the missing nodes level by level with one executemany pr level. The ids are returned by the insert
+#           so that the next level can reference its parents
+#   step 4: fill path_ids for the new nodes with one executemany update
+# The number of statements is therefore proportional to the depth of the tree and not to the number of path segments.
+# On PostgreSQL steps 3 and 4 are replaced by insert_new_nodes_by_copy: the ids are reserved from the sequence up front, so the
+# complete rows are copied into a staging table and inserted with one INSERT .. SELECT
+def insert_new_nodes_by_level(session: Session, rootfolder_id: int, change_version: int, new_nodes: list[dict], existing_path_ids: dict[int, str]) -> None:
+    # Step 3: insert level by level. The parents of a level are either existing or inserted in the previous level
+    new_ids: list[int]       = [0] * len(new_nodes)
+    new_path_ids: list[str]  = [""] * len(new_nodes)
+    levels: dict[int, list[int]] = {}
+    for i, node in enumerate(new_nodes):
+        levels.setdefault(node["depth"], []).append(i)
+
+    for depth in sorted(levels.keys()):
+        level_indices = levels[depth]
+        parents: list[tuple[int, str]] = []
+        rows: list[dict] = []
+        for i in level_indices:
+            node = new_nodes[i]
+            parent_ref = node["parent_ref"]
+            if parent_ref < 0:
+                parent = (new_ids[-parent_ref - 1], new_path_ids[-parent_ref - 1])
+            elif parent_ref == 0:
+                parent = (0, "0")
+            else:
+                parent = (parent_ref, existing_path_ids[parent_ref])
+            parents.append(parent)
+            rows.append({
+                "rootfolder_id": rootfolder_id,
+                "parent_id":     parent[0],
+                "name":          node["name"],
+                "name_key":      node["name_key"],
+                "path":          node["path"],
+                "path_key":      node["path_key"],
+                "path_ids":      "",
+                "nodetype_id":   node["nodetype_id"],
+                "retention_id":  0,
+                "path_protection_id": 0,
+                "change_version": change_version,
+            })
+
+        inserted_ids = session.execute(
+            insert(dtos.FolderNodeDTO).returning(dtos.FolderNodeDTO.id, sort_by_parameter_order=True), rows
+        ).scalars().all()
+        if len(inserted_ids) != len(rows):
+            raise HTTPException(status_code=500, detail=f"Failed to generate IDs for {len(rows) - len(inserted_ids)} new nodes")
+
+        for i, node_id, parent in zip(level_indices, inserted_ids, parents):
+            new_ids[i]      = node_id
+            new_path_ids[i] = generate_path_ids(parent[1], node_id)
+
+    # Step 4: path_ids can only be set once the ids are known
+    folder_table = dtos.FolderNodeDTO.__table__
+    session.connection().execute(
+        update(folder_table).where(folder_table.c.id == bindparam("node_id")).values(path_ids=bindparam("node_path_ids")),
+        [{"node_id": node_id, "node_path_ids": path_ids} for node_id, path_ids in zip(new_ids, new_path_ids)]
+    )
+
 def insert_simulations_in_db(rootfolder: dtos.RootFolderDTO, simulations: list[dtos.FileInfo]):
-    # Insert missing hierarchy for all simulation filepaths.
-    # This function only creates the folder structure, attributes will be updated separately.
     if not simulations:
-        return {"inserted_hierarchy_count": 0, "failed_path_count": 0, "failed_paths": []}
+        return {"inserted_hierarchy_count": 0, "inserted_node_count": 0, "failed_path_count": 0, "failed_paths": []}
 
-    #print(f"start insert_simulations rootfolder_id {rootfolder.id} inserting hierarchy for {len(simulations)} folders")
+    rootfolder_id = rootfolder.id
+    if rootfolder_id is None or rootfolder_id <= 0:
+        raise HTTPException(status_code=500, detail=f"Invalid rootfolder_id: {rootfolder_id}")
 
     nodetypes:dict[str,dtos.FolderTypeDTO] = read_folder_type_dict_pr_domain_id(rootfolder.simulationdomain_id)
-    #innernode_type_id =nodetypes.get(FolderTypeEnum.INNERNODE, None).id
-    #if not innernode_type_id:
-    #    raise HTTPException(status_code=500, detail=f"Unable to retrieve node_type_id=innernode for {rootfolder.id}")
-
-    with Session(Database.get_engine()) as session:
+    innernode_type_id:int  = nodetypes[dtos.FolderTypeEnum.INNERNODE].id
+    simulation_type_id:int = nodetypes[dtos.FolderTypeEnum.SIMULATION].id
+    rootfolder_head:str    = os.path.normpath(rootfolder.path)
+
+    with db_session(rootfolder_id=rootfolder_id) as session:
+        # Step 1: the existing tree. Keys are (parent_id, name_key) as in find_existing_node
+        existing_rows = session.exec(
+            select(dtos.FolderNodeDTO.id, dtos.FolderNodeDTO.parent_id, dtos.FolderNodeDTO.name_key, dtos.FolderNodeDTO.path_ids).where(
+                dtos.FolderNodeDTO.rootfolder_id == rootfolder_id
+            )
+        ).all()
+        existing_nodes: dict[tuple[int, str], tuple[int, str]] = {(parent_id, name_key): (id, path_ids) for id, parent_id, name_key, path_ids in existing_rows}
+        existing_path_ids: dict[int, str] = {id: path_ids for id, path_ids in existing_nodes.values()}
+        existing_rows = None # to preserve memory
+
+        # Step 2: collect missing nodes. A parent reference is either the id (>= 0) of an existing node
+        # or the negative index -(i+1) of a new node in new_nodes
+        new_nodes: list[dict] = []
+        new_node_keys: dict[tuple[int, str], int] = {}
         inserted_count = 0
         failed_paths = []
-        
+
         for sim in simulations:
             try:
-                # Insert hierarchy for this filepath (creates missing nodes)
-                leaf_node_id = insert_hierarchy_for_one_filepath(session, rootfolder, sim, nodetypes)
-                inserted_count += 1
-                
-            except Exception as e:
+                segments: list[str] = split_filepath_in_segments(rootfolder_head, sim.filepath)
+            except ValueError as e:
                 print(f"Error inserting hierarchy for path '{sim.filepath}': {e}")
                 failed_paths.append(sim.filepath)
-                # Continue with other paths rather than failing completely
                 continue
-        
+
+            parent_ref = 0
+            for index, segment in enumerate(segments):
+                key = (parent_ref, dtos.to_name_key(segment))
+                existing = existing_nodes.get(key) if parent_ref >= 0 else None
+                if existing is not None:
+                    parent_ref = existing[0]
+                    continue
+
+                new_index = new_node_keys.get(key)
+                if new_index is None:
+                    new_index = len(new_nodes)
+                    new_node_keys[key] = new_index
+                    path = "/".join(segments[:index + 1])
+                    new_nodes.append({
+                        "depth":       index,
+                        "parent_ref":  parent_ref,
+                        "name":        segment,
+                        "name_key":    key[1],
+                        "path":        path,
+                        "path_key":    dtos.to_path_key(path),
+                        "nodetype_id": simulation_type_id if index == len(segments) - 1 else innernode_type_id,
+                    })
+                parent_ref = -(new_index + 1)
+            inserted_count += 1
+
+        new_node_keys = None # to preserve memory
+
+        # Step 3 and 4: insert the new nodes with their path_ids
+        try:
+            change_version:int = next_change_version(session.connection(), rootfolder_id) if new_nodes else 0
+            if new_nodes and session.connection().dialect.name == "postgresql":
+                insert_new_nodes_by_copy(session.connection(), rootfolder_id, change_version, new_nodes, existing_path_ids)
+            elif new_nodes:
+                insert_new_nodes_by_level(session, rootfolder_id, change_version, new_nodes, existing_path_ids)
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Database error creating {len(new_nodes)} nodes: {str(e)}")
+
         # Commit all insertions
         session.commit()
-        count = session.exec(select(func.count()).select_from(dtos.FolderNodeDTO).where(dtos.FolderNodeDTO.rootfolder_id == rootfolder.id )).first()
-        #print(f"Total records in DB for rootfolder {rootfolder.id}: {count}")
-        #print(f"end insert_simulations rootfolder_id {rootfolder.id} - successfully inserted hierarchy for {inserted_count}/{len(simulations)} paths, {len(failed_paths)} failed")
-        
-    return {"inserted_hierarchy_count": inserted_count, "failed_path_count": len(failed_paths), "failed_paths": failed_paths}
 
+    return {"inserted_hierarchy_count": inserted_count, "inserted_node_count": len(new_nodes), "failed_path_count": len(failed_paths), "failed_paths": failed_paths}
+
+
+def split_filepath_in_segments(rootfolder_head: str, filepath: str) -> list[str]:
+    """
+    Split a simulation filepath into the segments of the folder hierarchy.
+    The first segment is always the rootfolder head (which may contain "/"). The rest are the folder names below it.
+
+    Args:
+        rootfolder_head: The normalized path of the rootfolder (os.path.normpath(rootfolder.path))
+        filepath: The filepath of the simulation
+
+    Returns:
+        List of segments. Raises ValueError if the filepath is not under the rootfolder
+    """
+    normalized:str = os.path.normpath(normalize_path(filepath).rstrip("/"))
 
-def insert_hierarchy_for_one_filepath(session: Session, rootfolder: dtos.RootFolderDTO, simulation: dtos.FileInfo, nodetypes:dict[str,dtos.FolderTypeDTO]) -> int:
-    #    Insert missing hierarchy for a single filepath and return the leaf node ID.
-    rootfolder_id = rootfolder.id
-    if rootfolder_id is None or rootfolder_id <= 0:
-        raise ValueError(f"Invalid rootfolder_id: {rootfolder_id}")
-    
- 
-    # Normalize path and split into segments
-    normalized:str = os.path.normpath(normalize_path(simulation.filepath).rstrip("/"))
-    rootfolder_head:str = os.path.normpath(rootfolder.path)
-    
     if not normalized.startswith(rootfolder_head)  :
-        raise ValueError(f"Filepath '{simulation.filepath}' does not start with rootfolder head '{rootfolder_head}'")
-    
+        raise ValueError(f"Filepath '{filepath}' does not start with rootfolder head '{rootfolder_head}'")
+
     # the first segment must be the rootfolder head. The rest can be split using "/"
     segments = [rootfolder_head]
     remaining_path = normalized[len(rootfolder_head):]
@@ -924,9 +1696,21 @@ def insert_hierarchy_for_one_filepath(session: Session, rootfolder: dtos.RootFol
         remaining_path = remaining_path[1:]  # Remove leading slash after rootfolder_head
     if remaining_path:
         segments.extend([segment for segment in remaining_path.split("/") if segment.strip()])
-    
+
     if not segments:
-        raise ValueError(f"Invalid or empty filepath: {simulation.filepath}")
+        raise ValueError(f"Invalid or empty filepath: {filepath}")
+    return segments
+
+
+def insert_hierarchy_for_one_filepath(session: Session, rootfolder: dtos.RootFolderDTO, simulation: dtos.FileInfo, nodetypes:dict[str,dtos.FolderTypeDTO]) -> int:
+    #    Insert missing hierarchy for a single filepath and return the leaf node ID.
+    rootfolder_id = rootfolder.id
+    if rootfolder_id is None or rootfolder_id <= 0:
+        raise ValueError(f"Invalid rootfolder_id: {rootfolder_id}")
+    
+ 
+    # Normalize path and split into segments
+    segments = split_filepath_in_segments(os.path.normpath(rootfolder.path), simulation.filepath)
     
     current_parent_id = 0  # Start from root level
     current_parent_path_ids = "0"
@@ -0,0 +1,164 @@
+import threading
+from datetime import datetime, timezone
+from itertools import chain
+from typing import Any, Callable, TypeVar
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from datamodel import dtos
+from db.database import Database
+from db.unit_of_work import UnitOfWork, outside_unit_of_work
+
+T = TypeVar("T")
+
+# Process-wide cache of the metadata that is read on every request and ingestion batch
+#   domain level:     retention types and folder types keyed by simulationdomain_id
+#   rootfolder level: the rootfolder's simulationdomain_id, path protections and cleanup configuration keyed by rootfolder_id
+# The cached values are shared between threads so they must be treated as read only.
+#
+# Entries are invalidated explicitly by the db_api functions that change them. As a safety net any commit that inserted, updated
+# or deleted a path protection, cleanup configuration, retention type, folder type, lead time or cleanup frequency invalidates the 
+# entries of its rootfolder or domain. A change of a simulation domain invalidates SIMULATION_DOMAINS_ID, the list of the domains.
+# Inside a write unit of work the explicit invalidations are also deferred to the commit of the unit, see db/unit_of_work.py
+#
+# The cache assumes that this process is the only writer of the database: it is only invalidated by the commits of this process, so
+# changes that another process commits would not be seen until the entry is invalidated here or the cache is cleared. 
+# The cache is therefore only used when the database is served by one process (Database.is_single_process, the SQLite backend). 
+# Otherwise get() loads every value and the http responses of the metadata use ETags of their content, see app/http_cache.py
+# Calculations that must see the caller's uncommitted changes read them from the caller's session, e.g. the cleanup configuration
+# of RetentionCalculator.
+#
+# Every invalidation gives the rootfolder or domain a new version: the generation and time of the invalidation. 
+# The versions are the ETag and Last-Modified of the http responses of the metadata, see app/http_cache.py
+class MetadataCache:
+    DOMAIN_RETENTION_TYPES       = "domain_retention_types"
+    DOMAIN_FOLDER_TYPES          = "domain_folder_types"
+    ROOTFOLDER_DOMAIN            = "rootfolder_domain"
+    ROOTFOLDER_PATH_PROTECTIONS  = "rootfolder_path_protections"
+    ROOTFOLDER_CLEANUP_CONFIG    = "rootfolder_cleanup_configuration"
+    domain_kinds     = (DOMAIN_RETENTION_TYPES, DOMAIN_FOLDER_TYPES)
+    rootfolder_kinds = (ROOTFOLDER_DOMAIN, ROOTFOLDER_PATH_PROTECTIONS, ROOTFOLDER_CLEANUP_CONFIG)
+    DOMAIN, ROOTFOLDER     = "domain", "rootfolder"
+    SIMULATION_DOMAINS_ID  = 0
+
+    _lock: threading.Lock = threading.Lock()
+    _entries: dict[tuple[str, int], Any] = {}
+    _generation: int = 0    # incremented by every invalidation so a load that raced with an invalidation is not stored
+    _versions: dict[tuple[str, int], tuple[int, datetime]] = {}   # (level, id) -> (generation, time) of the last invalidation
+    _cleared: tuple[int, datetime] = (0, datetime.now(timezone.utc))
+    hits: int   = 0
+    misses: int = 0
+
+    @classmethod
+    def is_enabled(cls) -> bool:
+        return Database.get_db().is_single_process
+
+    @classmethod
+    def get(cls, kind: str, id: int, load: Callable[[], T]) -> T:
+        """the cached value for (kind, id). On a miss the value is loaded with load() and cached unless load raises"""
+        if not cls.is_enabled():
+            with cls._lock:
+                cls.misses += 1
+            with outside_unit_of_work():
+                return load()
+        with cls._lock:
+            if (kind, id) in cls._entries:
+                cls.hits += 1
+                return cls._entries[(kind, id)]
+            cls.misses += 1
+            generation = cls._generation
+
+        # the load reads committed rows with its own session, never the uncommitted rows of the caller's unit of work
+        with outside_unit_of_work():
+            value = load()
+        with cls._lock:
+            if generation == cls._generation:
+                cls._entries[(kind, id)] = value
+        return value
+
+    @classmethod
+    def version(cls, level: str, id: int) -> tuple[int, datetime]:
+        """(generation, time) of the last invalidation of the rootfolder or domain, or of the last clear if it was not invalidated since"""
+        with cls._lock:
+            return cls._versions.get((level, id), cls._cleared)
+
+    @classmethod
+    def invalidate_rootfolder(cls, rootfolder_id: int) -> None:
+        cls._invalidate_or_defer(cls.ROOTFOLDER, rootfolder_id)
+
+    @classmethod
+    def invalidate_domain(cls, simulationdomain_id: int) -> None:
+        cls._invalidate_or_defer(cls.DOMAIN, simulationdomain_id)
+
+    @classmethod
+    def _invalidate_or_defer(cls, level: str, id: int) -> None:
+        # a load between an invalidation and the commit of the unit would cache the rows from before the change
+        unit: UnitOfWork | None = UnitOfWork.current()
+        if unit is not None and not unit.read_only:
+            unit.session.info.setdefault(_CHANGES_KEY, set()).add((level, id))
+        else:
+            cls._invalidate(level, cls.rootfolder_kinds if level == cls.ROOTFOLDER else cls.domain_kinds, id)
+
+    @classmethod
+    def _invalidate(cls, level: str, kinds: tuple[str, ...], id: int) -> None:
+        with cls._lock:
+            cls._generation += 1
+            cls._versions[(level, id)] = (cls._generation, datetime.now(timezone.utc))
+            for kind in kinds:
+                cls._entries.pop((kind, id), None)
+
+    @classmethod
+    def clear(cls) -> None:
+        """drop all entries. Used when the database is created or deleted"""
+        with cls._lock:
+            cls._generation += 1
+            cls._entries.clear()
+            cls._versions.clear()
+            cls._cleared = (cls._generation, datetime.now(timezone.utc))
+
+    @classmethod
+    def stats(cls) -> dict[str, int]:
+        with cls._lock:
+            return {"hits": cls.hits, "misses": cls.misses, "entries": len(cls._entries)}
+
+
+# collect the rootfolders and domains whose metadata was changed by a flush and invalidate them when the transaction commits
+# Jobs of a WriteQueue group run in savepoints of one session, so a savepoint keeps a copy of the changes from before it
+# and a rollback to the savepoint only discards the changes of its own job
+_CHANGES_KEY    = "metadata_cache_changes"
+_SAVEPOINTS_KEY = "metadata_cache_savepoints"
+
+@event.listens_for(Session, "after_flush")
+def _collect_metadata_changes(session: Session, flush_context) -> None:
+    changes: set[tuple[str, int]] = session.info.setdefault(_CHANGES_KEY, set())
+    for instance in chain(session.new, session.dirty, session.deleted):
+        if isinstance(instance, (dtos.PathProtectionDTO, dtos.CleanupConfigurationDTO)):
+            changes.add((MetadataCache.ROOTFOLDER, instance.rootfolder_id))
+        elif isinstance(instance, (dtos.RetentionTypeDTO, dtos.FolderTypeDTO, dtos.LeadTimeDTO, dtos.CleanupFrequencyDTO)):
+            changes.add((MetadataCache.DOMAIN, instance.simulationdomain_id))
+        elif isinstance(instance, dtos.SimulationDomainDTO):
+            changes.add((MetadataCache.DOMAIN, MetadataCache.SIMULATION_DOMAINS_ID))
+
+@event.listens_for(Session, "after_transaction_create")
+def _save_metadata_changes(session: Session, transaction) -> None:
+    if transaction.nested:
+        session.info.setdefault(_SAVEPOINTS_KEY, {})[transaction] = set(session.info.get(_CHANGES_KEY, ()))
+
+@event.listens_for(Session, "after_transaction_end")
+def _release_metadata_changes(session: Session, transaction) -> None:
+    if transaction.nested:
+        session.info.get(_SAVEPOINTS_KEY, {}).pop(transaction, None)
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_committed_metadata_changes(session: Session) -> None:
+    if session.in_nested_transaction():
+        return  # a released savepoint is committed with its transaction
+    for level, id in session.info.pop(_CHANGES_KEY, set()):
+        MetadataCache._invalidate(level, MetadataCache.rootfolder_kinds if level == MetadataCache.ROOTFOLDER else MetadataCache.domain_kinds, id)
+
+@event.listens_for(Session, "after_rollback")
+def _discard_metadata_changes(session: Session) -> None:
+    savepoint = session.get_nested_transaction()
+    if savepoint is not None:
+        session.info[_CHANGES_KEY] = session.info.get(_SAVEPOINTS_KEY, {}).pop(savepoint, set())
+    else:
+        session.info.pop(_CHANGES_KEY, None)
@@ -0,0 +1,100 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+from sqlmodel import Session
+from db.database import Database
+
+# A unit of work is one session, one connection and one transaction for a logical operation: a write job of the WriteQueue,
+# an agent step or a request that chains db_api calls. db_api and the cleanup modules get their sessions from db_session(),
+# which returns the session of the current unit, so the functions that an operation calls share the unit's transaction and
+# identity map: session.get() of a row that the unit has already loaded does not read it again.
+#   - commit() of a function inside the unit only flushes. The unit commits when it ends, or rolls back if it ends with an exception
+#   - a read-only unit uses the reader engine. db_session() for a write inside a read-only unit returns a new writer session
+#   - the unit is found through a context variable, so it follows the operation into the threadpool but not into the WriteQueue:
+#     write jobs run in the writer's own units, see db/write_queue.py
+#   - MetadataCache loads run outside the unit, so the process-wide cache never holds uncommitted rows
+#   - a unit that holds the SQLite write lock must not wait for another writer, e.g. a WriteQueue job. Units outside the writer
+#     thread should be read-only
+#   - a unit is bound to the database of its rootfolder, see Database.get_engine(rootfolder_id). db_session(rootfolder_id=...) returns
+#     the unit's session for the unit's database. A shard's session also reads the shared tables of the main database, but a write 
+#     to them or a session for another shard is a new session. In the single storage mode every unit is bound to the one database
+class UnitOfWorkSession(Session):
+    # the session of a unit of work. commit() flushes and commit_unit() commits
+    def commit(self) -> None:
+        self.flush()
+
+    def commit_unit(self) -> None:
+        super().commit()
+
+
+_current_unit: ContextVar[Optional["UnitOfWork"]] = ContextVar("unit_of_work", default=None)
+
+
+class UnitOfWork:
+    def __init__(self, read_only: bool = False, session: UnitOfWorkSession | None = None, rootfolder_id: int | None = None):
+        # a unit that is given a session uses it but leaves the commit and close to the owner of the session
+        self.read_only: bool = read_only
+        self.rootfolder_id: int | None = rootfolder_id     # the unit's database is the shard of the rootfolder, see Database.shard_id
+        self._session: UnitOfWorkSession | None = session
+        self._owns_session: bool = session is None
+        self._token = None
+        self.session_requests: int = 0      # db_session() calls served by the unit
+
+    @property
+    def session(self) -> UnitOfWorkSession:
+        # the connection is only checked out when the unit is used
+        if self._session is None:
+            engine = Database.get_read_engine(self.rootfolder_id) if self.read_only else Database.get_engine(self.rootfolder_id)
+            self._session = UnitOfWorkSession(engine, expire_on_commit=False)
+        return self._session
+
+    def __enter__(self) -> "UnitOfWork":
+        self._token = _current_unit.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        _current_unit.reset(self._token)
+        if not self._owns_session or self._session is None:
+            return
+        try:
+            if exc_type is None:
+                self._session.commit_unit()
+            else:
+                self._session.rollback()
+        finally:
+            self._session.close()
+            self._session = None
+
+    @staticmethod
+    def current() -> Optional["UnitOfWork"]:
+        return _current_unit.get()
+
+    def serves(self, read_only: bool, rootfolder_id: int | None) -> bool:
+        """can the unit's session be used for a session of the rootfolder's database"""
+        if not read_only and self.read_only:
+            return False
+        shard_id: int | None = Database.shard_id(rootfolder_id)
+        # a shard's connection reads the main database but cannot write it
+        return shard_id == Database.shard_id(self.rootfolder_id) or (shard_id is None and read_only)
+
+
+@contextmanager
+def db_session(read_only: bool = False, rootfolder_id: int | None = None) -> Iterator[Session]:
+    """the session of the current unit of work, or a new session of the writer or reader engine that is closed on exit.
+    Sessions that use the folder tables pass their rootfolder_id"""
+    unit: UnitOfWork | None = _current_unit.get()
+    if unit is not None and unit.serves(read_only, rootfolder_id):
+        unit.session_requests += 1
+        yield unit.session
+        return
+    with Session(Database.get_read_engine(rootfolder_id) if read_only else Database.get_engine(rootfolder_id)) as session:
+        yield session
+
+@contextmanager
+def outside_unit_of_work() -> Iterator[None]:
+    """db_session() opens its own sessions in the block"""
+    token = _current_unit.set(None)
+    try:
+        yield
+    finally:
+        _current_unit.reset(token)
@@ -0,0 +1,319 @@
+import asyncio
+import contextvars
+import functools
+import inspect
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Callable, TypeVar
+from sqlmodel import Session
+from db.database import Database
+from db.unit_of_work import UnitOfWork, UnitOfWorkSession, outside_unit_of_work
+
+T = TypeVar("T")
+
+# Single writer for the changes of the api, the agents and the scheduler. SQLite has one write lock, so writers that commit
+# from their own threads wait for each other in the busy timeout and a short change from the webclient can wait behind an agent.
+# Instead the writers submit jobs from any thread or coroutine and one writer thread runs them:
+#   session jobs, job(session): small writes that do not commit. Session jobs of the same priority that are queued together run in
+#                one transaction (BEGIN IMMEDIATE on SQLite) and are committed together. Each job runs in a savepoint so a job that
+#                raises only rolls back its own changes and only its caller gets the exception
+#   exclusive jobs, job(): writers that open their own sessions and commit themselves, e.g. ingestion and the cleanup agents.
+#                They run alone. Use the queued_write decorator for these
+# INTERACTIVE jobs (the webclient's changes) are taken before BULK jobs (agents and scheduler). A job is never interrupted, but long
+# bulk jobs that commit in chunks call yield_to_interactive() between the chunks to run the interactive jobs that are waiting.
+# Each priority has a lane per rootfolder, and the jobs of a priority are taken round-robin from the lanes, first in first out within
+# a lane, so the jobs of one rootfolder do not starve the others. Jobs without a rootfolder share the lane None.
+# There is a writer per database. In the sharded storage mode (see db/database.py) the jobs of a rootfolder run on the writer of its 
+# shard, so the scans, marks and cleans of different rootfolders write in parallel. Jobs without a rootfolder and jobs that only write 
+# the shared tables (main_database=True) run on the writer of the main database. A shard's job may wait for a job of the main database's 
+# writer, but the main database's writer never waits for a shard and a shard never waits for another shard, so the writers cannot deadlock.
+# In the single storage mode there is one writer
+# There is no wait for more jobs before a commit: the jobs that are queued while the writer is busy form the next group.
+# A job that submits a job from the writer thread runs it inline: in the group's transaction if it is a session job, otherwise directly.
+# The jobs run in units of work (see db/unit_of_work.py), never in the unit of their caller: a group is one unit so the db_api functions
+# that a session job calls join the group's transaction, and queued_write runs the function in its own unit unless unit_of_work=False
+# stats() has the queue depth, commits, jobs per commit, commit latency and time in the queue. See also GET /metrics
+@dataclass
+class WriteJob:
+    function: Callable
+    priority: int
+    is_exclusive: bool
+    rootfolder_id: int | None = None                 # the lane of the job
+    shard_id: int | None = None                      # the database of the job, see Database.shard_id. None is the main database
+    future: Future = field(default_factory=Future)
+    context: contextvars.Context = field(default_factory=contextvars.copy_context)   # e.g. the request metrics of the caller
+    queued_at: float = field(default_factory=time.perf_counter)
+
+
+class DatabaseWriter:
+    # the jobs and the thread of the writer of one database. The state is guarded by WriteQueue._lock
+    def __init__(self, shard_id: int | None):
+        self.shard_id: int | None = shard_id
+        self.not_empty: threading.Condition = threading.Condition(WriteQueue._lock)
+        self.lanes: dict[int, OrderedDict[int | None, deque[WriteJob]]] = {}   # priority -> rootfolder_id -> jobs. Only non-empty lanes
+        self.depth: int = 0
+        self.thread: threading.Thread | None = None
+
+
+class WriteQueue:
+    INTERACTIVE: int   = 0
+    BULK: int          = 1
+    MAX_GROUP_SIZE: int = 64
+
+    _lock: threading.Lock = threading.Lock()
+    _writers: dict[int | None, DatabaseWriter] = {}     # shard_id -> writer
+    _current: threading.local = threading.local()       # the writer of the writer threads
+    max_depth: int          = 0
+    commits: int            = 0
+    committed_jobs: int     = 0
+    failed_jobs: int        = 0
+    exclusive_jobs: int     = 0
+    commit_seconds: float   = 0.0
+    max_commit_seconds: float = 0.0
+    wait_seconds: float     = 0.0
+    max_wait_seconds: float = 0.0
+
+    @classmethod
+    def submit(cls, job: Callable[[Session], T], priority: int = BULK, rootfolder_id: int | None = None, main_database: bool = False) -> Future:
+        """queue the session job. The future gets its result after the commit, or the exception of the job or the commit.
+        The job runs on the writer of the rootfolder's database unless it only writes the shared tables of the main_database"""
+        return cls._submit(WriteJob(job, priority, is_exclusive=False, rootfolder_id=rootfolder_id, shard_id=cls._shard_id(rootfolder_id, main_database)))
+
+    @classmethod
+    def submit_exclusive(cls, job: Callable[[], T], priority: int = BULK, rootfolder_id: int | None = None, main_database: bool = False) -> Future:
+        """queue the exclusive job. The future gets its result or exception"""
+        return cls._submit(WriteJob(job, priority, is_exclusive=True, rootfolder_id=rootfolder_id, shard_id=cls._shard_id(rootfolder_id, main_database)))
+
+    @classmethod
+    def run(cls, job: Callable[[Session], T], priority: int = BULK, rootfolder_id: int | None = None, main_database: bool = False) -> T:
+        """run the session job on the writer thread of its database and wait for the commit"""
+        shard_id: int | None = cls._shard_id(rootfolder_id, main_database)
+        if cls._runs_inline(shard_id):
+            return cls._run_inline(job, shard_id)
+        return cls.submit(job, priority, rootfolder_id, main_database).result()
+
+    @classmethod
+    def run_exclusive(cls, job: Callable[[], T], priority: int = BULK, rootfolder_id: int | None = None, main_database: bool = False) -> T:
+        """run the exclusive job on the writer thread of its database and wait for it"""
+        if cls._runs_inline(cls._shard_id(rootfolder_id, main_database)):
+            return job()
+        return cls.submit_exclusive(job, priority, rootfolder_id, main_database).result()
+
+    @classmethod
+    async def run_async(cls, job: Callable[[Session], T], priority: int = INTERACTIVE, rootfolder_id: int | None = None, main_database: bool = False) -> T:
+        """run for coroutines: the event loop is not blocked while the job waits in the queue"""
+        return await asyncio.wrap_future(cls.submit(job, priority, rootfolder_id, main_database))
+
+    @classmethod
+    def is_writer_thread(cls) -> bool:
+        return getattr(cls._current, "writer", None) is not None
+
+    @classmethod
+    def yield_to_interactive(cls) -> None:
+        """run the interactive jobs that are waiting. Called by bulk jobs on the writer thread between chunks that have been committed"""
+        writer: DatabaseWriter | None = getattr(cls._current, "writer", None)
+        if writer is None or UnitOfWork.current() is not None:
+            return
+        while True:
+            group = cls._take_group(writer, max_priority=cls.INTERACTIVE)
+            if not group:
+                return
+            cls._run_group(writer, group)
+
+    @classmethod
+    def stats(cls) -> dict[str, int | float]:
+        with cls._lock:
+            lanes_by_priority = [(priority, lanes) for writer in cls._writers.values() for priority, lanes in writer.lanes.items()]
+            return {
+                "interactive_depth":  sum(len(jobs) for priority, lanes in lanes_by_priority if priority == cls.INTERACTIVE for jobs in lanes.values()),
+                "bulk_depth":         sum(len(jobs) for priority, lanes in lanes_by_priority if priority != cls.INTERACTIVE for jobs in lanes.values()),
+                "bulk_lanes":         sum(len(lanes) for priority, lanes in lanes_by_priority if priority != cls.INTERACTIVE),
+                "writers":            len(cls._writers),
+                "max_depth":          cls.max_depth,
+                "commits":            cls.commits,
+                "committed_jobs":     cls.committed_jobs,
+                "jobs_per_commit":    cls.committed_jobs / cls.commits if cls.commits else 0.0,
+                "failed_jobs":        cls.failed_jobs,
+                "exclusive_jobs":     cls.exclusive_jobs,
+                "commit_seconds":     cls.commit_seconds,
+                "max_commit_seconds": cls.max_commit_seconds,
+                "wait_seconds":       cls.wait_seconds,
+                "max_wait_seconds":   cls.max_wait_seconds,
+            }
+
+    @classmethod
+    def clear_stats(cls) -> None:
+        with cls._lock:
+            cls.max_depth = cls.commits = cls.committed_jobs = cls.failed_jobs = cls.exclusive_jobs = 0
+            cls.commit_seconds = cls.max_commit_seconds = cls.wait_seconds = cls.max_wait_seconds = 0.0
+
+    @staticmethod
+    def _shard_id(rootfolder_id: int | None, main_database: bool) -> int | None:
+        return None if main_database else Database.shard_id(rootfolder_id)
+
+    @classmethod
+    def _runs_inline(cls, shard_id: int | None) -> bool:
+        # a job for the writer's own database runs inline. Waiting for another writer is only allowed from a shard for the main database
+        writer: DatabaseWriter | None = getattr(cls._current, "writer", None)
+        if writer is None or writer.shard_id == shard_id:
+            return writer is not None
+        if shard_id is not None:
+            raise RuntimeError(f"the writer of {'the main database' if writer.shard_id is None else f'shard {writer.shard_id}'} "
+                               f"must not wait for the writer of shard {shard_id}")
+        return False
+
+    @classmethod
+    def _submit(cls, job: WriteJob) -> Future:
+        with cls._lock:
+            writer: DatabaseWriter | None = cls._writers.get(job.shard_id)
+            if writer is None:
+                writer = cls._writers[job.shard_id] = DatabaseWriter(job.shard_id)
+                name: str = "write-queue" if job.shard_id is None else f"write-queue-{job.shard_id}"
+                writer.thread = threading.Thread(target=cls._write_loop, args=(writer,), name=name, daemon=True)
+                writer.thread.start()
+            writer.lanes.setdefault(job.priority, OrderedDict()).setdefault(job.rootfolder_id, deque()).append(job)
+            writer.depth += 1
+            cls.max_depth = max(cls.max_depth, sum(writer.depth for writer in cls._writers.values()))
+            writer.not_empty.notify()
+        return job.future
+
+    @classmethod
+    def _run_inline(cls, job: Callable[[Session], T], shard_id: int | None) -> T:
+        unit: UnitOfWork | None = UnitOfWork.current()
+        if unit is not None and not unit.read_only:
+            with unit.session.begin_nested():
+                return job(unit.session)
+        with UnitOfWork(rootfolder_id=shard_id) as unit:
+            return job(unit.session)
+
+    @classmethod
+    def _write_loop(cls, writer: DatabaseWriter) -> None:
+        cls._current.writer = writer
+        while True:
+            with writer.not_empty:
+                while writer.depth == 0:
+                    writer.not_empty.wait()
+            cls._run_group(writer, cls._take_group(writer, max_priority=cls.BULK))
+
+    @classmethod
+    def _take_group(cls, writer: DatabaseWriter, max_priority: int) -> list[WriteJob]:
+        # the next job of the most urgent priority and, if it is a session job, the session jobs of the same priority that follow it
+        with cls._lock:
+            priorities: list[int] = sorted(priority for priority, lanes in writer.lanes.items() if lanes)
+            if not priorities or priorities[0] > max_priority:
+                return []
+            lanes: OrderedDict[int | None, deque[WriteJob]] = writer.lanes[priorities[0]]
+            group: list[WriteJob] = [cls._pop_next(writer, lanes)]
+            while (not group[0].is_exclusive and lanes and len(group) < cls.MAX_GROUP_SIZE and
+                   not next(iter(lanes.values()))[0].is_exclusive):
+                group.append(cls._pop_next(writer, lanes))
+            now: float = time.perf_counter()
+            for job in group:
+                cls.wait_seconds += now - job.queued_at
+                cls.max_wait_seconds = max(cls.max_wait_seconds, now - job.queued_at)
+        return group
+
+    @classmethod
+    def _pop_next(cls, writer: DatabaseWriter, lanes: OrderedDict[int | None, deque[WriteJob]]) -> WriteJob:
+        # the first job of the first lane. The lane moves to the end so the next job comes from the next rootfolder
+        rootfolder_id, jobs = next(iter(lanes.items()))
+        job: WriteJob = jobs.popleft()
+        if jobs:
+            lanes.move_to_end(rootfolder_id)
+        else:
+            del lanes[rootfolder_id]
+        writer.depth -= 1
+        return job
+
+    @classmethod
+    def _run_exclusive(cls, job: WriteJob) -> None:
+        try:
+            result = job.context.run(cls._run_outside_unit, job.function)
+        except BaseException as error:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
+        with cls._lock:
+            cls.exclusive_jobs += 1
+
+    @staticmethod
+    def _run_outside_unit(function: Callable[[], T]) -> T:
+        with outside_unit_of_work():
+            return function()
+
+    @staticmethod
+    def _run_in_unit(unit: UnitOfWork, function: Callable[[Session], T], session: Session) -> T:
+        with unit:
+            return function(session)
+
+    @classmethod
+    def _run_group(cls, writer: DatabaseWriter, group: list[WriteJob]) -> None:
+        if len(group) == 1 and group[0].is_exclusive:
+            cls._run_exclusive(group[0])
+            return
+
+        results: list[tuple[WriteJob, Any, BaseException | None]] = []
+        commit_seconds: float = 0.0
+        try:
+            with UnitOfWorkSession(Database.get_engine(writer.shard_id), expire_on_commit=False) as session:
+                connection = session.connection()
+                if connection.dialect.name == "sqlite":
+                    # take the write lock up front so the jobs do not fail halfway on a lock held by another process.
+                    # On a shard it is the shard's lock only, because the main database is attached read-only
+                    connection.exec_driver_sql("BEGIN IMMEDIATE")
+                unit = UnitOfWork(session=session, rootfolder_id=writer.shard_id)
+                for job in group:
+                    try:
+                        with session.begin_nested():
+                            results.append((job, job.context.run(cls._run_in_unit, unit, job.function, session), None))
+                    except Exception as error:
+                        results.append((job, None, error))
+                commit_start: float = time.perf_counter()
+                session.commit_unit()
+                commit_seconds = time.perf_counter() - commit_start
+        except BaseException as error:
+            # the transaction could not be started or committed so no job was written
+            results = [(job, None, error) for job in group]
+
+        for job, result, error in results:
+            if error is None:
+                job.future.set_result(result)
+            else:
+                job.future.set_exception(error)
+        failed: int = sum(1 for _, _, error in results if error is not None)
+        with cls._lock:
+            if failed < len(group):
+                cls.commits += 1
+                cls.committed_jobs += len(group) - failed
+                cls.commit_seconds += commit_seconds
+                cls.max_commit_seconds = max(cls.max_commit_seconds, commit_seconds)
+            cls.failed_jobs += failed
+
+
+def queued_write(priority: int = WriteQueue.BULK, unit_of_work: bool = True, main_database: bool = False):
+    """decorator that runs the function as an exclusive job of the WriteQueue, in one unit of work that is committed when the
+    function returns. Functions that commit in chunks, e.g. to yield_to_interactive() between them, use unit_of_work=False.
+    The function's rootfolder_id argument, if it has one, is the lane of the job and selects the database of the job unless the 
+    function only writes the shared tables of the main_database"""
+    def decorate(function: Callable[..., T]) -> Callable[..., T]:
+        signature: inspect.Signature = inspect.signature(function)
+        has_rootfolder_id: bool = "rootfolder_id" in signature.parameters
+
+        def run_in_unit(unit_rootfolder_id: int | None, *args, **kwargs) -> T:
+            unit: UnitOfWork | None = UnitOfWork.current()
+            if not unit_of_work or (unit is not None and not unit.read_only):
+                # called inline by a job on the writer thread: join its unit, if any
+                return function(*args, **kwargs)
+            with UnitOfWork(rootfolder_id=unit_rootfolder_id):
+                return function(*args, **kwargs)
+
+        @functools.wraps(function)
+        def run(*args, **kwargs) -> T:
+            rootfolder_id: int | None = signature.bind(*args, **kwargs).arguments.get("rootfolder_id") if has_rootfolder_id else None
+            unit_rootfolder_id: int | None = None if main_database else rootfolder_id
+            return WriteQueue.run_exclusive(lambda: run_in_unit(unit_rootfolder_id, *args, **kwargs), priority, rootfolder_id, main_database)
+        return run
+    return decorate
@@ -57,8 +57,10 @@ def generate_root_folder(session: Session, domain_id:int, owner:str, approvers:s
     cleanup_config.lead_time = cycle_time
     cleanup_config.frequency = frequency
     session.add(cleanup_config)
-    #session.refresh(cleanup_config) 
-    root_folder.folder_id = generate_folder_tree(session, root_folder.id, path, levels)
+    session.commit()
+    # the folders are written to the rootfolder's own database when the storage is sharded
+    with Session(Database.get_engine(root_folder.id)) as folder_session:
+        root_folder.folder_id = generate_folder_tree(folder_session, root_folder.id, path, levels)
     session.add(root_folder)
     #session.refresh(cleanup_config) 
     session.commit()
@@ -1,7 +1,11 @@
 import pytest
 from app.clock import SystemClock
-from sqlmodel import Session
+from sqlmodel import Session, select
 from db.database import Database
+from app.app_config import AppConfig
+from datamodel import dtos
+from datamodel.vts_create_meta_data import insert_vts_metadata_in_db
+from db import db_api
 
 
 lead_time:int=14
@@ -46,6 +50,38 @@ def test_session():
         Database._engine = None
 
 
+@pytest.fixture(scope="function")
+def rootfolder():
+    """Fresh unit test database with vts metadata and one empty rootfolder"""
+    AppConfig.set_test_mode(AppConfig.Mode.UNIT_TEST)
+    Database._instance = None
+    Database._engine = None
+
+    db = Database.get_db()
+    db.delete_db()
+    db.create_db_and_tables()
+    try:
+        with Session(db.get_engine()) as session:
+            insert_vts_metadata_in_db(session)
+            domain = session.exec(select(dtos.SimulationDomainDTO).where(dtos.SimulationDomainDTO.name == "vts")).first()
+            domain_id = domain.id
+
+        rootfolder = db_api.insert_rootfolder(dtos.RootFolderDTO(simulationdomain_id=domain_id, owner="jajac", approvers="stefw", path="/teams/root"))
+        with Session(db.get_engine()) as session:
+            rootfolder = session.get(dtos.RootFolderDTO, rootfolder.id)
+            cleanup_config = rootfolder.get_cleanup_configuration(session)
+            cleanup_config.lead_time = 14
+            cleanup_config.frequency = 7
+            session.add(cleanup_config)
+            session.commit()
+            session.refresh(rootfolder)
+        yield rootfolder
+    finally:
+        db.delete_db()
+        Database._instance = None
+        Database._engine = None
+
+
 @pytest.fixture(scope="function")
 def integration_session():
     # Create a SystemClock offset by more than cleanup configuration lead_time 
@@ -737,7 +737,7 @@ class TestCleanupWorkflows:
         # Verify that sim_changed_from_ui is not found in the reduced marked folders
         assert sim_changed_by_import_ui.id not in [folder.id for folder in reduced_marked_folders], f"sim_changed_by_import_ui (id={sim_changed_by_import_ui.id}, {sim_changed_by_import_ui.path}) should not be in the reduced marked folders"
 
-        pathprotected_folder_after_insert: FolderNodeDTO = db_api.read_folder(pathprotected_folder.id)
+        pathprotected_folder_after_insert: FolderNodeDTO = db_api.read_folder(rootfolder.id, pathprotected_folder.id)
         assert pathprotected_folder_after_insert.path_protection_id is not None, \
             f"pathprotected_folder_after_insert (id={pathprotected_folder.id}, {pathprotected_folder.path}) should still be path protected but pathprotection_id is None"
         assert pathprotected_folder.retention_id == pathprotected_folder_after_insert.retention_id, \
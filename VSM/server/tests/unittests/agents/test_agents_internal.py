@@ -0,0 +1,106 @@
+import random
+from datetime import datetime, timedelta
+import pytest
+from sqlmodel import Session, select
+from db.database import Database
+from db import db_api
+from datamodel import dtos
+from datamodel.dtos import FileInfo, FolderTypeEnum, ExternalRetentionTypes
+from datamodel.retentions import RetentionCalculator
+from cleanup import agents_internal
+from cleanup.agents_internal import AgentMarkSimulationsPreReview, AgentUnmarkSimulationsPostReview
+from tests.unittests.db.test_db_api import counted_retentions, materialized_retentions
+
+
+def set_cleanup_progress(rootfolder: dtos.RootFolderDTO, progress: dtos.CleanupProgress.Progress, start_date: datetime):
+    with Session(Database.get_engine()) as session:
+        cleanup_config = session.get(dtos.CleanupConfigurationDTO, rootfolder.cleanup_config_id)
+        cleanup_config.progress = progress.value
+        cleanup_config.start_date = start_date
+        session.add(cleanup_config)
+        session.commit()
+
+
+def randomize_simulations(rootfolder: dtos.RootFolderDTO, count: int, seed: int, start_date: datetime):
+    # insert simulations and give them random retentions, expiration dates and modified dates around start_date
+    rng = random.Random(seed)
+    paths = [f"/teams/root/p{i % 7}/sim{i}" for i in range(count)]
+    db_api.insert_or_update_simulations_in_db(rootfolder.id, [FileInfo(path, start_date, FolderTypeEnum.SIMULATION, ExternalRetentionTypes.NUMERIC) for path in paths])
+    retention_ids = [retention.id for retention in db_api.read_rootfolder_retentiontypes(rootfolder.id)]
+    with Session(Database.get_engine(rootfolder.id)) as session:
+        nodetype_leaf_id = db_api.read_folder_type_dict_pr_domain_id(rootfolder.simulationdomain_id)[FolderTypeEnum.SIMULATION].id
+        for folder in session.exec(select(dtos.FolderNodeDTO).where(dtos.FolderNodeDTO.nodetype_id == nodetype_leaf_id)).all():
+            folder.retention_id    = rng.choice(retention_ids)
+            folder.modified_date   = rng.choice([None, start_date - timedelta(days=rng.randint(0, 800), hours=rng.randint(0, 23), microseconds=rng.randint(0, 999999))])
+            folder.expiration_date = rng.choice([None, start_date + timedelta(days=rng.randint(-30, 1200), hours=rng.randint(0, 23), microseconds=rng.randint(0, 999999))])
+            if folder.modified_date is None and folder.expiration_date is None:
+                folder.expiration_date = start_date
+            session.add(folder)
+        session.commit()
+
+
+def expected_retentions(rootfolder: dtos.RootFolderDTO) -> dict[int, tuple]:
+    # the per simulation calculation that the set-based update must reproduce
+    db_api.apply_pathprotections(rootfolder.id)
+    with Session(Database.get_engine(rootfolder.id)) as session:
+        calculator = RetentionCalculator(rootfolder.id, rootfolder.cleanup_config_id, session)
+        nodetype_leaf_id = db_api.read_folder_type_dict_pr_domain_id(rootfolder.simulationdomain_id)[FolderTypeEnum.SIMULATION].id
+        expected = {}
+        for folder in session.exec(select(dtos.FolderNodeDTO).where(dtos.FolderNodeDTO.nodetype_id == nodetype_leaf_id)).all():
+            retention = calculator.adjust_from_cleanup_configuration_and_modified_date(folder.get_retention(), folder.modified_date)
+            expected[folder.id] = (retention.retention_id, retention.expiration_date)
+        return expected
+
+
+def actual_retentions(rootfolder: dtos.RootFolderDTO) -> dict[int, tuple]:
+    nodetype_leaf_id = db_api.read_folder_type_dict_pr_domain_id(rootfolder.simulationdomain_id)[FolderTypeEnum.SIMULATION].id
+    return {folder.id: (folder.retention_id, folder.expiration_date) for folder in db_api.read_folders(rootfolder.id) if folder.nodetype_id == nodetype_leaf_id}
+
+
+class TestSetBasedRetentionUpdates:
+
+    @pytest.mark.parametrize("progress", [dtos.CleanupProgress.Progress.MARKING_FOR_RETENTION_REVIEW, dtos.CleanupProgress.Progress.RETENTION_REVIEW])
+    def test_mark_simulations_is_equivalent_to_per_simulation_calculation(self, rootfolder, monkeypatch, progress):
+        monkeypatch.setattr(agents_internal, "FOLDER_UPDATE_CHUNK_SIZE", 50)
+        start_date = datetime(2025, 11, 19, 8, 30)
+        set_cleanup_progress(rootfolder, progress, start_date)
+        randomize_simulations(rootfolder, 300, seed=3, start_date=start_date)
+
+        expected = expected_retentions(rootfolder)
+        AgentMarkSimulationsPreReview.mark_simulations(rootfolder.id)
+
+        assert actual_retentions(rootfolder) == expected
+        assert materialized_retentions(rootfolder.id) == counted_retentions(rootfolder.id)
+
+        # marking again changes nothing so the change version does not advance
+        version = db_api.read_folder_changes(rootfolder.id, 0).version
+        AgentMarkSimulationsPreReview.mark_simulations(rootfolder.id)
+        assert db_api.read_folder_changes(rootfolder.id, version).folders == []
+        assert db_api.read_folder_changes(rootfolder.id, 0).version == version
+
+    def test_unmark_simulations_post_review(self, rootfolder, monkeypatch):
+        monkeypatch.setattr(agents_internal, "FOLDER_UPDATE_CHUNK_SIZE", 2)
+        set_cleanup_progress(rootfolder, dtos.CleanupProgress.Progress.UNMARKING_AFTER_REVIEW, datetime(2025, 11, 19))
+        paths = [f"/teams/root/sim{i}" for i in range(7)]
+        db_api.insert_or_update_simulations_in_db(rootfolder.id, [FileInfo(path, datetime(2025, 1, 1), FolderTypeEnum.SIMULATION, ExternalRetentionTypes.NUMERIC) for path in paths])
+        retention_types = db_api.read_rootfolder_retentiontypes_dict(rootfolder.id)
+
+        # mark every second simulation
+        nodes = {folder.path: folder for folder in db_api.read_folders(rootfolder.id)}
+        marked_ids = [nodes[path].id for path in paths[::2]]
+        with Session(Database.get_engine(rootfolder.id)) as session:
+            for id in marked_ids:
+                folder = session.get(dtos.FolderNodeDTO, id)
+                folder.retention_id = retention_types["marked"].id
+                session.add(folder)
+            session.commit()
+
+        version = db_api.read_folder_changes(rootfolder.id, 0).version
+        AgentUnmarkSimulationsPostReview.unmark_simulations_post_review(rootfolder.id)
+
+        assert db_api.read_folders_marked_for_cleanup(rootfolder.id) == []
+        assert sorted(folder.id for folder in db_api.read_folder_changes(rootfolder.id, version).folders) == sorted(marked_ids)
+        assert materialized_retentions(rootfolder.id) == counted_retentions(rootfolder.id)
+        folders = {folder.id: folder for folder in db_api.read_folders(rootfolder.id)}
+        assert all(folders[id].retention_id == retention_types["+7d(next)"].id for id in marked_ids)
+        assert folders[nodes[paths[1]].id].retention_id == nodes[paths[1]].retention_id
@@ -0,0 +1,78 @@
+import asyncio
+import json
+from datetime import datetime
+from fastapi.testclient import TestClient
+from app.web_api import app
+from app.metrics import RequestStats
+from db import db_api
+from datamodel import dtos
+from datamodel.dtos import FileInfo, FolderTypeEnum, ExternalRetentionTypes
+
+
+def insert_simulations(rootfolder: dtos.RootFolderDTO) -> None:
+    paths = [f"/teams/root/p{i}/sim{j}" for i in range(3) for j in range(2)]
+    db_api.insert_or_update_simulations_in_db(rootfolder.id, [FileInfo(path, datetime(2025, 1, 1), FolderTypeEnum.SIMULATION, ExternalRetentionTypes.NUMERIC) for path in paths])
+    db_api.add_pathprotection_by_paths(rootfolder.id, ["/teams/root/p0"])
+
+
+class TestRootFolderBootstrap:
+
+    def test_same_json_as_the_separate_endpoints(self, rootfolder):
+        insert_simulations(rootfolder)
+        client = TestClient(app)
+        response = client.get(f"/v1/rootfolders/{rootfolder.id}/bootstrap")
+        assert response.status_code == 200
+        bootstrap = response.json()
+        dtos.RootFolderBootstrapDTO.model_validate(bootstrap)
+
+        domain_url = f"/v1/simulationdomains/{rootfolder.simulationdomain_id}"
+        rootfolder_url = f"/v1/rootfolders/{rootfolder.id}"
+        assert bootstrap["rootfolder"] == dtos.RootFolderDTO.model_validate(rootfolder).model_dump(mode="json", by_alias=True)
+        assert bootstrap["simulationDomain"] == client.get("/v1/simulationdomains/vts").json()
+        assert bootstrap["cleanupConfiguration"] == client.get(f"{rootfolder_url}/cleanup_configuration").json()
+        assert bootstrap["retentionTypes"] == client.get(f"{rootfolder_url}/retentiontypes").json()
+        assert bootstrap["folderTypes"] == client.get(f"{domain_url}/foldertypes/").json()
+        assert bootstrap["leadTimes"] == client.get(f"{domain_url}/leadtimes/").json()
+        assert bootstrap["cleanupFrequencies"] == client.get(f"{domain_url}/cleanupfrequencies/").json()
+        assert bootstrap["pathProtections"] == client.get(f"{rootfolder_url}/pathprotections").json() != []
+        assert bootstrap["folders"] == sorted(client.get(f"{rootfolder_url}/folders/").json(), key=lambda folder: folder["id"])
+        assert bootstrap["changeVersion"] == client.get(f"{rootfolder_url}/folders/changes").json()["version"]
+
+    def test_folders_are_streamed_after_the_metadata(self, rootfolder, monkeypatch):
+        insert_simulations(rootfolder)
+        monkeypatch.setattr(db_api, "FOLDER_STREAM_PAGE_SIZE", 4)
+        async def read_chunks(response) -> list[bytes]:
+            return [chunk async for chunk in response.body_iterator]
+        chunks: list[bytes] = asyncio.run(read_chunks(db_api.read_rootfolder_bootstrap(rootfolder.id)))
+
+        folder_count: int = len(db_api.read_folders(rootfolder.id))
+        assert len(chunks) == 1 + (folder_count + 3) // 4 + 1
+        assert chunks[0].endswith(b'"folders":[')
+        assert [folder["id"] for folder in json.loads(b"".join(chunks))["folders"]] == sorted(folder.id for folder in db_api.read_folders(rootfolder.id))
+
+        # the read transaction has ended so the rootfolder can be written
+        db_api.add_pathprotection_by_paths(rootfolder.id, ["/teams/root/p1"])
+
+    def test_the_folders_are_read_as_the_stream_is_consumed(self, rootfolder, monkeypatch):
+        insert_simulations(rootfolder)
+        monkeypatch.setattr(db_api, "FOLDER_STREAM_PAGE_SIZE", 4)
+        stream = db_api.generate_bootstrap(rootfolder.id, {"changeVersion": 0})
+        assert next(stream) == b'{"changeVersion":0,"folders":['
+
+        query_count: int = RequestStats.query_count
+        first_page: bytes = next(stream)
+        assert len(json.loads(b"[" + first_page + b"]")) == 4
+        assert RequestStats.query_count == query_count + 1
+
+        # a folder that is inserted while the stream is consumed is in a later page
+        db_api.insert_or_update_simulations_in_db(rootfolder.id, [FileInfo("/teams/root/p9/sim0", datetime(2025, 1, 1), FolderTypeEnum.SIMULATION, ExternalRetentionTypes.NUMERIC)])
+        folders: list[dict] = json.loads(b'{"folders":[' + first_page + b"".join(stream))["folders"]
+        assert "/teams/root/p9/sim0" in [folder["path"] for folder in folders]
+
+    def test_rootfolder_without_folders(self, rootfolder):
+        bootstrap = TestClient(app).get(f"/v1/rootfolders/{rootfolder.id}/bootstrap").json()
+        assert bootstrap["folders"] == []
+        assert bootstrap["pathProtections"] == []
+
+    def test_unknown_rootfolder(self, rootfolder):
+        assert TestClient(app).get(f"/v1/rootfolders/{rootfolder.id + 100}/bootstrap").status_code == 404
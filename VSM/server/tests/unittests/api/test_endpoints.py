@@ -1,9 +1,14 @@
+import csv
+import io
+import numpy as np
 import pytest
+import zstandard
 from sqlmodel import Session
 from fastapi.testclient import TestClient
 from app.web_api import app
 from app.app_config import AppConfig
 from db.database import Database
+from db import db_api
 from datamodel.vts_create_meta_data import insert_vts_metadata_in_db
 from testdata.vts_generate_test_data import insert_minimal_test_data_for_unit_tests 
 
@@ -137,10 +142,157 @@ class TestFolderNodeAPI:
 
     def test_get_folder_nodes(self, client):
         # Test GET /v1/rootfolders/{rootfolder_id}/folders/ endpoint
-        response = client.get("/v1/rootfolders/1/folders/")  
+        response = client.get("/v1/rootfolders/1/folders/")
         assert response.status_code == 200
         assert response.headers["content-type"] == "application/json"
 
+    def test_get_subtree_summary_of_top_folder(self, client):
+        # Test GET /v1/rootfolders/{rootfolder_id}/folders/{folder_id}/summary endpoint for the top folder of the rootfolder
+        folders = client.get("/v1/rootfolders/1/folders/").json()
+        top_folder = next(folder for folder in folders if folder["parentId"] == 0)
+
+        response = client.get(f"/v1/rootfolders/1/folders/{top_folder['id']}/summary")
+        assert response.status_code == 200
+        summary = response.json()
+        assert summary["node_count"] == len(folders)
+        assert summary["simulation_count"] == sum(summary["simulations_by_retention"].values())
+
+        response = client.get(f"/v1/rootfolders/1/folders/{top_folder['id']}/ancestors")
+        assert response.status_code == 200
+        assert response.json() == []
+
+    def test_get_folder_changes(self, client):
+        # Test GET /v1/rootfolders/{rootfolder_id}/folders/changes?since= endpoint
+        folders = client.get("/v1/rootfolders/1/folders/").json()
+        snapshot = client.get("/v1/rootfolders/1/folders/changes?since=0").json()
+        assert snapshot["isFullSnapshot"]
+        assert sorted(folder["id"] for folder in snapshot["folders"]) == sorted(folder["id"] for folder in folders)
+
+        changes = client.get(f"/v1/rootfolders/1/folders/changes?since={snapshot['version']}").json()
+        assert changes == {"version": snapshot["version"], "isFullSnapshot": False, "folders": []}
+
+        # protecting a folder changes the simulations below it
+        top_folder = next(folder for folder in folders if folder["parentId"] == 0)
+        protected  = next(folder for folder in folders if folder["parentId"] == top_folder["id"])
+        response = client.post("/v1/rootfolders/1/pathprotection", json={"rootfolderId": 1, "folderId": protected["id"], "path": protected["path"]})
+        assert response.status_code == 200
+        changes = client.get(f"/v1/rootfolders/1/folders/changes?since={snapshot['version']}").json()
+        assert changes["version"] > snapshot["version"]
+        assert len(changes["folders"]) > 0
+        assert all(folder["path"].startswith(protected["path"] + "/") and folder["pathProtectionId"] == response.json()["id"] for folder in changes["folders"])
+
+        assert client.get("/v1/rootfolders/1/folders/changes?since=-1").status_code == 422
+        assert client.get("/v1/rootfolders/999/folders/changes").status_code == 404
+
+    def test_get_retention_counts(self, client):
+        # Test GET /v1/rootfolders/{rootfolder_id}/retention_counts endpoint against the folders
+        folders = client.get("/v1/rootfolders/1/folders/").json()
+        simulation_type_id = next(foldertype["id"] for foldertype in client.get("/v1/simulationdomains/1/foldertypes/").json() if foldertype["name"] == "simulation")
+        def expected_counts(folder: dict) -> dict[str, int]:
+            # a simulation counts in every ancestor listed in its path_ids
+            if folder["nodetypeId"] == simulation_type_id:
+                return {str(folder["retentionId"]): 1} if folder["retentionId"] else {}
+            expected: dict[str, int] = {}
+            for simulation in folders:
+                if simulation["nodetypeId"] == simulation_type_id and simulation["retentionId"] and str(folder["id"]) in simulation["pathIds"].split("/")[:-1]:
+                    expected[str(simulation["retentionId"])] = expected.get(str(simulation["retentionId"]), 0) + 1
+            return expected
+        folders_by_id = {folder["id"]: folder for folder in folders}
+
+        response = client.get("/v1/rootfolders/1/retention_counts")
+        assert response.status_code == 200
+        top = response.json()
+        assert [counts["folderId"] for counts in top] == [folder["id"] for folder in folders if folder["parentId"] == 0]
+        assert all(counts["retentionCounts"] == expected_counts(folders_by_id[counts["folderId"]]) for counts in top)
+
+        children = client.get(f"/v1/rootfolders/1/retention_counts?parent_id={top[0]['folderId']}").json()
+        assert sorted(counts["folderId"] for counts in children) == sorted(folder["id"] for folder in folders if folder["parentId"] == top[0]["folderId"])
+        assert any(counts["retentionCounts"] for counts in children)
+        assert all(counts["retentionCounts"] == expected_counts(folders_by_id[counts["folderId"]]) for counts in children)
+
+    def test_change_retentions_by_filter(self, client):
+        # Test POST /v1/rootfolders/{rootfolder_id}/retentions/by_filter. The expiration dates require a cleanup configuration
+        response = client.post("/v1/rootfolders/1/cleanup_configuration", json={"rootfolderId": 1, "leadTime": 14, "frequency": 7})
+        assert response.status_code == 200
+        retention_ids = {retention["name"]: retention["id"] for retention in client.get("/v1/rootfolders/1/retentiontypes").json()}
+        folders = client.get("/v1/rootfolders/1/folders/").json()
+        selected = [folder["id"] for folder in folders if folder["retentionId"] == retention_ids["+90d"] and not folder["pathProtectionId"]]
+
+        response = client.post("/v1/rootfolders/1/retentions/by_filter", json={"retentionId": retention_ids["issue"], "currentRetentionIds": [retention_ids["+90d"]]})
+        assert response.status_code == 200
+        assert response.json()["count"] == len(selected) > 0
+
+        changes = client.get(f"/v1/rootfolders/1/folders/changes?since={response.json()['changeVersion'] - 1}").json()
+        assert sorted(folder["id"] for folder in changes["folders"]) == sorted(selected)
+        assert all(folder["retentionId"] == retention_ids["issue"] and folder["expirationDate"] is None for folder in changes["folders"])
+
+        assert client.post("/v1/rootfolders/1/retentions/by_filter", json={"retentionId": retention_ids["path"]}).status_code == 400
+        assert client.post("/v1/rootfolders/99/retentions/by_filter", json={"retentionId": retention_ids["issue"]}).status_code == 404
+
+    def test_change_retentions_columnar(self, client):
+        # Test POST /v1/rootfolders/{rootfolder_id}/retentions/columnar with a packed binary body
+        assert client.post("/v1/rootfolders/1/cleanup_configuration", json={"rootfolderId": 1, "leadTime": 14, "frequency": 7}).status_code == 200
+        issue = next(retention["id"] for retention in client.get("/v1/rootfolders/1/retentiontypes").json() if retention["name"] == "issue")
+        folder_ids = [folder["id"] for folder in client.get("/v1/rootfolders/1/folders/").json() if folder["retentionId"] not in (0, issue)]
+
+        body = np.array([folder_ids, [issue] * len(folder_ids)], dtype="<i8").tobytes()
+        response = client.post("/v1/rootfolders/1/retentions/columnar", content=body, headers={"Content-Type": "application/octet-stream"})
+        assert response.status_code == 200
+        assert response.json()["count"] == len(folder_ids) > 0
+        assert all(folder["retentionId"] == issue for folder in client.get("/v1/rootfolders/1/folders/").json() if folder["id"] in folder_ids)
+
+        response = client.post("/v1/rootfolders/1/retentions/columnar", json={"folderIds": folder_ids[:1], "retentionIds": [issue]})
+        assert response.status_code == 200
+        assert response.json()["count"] == 0
+        assert client.post("/v1/rootfolders/1/retentions/columnar", content=b"1,1", headers={"Content-Type": "text/csv"}).status_code == 415
+
+    def test_folders_are_compressed_when_accepted(self, client):
+        # Test the compression middleware on GET /v1/rootfolders/{rootfolder_id}/folders/ and its stats in GET /v1/compression/stats
+        folders = client.get("/v1/rootfolders/1/folders/", headers={"Accept-Encoding": "identity"})
+        assert "content-encoding" not in folders.headers
+
+        with client.stream("GET", "/v1/rootfolders/1/folders/", headers={"Accept-Encoding": "zstd"}) as response:
+            assert response.headers["content-encoding"] == "zstd"
+            body = zstandard.ZstdDecompressor().decompressobj().decompress(b"".join(response.iter_raw()))
+        assert body == folders.content
+
+        stats = client.get("/v1/compression/stats").json()["/v1/rootfolders/{rootfolder_id}/folders/"]
+        assert stats["compressed_responses"] >= 1
+        assert stats["ratio"] > 1
+
+class TestFolderStreamAPI:
+    # Test the streamed csv of the folders of a rootfolder against the json of GET /v1/rootfolders/{rootfolder_id}/folders/
+
+    def expected_rows(self, client) -> list[dict[str, str]]:
+        columns = next(csv.reader(io.StringIO(client.get("/v1/rootfolders/1/folders/csv").text)))
+        folders = sorted(client.get("/v1/rootfolders/1/folders/").json(), key=lambda folder: folder["id"])
+        return [{column: "" if folder[column] is None else str(folder[column]) for column in columns} for folder in folders]
+
+    @pytest.mark.parametrize("page_size", [3, 10000])
+    def test_stream_folders_csv(self, client, monkeypatch, page_size):
+        monkeypatch.setattr(db_api, "FOLDER_STREAM_PAGE_SIZE", page_size)
+        response = client.get("/v1/rootfolders/1/folders/csv", headers={"Accept-Encoding": "identity"})
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/csv")
+        assert "content-encoding" not in response.headers
+
+        rows = list(csv.DictReader(io.StringIO(response.text)))
+        assert len(rows) > 3
+        assert rows == self.expected_rows(client)
+
+    def test_stream_folders_csv_zstd(self, client, monkeypatch):
+        monkeypatch.setattr(db_api, "FOLDER_STREAM_PAGE_SIZE", 3)
+        with client.stream("GET", "/v1/rootfolders/1/folders/csv", headers={"Accept-Encoding": "zstd"}) as response:
+            assert response.status_code == 200
+            assert response.headers["content-encoding"] == "zstd"
+            compressed = b"".join(response.iter_raw())
+
+        text = zstandard.ZstdDecompressor().decompressobj().decompress(compressed).decode("utf-8")
+        assert list(csv.DictReader(io.StringIO(text))) == self.expected_rows(client)
+
+    def test_stream_folders_csv_of_unknown_rootfolder(self, client):
+        assert client.get("/v1/rootfolders/999/folders/csv").status_code == 404
+
 class TestRootfolder_vs_FoldersNodeAPI:
     # Test API endpoints for FolderNode operations
     
@@ -0,0 +1,140 @@
+from datetime import datetime, timezone
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from starlette.datastructures import Headers
+from app.app_config import AppConfig
+from app.web_api import app
+from app.http_cache import is_not_modified
+from db import db_api
+from db.database import Database
+from datamodel import dtos
+from datamodel.dtos import FileInfo, FolderTypeEnum, ExternalRetentionTypes, SimulationDomainDTO, FolderTypeDTO, LeadTimeDTO, CleanupFrequencyDTO, CleanupConfigurationDTO
+from tests.unittests.db.test_metadata_cache import insert_protection_from_another_process
+
+
+# the endpoints as they were before the conditional responses: FastAPI serializes the dtos with the response_model
+legacy_app = FastAPI()
+
+@legacy_app.get("/v1/simulationdomains/", response_model=list[SimulationDomainDTO])
+def legacy_read_simulation_domains():
+    return db_api.read_simulation_domains()
+
+@legacy_app.get("/v1/simulationdomains/{domain_name}", response_model=SimulationDomainDTO)
+def legacy_read_simulation_domain_by_name(domain_name: str):
+    return db_api.read_simulation_domain_by_name(domain_name)
+
+@legacy_app.get("/v1/simulationdomains/{simulationdomain_id}/foldertypes/", response_model=list[FolderTypeDTO])
+def legacy_read_folder_types_pr_domain_id(simulationdomain_id: int):
+    return db_api.read_folder_types_pr_domain_id(simulationdomain_id)
+
+@legacy_app.get("/v1/simulationdomains/{simulationdomain_id}/leadtimes/", response_model=list[LeadTimeDTO])
+def legacy_read_cycle_time_by_domain_id(simulationdomain_id: int):
+    return db_api.read_cycle_time_by_domain_id(simulationdomain_id)
+
+@legacy_app.get("/v1/simulationdomains/{simulationdomain_id}/cleanupfrequencies/", response_model=list[CleanupFrequencyDTO])
+def legacy_read_frequency_by_domain_id(simulationdomain_id: int):
+    return db_api.read_frequency_by_domain_id(simulationdomain_id)
+
+@legacy_app.get("/v1/rootfolders/{rootfolder_id}/cleanup_configuration", response_model=CleanupConfigurationDTO)
+def legacy_read_rootfolder_cleanup_configuration(rootfolder_id: int):
+    return db_api.get_cleanup_configuration_by_rootfolder_id(rootfolder_id)
+
+
+def metadata_urls(rootfolder: dtos.RootFolderDTO) -> list[str]:
+    domain_id: int = rootfolder.simulationdomain_id
+    return ["/v1/simulationdomains/", "/v1/simulationdomains/vts",
+            f"/v1/simulationdomains/{domain_id}/retentiontypes/", f"/v1/simulationdomains/{domain_id}/foldertypes/",
+            f"/v1/simulationdomains/{domain_id}/leadtimes/", f"/v1/simulationdomains/{domain_id}/cleanupfrequencies/",
+            f"/v1/rootfolders/{rootfolder.id}/retentiontypes", f"/v1/rootfolders/{rootfolder.id}/cleanup_configuration",
+            f"/v1/rootfolders/{rootfolder.id}/pathprotections"]
+
+
+class TestConditionalRequests:
+
+    def test_same_json_as_the_response_model(self, rootfolder):
+        # the retention types and path protections are compared in test_json_responses
+        client, legacy_client = TestClient(app), TestClient(legacy_app)
+        client.post(f"/v1/rootfolders/{rootfolder.id}/cleanup_configuration", json={"rootfolderId": rootfolder.id, "leadTime": 30, "frequency": 7, "startDate": "2025-03-01T08:30:00Z"})
+        for url in metadata_urls(rootfolder):
+            if "retentiontypes" not in url and "pathprotections" not in url:
+                assert client.get(url).json() == legacy_client.get(url).json(), url
+
+    @pytest.mark.skipif(AppConfig.get_db_backend() != "sqlite", reason="the metadata cache is only used by a single server process")
+    def test_unchanged_metadata_is_not_modified(self, rootfolder):
+        client = TestClient(app)
+        for url in metadata_urls(rootfolder):
+            response = client.get(url)
+            assert response.status_code == 200, url
+            assert response.headers["etag"].startswith('W/"')
+            assert response.headers["cache-control"] == "no-cache"
+
+            not_modified = client.get(url, headers={"If-None-Match": response.headers["etag"]})
+            assert not_modified.status_code == 304, url
+            assert not_modified.content == b""
+            assert not_modified.headers["etag"] == response.headers["etag"]
+            assert not_modified.headers["x-db-query-count"] == "0"
+
+            assert client.get(url, headers={"If-Modified-Since": response.headers["last-modified"]}).status_code == 304
+            assert client.get(url, headers={"If-None-Match": 'W/"other"'}).status_code == 200
+
+    def test_changes_give_new_etags(self, rootfolder):
+        db_api.insert_or_update_simulations_in_db(rootfolder.id, [FileInfo("/teams/root/p0/sim", datetime(2025, 1, 1), FolderTypeEnum.SIMULATION, ExternalRetentionTypes.NUMERIC)])
+        client = TestClient(app)
+        protections_url = f"/v1/rootfolders/{rootfolder.id}/pathprotections"
+        config_url = f"/v1/rootfolders/{rootfolder.id}/cleanup_configuration"
+        etags = {url: client.get(url).headers["etag"] for url in metadata_urls(rootfolder)}
+
+        db_api.add_pathprotection_by_paths(rootfolder.id, ["/teams/root/p0"])
+        response = client.get(protections_url, headers={"If-None-Match": etags[protections_url]})
+        assert response.status_code == 200
+        assert [protection["path"] for protection in response.json()] == ["/teams/root/p0"]
+        assert client.get(protections_url, headers={"If-None-Match": response.headers["etag"]}).status_code == 304
+
+        client.post(config_url, json={"rootfolderId": rootfolder.id, "leadTime": 30, "frequency": 7})
+        response = client.get(config_url, headers={"If-None-Match": etags[config_url]})
+        assert response.status_code == 200
+        assert response.json()["leadTime"] == 30
+
+        # the domain's metadata did not change
+        domain_url = f"/v1/simulationdomains/{rootfolder.simulationdomain_id}/retentiontypes/"
+        assert client.get(domain_url, headers={"If-None-Match": etags[domain_url]}).status_code == 304
+
+    def test_etags_of_the_content_when_other_processes_share_the_database(self, rootfolder, monkeypatch):
+        monkeypatch.setattr(Database.get_db(), "is_single_process", False)
+        db_api.insert_or_update_simulations_in_db(rootfolder.id, [FileInfo(f"/teams/root/p{i}/sim", datetime(2025, 1, 1), FolderTypeEnum.SIMULATION, ExternalRetentionTypes.NUMERIC) for i in range(2)])
+        db_api.add_pathprotection_by_paths(rootfolder.id, ["/teams/root/p0"])
+        client = TestClient(app)
+        protections_url = f"/v1/rootfolders/{rootfolder.id}/pathprotections"
+        response = client.get(protections_url)
+        assert "last-modified" not in response.headers
+        assert client.get(protections_url, headers={"If-None-Match": response.headers["etag"]}).status_code == 304
+
+        insert_protection_from_another_process(rootfolder.id, "/teams/root/p1")
+        changed = client.get(protections_url, headers={"If-None-Match": response.headers["etag"]})
+        assert changed.status_code == 200
+        assert sorted(protection["path"] for protection in changed.json()) == ["/teams/root/p0", "/teams/root/p1"]
+
+    def test_unknown_ids(self, rootfolder):
+        client = TestClient(app)
+        assert client.get("/v1/simulationdomains/unknown").status_code == 404
+        assert client.get(f"/v1/rootfolders/{rootfolder.id + 100}/retentiontypes").status_code == 404
+        assert client.get(f"/v1/simulationdomains/{rootfolder.simulationdomain_id + 100}/leadtimes/").status_code == 404
+
+
+class TestIsNotModified:
+    last_modified = datetime(2026, 1, 2, 3, 4, 5, 678000, tzinfo=timezone.utc)
+
+    @pytest.mark.parametrize("headers, not_modified", [
+        ({"if-none-match": 'W/"abc-1"'}, True),
+        ({"if-none-match": '"abc-1"'}, True),
+        ({"if-none-match": 'W/"abc-0", W/"abc-1"'}, True),
+        ({"if-none-match": "*"}, True),
+        ({"if-none-match": 'W/"abc-2"'}, False),
+        ({"if-none-match": 'W/"abc-2"', "if-modified-since": "Fri, 02 Jan 2026 03:04:05 GMT"}, False),
+        ({"if-modified-since": "Fri, 02 Jan 2026 03:04:05 GMT"}, True),
+        ({"if-modified-since": "Fri, 02 Jan 2026 03:04:04 GMT"}, False),
+        ({"if-modified-since": "not a date"}, False),
+        ({}, False)])
+    def test_is_not_modified(self, headers, not_modified):
+        assert is_not_modified(Headers(headers), '"abc-1"', self.last_modified) == not_modified
@@ -0,0 +1,101 @@
+import json
+import os
+import time
+from datetime import datetime, timedelta
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import insert
+from sqlmodel import Session
+from app.web_api import app
+from db.database import Database
+from db import db_api
+from datamodel import dtos
+from datamodel.dtos import FileInfo, FolderTypeEnum, ExternalRetentionTypes, FolderNodeDTO, RetentionTypeDTO, PathProtectionDTO
+
+
+# the endpoints as they were before the fast json responses: FastAPI validates and serializes the list with the response_model
+legacy_app = FastAPI()
+
+@legacy_app.get("/v1/rootfolders/{rootfolder_id}/folders/", response_model=list[FolderNodeDTO])
+def legacy_read_folders(rootfolder_id: int):
+    return db_api.read_folders(rootfolder_id)
+
+@legacy_app.get("/v1/rootfolders/{rootfolder_id}/folders/{folder_id}/simulations", response_model=list[FolderNodeDTO])
+def legacy_read_simulations_in_subtree(rootfolder_id: int, folder_id: int):
+    return db_api.read_simulations_in_subtree(rootfolder_id, folder_id)
+
+@legacy_app.get("/v1/rootfolders/{rootfolder_id}/retentiontypes", response_model=list[RetentionTypeDTO])
+def legacy_read_rootfolder_retentiontypes(rootfolder_id: int):
+    return db_api.read_rootfolder_retentiontypes(rootfolder_id)
+
+@legacy_app.get("/v1/simulationdomains/{simulationdomain_id}/retentiontypes/", response_model=list[RetentionTypeDTO])
+def legacy_read_retentiontypes_by_domain_id(simulationdomain_id: int):
+    return db_api.read_retentiontypes_by_domain_id(simulationdomain_id)
+
+@legacy_app.get("/v1/rootfolders/{rootfolder_id}/pathprotections", response_model=list[PathProtectionDTO])
+def legacy_read_pathprotections(rootfolder_id: int):
+    return db_api.read_pathprotections(rootfolder_id)
+
+
+def insert_flat_simulations(rootfolder: dtos.RootFolderDTO, count: int) -> int:
+    # count simulations directly under the top folder inserted with Core. Returns the id of the top folder
+    db_api.insert_or_update_simulations_in_db(rootfolder.id, [FileInfo("/teams/root/sim", datetime(2025, 1, 1), FolderTypeEnum.SIMULATION, ExternalRetentionTypes.NUMERIC)])
+    top = next(folder for folder in db_api.read_folders(rootfolder.id) if folder.parent_id == 0)
+    simulation_type_id = db_api.read_folder_type_dict_pr_domain_id(rootfolder.simulationdomain_id)[FolderTypeEnum.SIMULATION].id
+    retention_ids = [retention.id for retention in db_api.read_rootfolder_retentiontypes(rootfolder.id)]
+    with Session(Database.get_engine(rootfolder.id)) as session:
+        for chunk_start in range(0, count, 50000):
+            session.connection().execute(insert(FolderNodeDTO.__table__), [{
+                "rootfolder_id": rootfolder.id, "parent_id": top.id, "name": f"sim{i}", "name_key": f"sim{i}",
+                "path": f"/teams/root/sim{i}", "path_key": f"/teams/root/sim{i}", "path_ids": f"{top.path_ids}/0",
+                "nodetype_id": simulation_type_id, "retention_id": retention_ids[i % len(retention_ids)], "path_protection_id": 0,
+                "modified_date": datetime(2025, 1, 1) + timedelta(seconds=i, microseconds=i % 7),
+                "expiration_date": None if i % 3 == 0 else datetime(2026, 1, 1) + timedelta(minutes=i)}
+                for i in range(chunk_start, min(count, chunk_start + 50000))])
+        session.commit()
+    return top.id
+
+
+def list_urls(rootfolder: dtos.RootFolderDTO, top_id: int) -> list[str]:
+    return [f"/v1/rootfolders/{rootfolder.id}/folders/",
+            f"/v1/rootfolders/{rootfolder.id}/folders/{top_id}/simulations",
+            f"/v1/rootfolders/{rootfolder.id}/retentiontypes",
+            f"/v1/simulationdomains/{rootfolder.simulationdomain_id}/retentiontypes/",
+            f"/v1/rootfolders/{rootfolder.id}/pathprotections"]
+
+
+class TestJsonResponses:
+
+    def test_same_json_as_the_response_model(self, rootfolder):
+        top_id = insert_flat_simulations(rootfolder, 50)
+        db_api.add_pathprotection_by_paths(rootfolder.id, ["/teams/root/sim7", "/teams/root/sim8"])
+        client, legacy_client = TestClient(app), TestClient(legacy_app)
+        for url in list_urls(rootfolder, top_id):
+            response, legacy_response = client.get(url), legacy_client.get(url)
+            assert response.status_code == 200
+            assert response.headers["content-type"] == "application/json"
+            assert response.json() == legacy_response.json() != []
+
+    def test_unknown_subtree(self, rootfolder):
+        assert TestClient(app).get(f"/v1/rootfolders/{rootfolder.id}/folders/10000/simulations").status_code == 404
+
+    @pytest.mark.benchmark
+    # 10k: 0.48s vs 0.10s, 100k: 4.0s vs 0.70s, 1M: 28.4s vs 7.4s. The 1M run takes minutes so it only runs with VSM_BENCHMARK_1M set
+    @pytest.mark.parametrize("count", [10_000, 100_000, pytest.param(1_000_000, marks=pytest.mark.skipif("VSM_BENCHMARK_1M" not in os.environ, reason="set VSM_BENCHMARK_1M to run"))])
+    def test_benchmark_against_response_model(self, rootfolder, count):
+        insert_flat_simulations(rootfolder, count)
+        url = f"/v1/rootfolders/{rootfolder.id}/folders/"
+
+        seconds: dict[str, float] = {}
+        bodies: dict[str, list] = {}
+        for name, client in [("response_model", TestClient(legacy_app)), ("fast json", TestClient(app))]:
+            start = time.perf_counter()
+            response = client.get(url)
+            seconds[name] = time.perf_counter() - start
+            bodies[name] = json.loads(response.content)
+
+        print(f"\nGET {count + 2} folders: response_model {seconds['response_model']:.3f}s, fast json {seconds['fast json']:.3f}s "
+              f"({seconds['response_model'] / seconds['fast json']:.1f}x)")
+        assert bodies["fast json"] == bodies["response_model"]
+        assert seconds["fast json"] * 2 < seconds["response_model"]
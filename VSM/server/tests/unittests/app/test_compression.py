@@ -0,0 +1,114 @@
+"""Unit tests for the response compression middleware."""
+import asyncio
+import gzip
+import json
+import pytest
+import zstandard
+from fastapi import FastAPI
+from fastapi.responses import Response, StreamingResponse
+from fastapi.testclient import TestClient
+from app.compression import CompressionMiddleware, CompressionStats, negotiate_encoding, COMPRESSION_MINIMUM_SIZE
+
+LARGE_BODY: bytes = json.dumps([{"id": i, "path": f"/teams/root/sim{i}"} for i in range(500)]).encode()
+CHUNKS: list[bytes] = [f"{i},/teams/root/sim{i}\n".encode() * 200 for i in range(5)]
+
+test_app = FastAPI()
+test_app.add_middleware(CompressionMiddleware)
+
+@test_app.get("/items/{item_id}")
+def read_item(item_id: int):
+    return Response(content=LARGE_BODY, media_type="application/json")
+
+@test_app.get("/small")
+def read_small():
+    return {"id": 1}
+
+@test_app.get("/stream")
+def read_stream():
+    return StreamingResponse(iter(CHUNKS), media_type="text/csv")
+
+@test_app.get("/encoded")
+def read_encoded():
+    return Response(content=zstandard.compress(LARGE_BODY), media_type="application/json", headers={"Content-Encoding": "zstd"})
+
+
+def zstd_decompress(body: bytes) -> bytes:
+    # the streamed frames have no content size in the header so zstandard.decompress cannot be used
+    return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+
+
+def get(url: str, accept_encoding: str):
+    # httpx decodes gzip itself, so the raw bytes are read from the stream
+    with TestClient(test_app).stream("GET", url, headers={"Accept-Encoding": accept_encoding}) as response:
+        return response, b"".join(response.iter_raw())
+
+
+class TestNegotiation:
+
+    @pytest.mark.parametrize("accept_encoding, encoding", [
+        ("gzip, deflate, br, zstd", "zstd"),
+        ("gzip", "gzip"),
+        ("zstd;q=0, gzip;q=0.5", "gzip"),
+        ("*", "zstd"),
+        ("*, zstd;q=0", "gzip"),
+        ("identity", None),
+        ("", None)])
+    def test_negotiate_encoding(self, accept_encoding, encoding):
+        assert negotiate_encoding(accept_encoding) == encoding
+
+
+class TestCompressionMiddleware:
+
+    def setup_method(self):
+        CompressionStats.clear()
+
+    @pytest.mark.parametrize("accept_encoding, decompress", [("zstd", zstd_decompress), ("gzip", gzip.decompress)])
+    def test_large_responses_are_compressed(self, accept_encoding, decompress):
+        response, body = get("/items/1", accept_encoding)
+        assert response.headers["content-encoding"] == accept_encoding
+        assert "accept-encoding" in response.headers["vary"].lower()
+        assert "content-length" not in response.headers
+        assert decompress(body) == LARGE_BODY
+        assert len(body) < len(LARGE_BODY)
+
+    def test_small_and_not_accepted_responses_are_not_compressed(self):
+        assert len(json.dumps({"id": 1})) < COMPRESSION_MINIMUM_SIZE
+        response, body = get("/small", "zstd")
+        assert "content-encoding" not in response.headers
+        assert json.loads(body) == {"id": 1}
+
+        response, body = get("/items/1", "identity")
+        assert "content-encoding" not in response.headers
+        assert body == LARGE_BODY
+
+    def test_encoded_responses_are_passed_through(self):
+        response, body = get("/encoded", "gzip, zstd")
+        assert response.headers["content-encoding"] == "zstd"
+        assert zstd_decompress(body) == LARGE_BODY
+
+    def test_streamed_responses_are_compressed_message_by_message(self):
+        # call the app directly to see the messages: every body message is sent on compressed and can be decoded on arrival
+        messages = []
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+        async def send(message):
+            messages.append(message)
+        scope = {"type": "http", "asgi": {"version": "3.0", "spec_version": "2.4"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+                 "path": "/stream", "raw_path": b"/stream", "root_path": "", "query_string": b"", "headers": [(b"accept-encoding", b"zstd")],
+                 "server": ("testserver", 80), "client": ("testclient", 50000)}
+        asyncio.run(test_app(scope, receive, send))
+
+        bodies = [message["body"] for message in messages if message["type"] == "http.response.body"]
+        assert len(bodies) == len(CHUNKS) + 1    # the last message ends the stream
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+        assert [decompressor.decompress(body) for body in bodies] == CHUNKS + [b""]
+
+    def test_stats_per_endpoint(self):
+        get("/items/1", "zstd")
+        get("/items/2", "gzip")
+        get("/small", "zstd")
+        stats = CompressionStats.stats()
+        assert stats["/items/{item_id}"]["responses"] == stats["/items/{item_id}"]["compressed_responses"] == 2
+        assert stats["/items/{item_id}"]["bytes_in"] == 2 * len(LARGE_BODY)
+        assert stats["/items/{item_id}"]["ratio"] > 1
+        assert stats["/small"]["compressed_responses"] == 0
@@ -0,0 +1,82 @@
+"""Unit tests for the request metrics middleware and GET /metrics."""
+import re
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+from app.app_config import AppConfig
+from db.database import Database
+from app.web_api import app
+from app.metrics import RequestStats, RequestMetrics, LATENCY_BUCKETS, escape_label
+
+
+def sample(text: str, name: str, **labels: str) -> float:
+    # the value of the sample with exactly these labels
+    label_text = ",".join(f'{key}="{value}"' for key, value in labels.items())
+    match = re.search(rf"^{re.escape(name)}{re.escape('{' + label_text + '}' if label_text else '')} (\S+)$", text, re.MULTILINE)
+    assert match, f"{name}{{{label_text}}} not found"
+    return float(match.group(1))
+
+
+class TestRequestMetrics:
+
+    def setup_method(self):
+        RequestStats.clear()
+
+    def test_query_count_and_db_time_headers(self, rootfolder):
+        client = TestClient(app)
+        url = f"/v1/rootfolders/{rootfolder.id}/folders/"
+        response = client.get(url)
+        assert int(response.headers["x-db-query-count"]) >= 1
+        assert re.fullmatch(r'db;dur=\d+\.\d;desc="\d+ queries"', response.headers["server-timing"])
+
+    @pytest.mark.skipif(AppConfig.get_db_backend() != "sqlite", reason="the metadata cache is only used by a single server process")
+    def test_cached_metadata_runs_no_queries(self, rootfolder):
+        # the retention types are served from the metadata cache the second time
+        client = TestClient(app)
+        client.get(f"/v1/rootfolders/{rootfolder.id}/retentiontypes")
+        assert client.get(f"/v1/rootfolders/{rootfolder.id}/retentiontypes").headers["x-db-query-count"] == "0"
+
+    def test_metrics_per_route(self, rootfolder):
+        client = TestClient(app)
+        for _ in range(3):
+            client.get(f"/v1/rootfolders/{rootfolder.id}/folders/")
+        client.get("/v1/rootfolders/10000/folders/10000/summary")
+
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+        text = response.text
+        labels = {"method": "GET", "route": "/v1/rootfolders/{rootfolder_id}/folders/", "status": "200"}
+        assert sample(text, "vsm_http_request_duration_seconds_count", **labels) == 3
+        assert sample(text, "vsm_http_request_duration_seconds_bucket", **labels, le="+Inf") == 3
+        assert sample(text, "vsm_http_request_duration_seconds_sum", **labels) > 0
+        assert sample(text, "vsm_http_request_duration_seconds_count", method="GET", route="/v1/rootfolders/{rootfolder_id}/folders/{folder_id}/summary", status="404") == 1
+        assert sample(text, "vsm_http_request_db_queries_total", method="GET", route="/v1/rootfolders/{rootfolder_id}/folders/") >= 3
+        assert sample(text, "vsm_db_queries_total") >= sample(text, "vsm_http_request_db_queries_total", method="GET", route="/v1/rootfolders/{rootfolder_id}/folders/")
+        assert "# TYPE vsm_http_request_duration_seconds histogram" in text
+        assert "vsm_metadata_cache_hits_total" in text
+
+    def test_histogram_buckets_are_cumulative(self):
+        for seconds in [0.001, 0.03, 0.03, 100.0]:
+            RequestStats.observe_request("GET", "/r", 200, seconds, RequestMetrics(query_count=2, db_seconds=0.5))
+        text = RequestStats.render()
+        buckets = [sample(text, "vsm_http_request_duration_seconds_bucket", method="GET", route="/r", status="200", le=str(bound)) for bound in LATENCY_BUCKETS]
+        assert buckets[0] == 1
+        assert buckets[LATENCY_BUCKETS.index(0.05)] == 3
+        assert buckets[-1] == 3
+        assert sample(text, "vsm_http_request_duration_seconds_bucket", method="GET", route="/r", status="200", le="+Inf") == 4
+        assert sample(text, "vsm_http_request_db_queries_total", method="GET", route="/r") == 8
+        assert sample(text, "vsm_http_request_db_seconds_total", method="GET", route="/r") == 2.0
+
+    def test_failed_statements_raise_their_error(self, rootfolder):
+        with Database.get_engine().connect() as connection:
+            with pytest.raises(DBAPIError, match="no_such_table"):
+                connection.execute(text("SELECT * FROM no_such_table"))
+            connection.rollback()   # PostgreSQL aborts the transaction of a failed statement
+            query_count: int = RequestStats.query_count
+            connection.execute(text("SELECT 1"))
+            assert RequestStats.query_count == query_count + 1
+
+    def test_escape_label(self):
+        assert escape_label('a"b\\c\nd') == 'a\\"b\\\\c\\nd'
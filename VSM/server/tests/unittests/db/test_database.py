@@ -1,5 +1,24 @@
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import func, inspect, select, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import DBAPIError, OperationalError
+from sqlalchemy.schema import CreateTable
+from sqlmodel import Session
 from sqlmodel import SQLModel
+from app.app_config import AppConfig
+from app.metrics import RequestStats
 from db.database import Database
+from db import db_api
+from db.write_queue import WriteQueue
+from datamodel import dtos
+from datamodel.dtos import FileInfo, FolderTypeEnum, ExternalRetentionTypes, FolderNodeDTO
 
 
 class TestDatabase:
@@ -67,3 +86,233 @@ class TestDatabase:
         
         for expected_table in expected_tables:
             assert expected_table in table_names
+
+
+@pytest.fixture
+def profile_rootfolder(request):
+    """the rootfolder fixture in a database created with the sqlite profile request.param"""
+    AppConfig.set_sqlite_profile(request.param)
+    try:
+        yield request.getfixturevalue("rootfolder")
+    finally:
+        AppConfig.set_sqlite_profile(None)
+
+
+def read_rootfolder_in_loop(db_file: str, stop, latencies) -> None:
+    # the reads of the benchmark run in their own process so the GIL of the ingestion does not add to their latency
+    connection = sqlite3.connect(db_file, timeout=30)
+    connection.execute("PRAGMA query_only=ON")
+    seconds: list[float] = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        connection.execute("SELECT * FROM rootfolderdto").fetchall()
+        seconds.append(time.perf_counter() - start)
+        time.sleep(0.005)
+    latencies.put(seconds)
+
+
+@pytest.mark.skipif(AppConfig.get_db_backend() != "sqlite", reason="SQLite pragmas")
+class TestSQLiteProfiles:
+
+    def test_wal_profile_is_the_default(self, rootfolder):
+        profile = AppConfig.get_sqlite_profile()
+        with Database.get_engine().connect() as connection:
+            assert connection.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+            assert connection.execute(text("PRAGMA synchronous")).scalar() == 1     # normal
+            assert connection.execute(text("PRAGMA busy_timeout")).scalar() == profile.busy_timeout_ms
+            assert connection.execute(text("PRAGMA cache_size")).scalar() == -profile.cache_size_kib
+            assert connection.execute(text("PRAGMA query_only")).scalar() == 0
+
+    def test_reader_connections_are_read_only(self, rootfolder):
+        assert Database.get_read_engine() is not Database.get_engine()
+        with Database.get_read_engine().connect() as connection:
+            assert connection.execute(text("PRAGMA query_only")).scalar() == 1
+            assert connection.execute(text("SELECT count(*) FROM rootfolderdto")).scalar() == 1
+            with pytest.raises(OperationalError, match="readonly"):
+                connection.execute(text("UPDATE rootfolderdto SET owner = 'x'"))
+
+    @pytest.mark.skipif(AppConfig.get_storage_mode() == "sharded", reason="the shards require the wal profile")
+    @pytest.mark.parametrize("profile_rootfolder", ["legacy"], indirect=True)
+    def test_legacy_profile(self, profile_rootfolder):
+        with Database.get_engine().connect() as connection:
+            assert connection.execute(text("PRAGMA journal_mode")).scalar() == "delete"
+            assert connection.execute(text("PRAGMA synchronous")).scalar() == 2     # full
+
+    def test_unknown_profile(self, monkeypatch):
+        with pytest.raises(ValueError):
+            AppConfig.set_sqlite_profile("fast")
+        monkeypatch.setenv("VSM_SQLITE_PROFILE", "fast")
+        with pytest.raises(ValueError):
+            AppConfig.get_sqlite_profile()
+
+    @pytest.mark.benchmark
+    # read latency in a second process during the ingestion of 3 batches of 5000 simulations, over 4 runs: 
+    #   wal p99 0.07-0.12ms, max 0.6-6ms. legacy p99 0.1-3.3ms, max 8.5-28ms
+    # With 2 batches of 25000 the legacy ingestion takes 232s instead of 9s because the writer must wait for the readers 
+    # whenever its transaction spills from the cache, and reads wait up to 1s
+    @pytest.mark.parametrize("profile_rootfolder", ["wal", "legacy"], indirect=True)
+    def test_benchmark_reads_during_ingestion(self, profile_rootfolder):
+        stop, latencies = multiprocessing.Event(), multiprocessing.Queue()
+        reader = multiprocessing.Process(target=read_rootfolder_in_loop, args=(Database.get_db().db_url.replace("sqlite:///", ""), stop, latencies))
+        reader.start()
+        start = time.perf_counter()
+        for batch in range(3):
+            db_api.insert_or_update_simulations_in_db(profile_rootfolder.id, [
+                FileInfo(f"/teams/root/b{batch}/d{i % 50}/sim{i}", datetime(2025, 1, 1), FolderTypeEnum.SIMULATION, ExternalRetentionTypes.NUMERIC) for i in range(5000)])
+        ingestion_seconds = time.perf_counter() - start
+        stop.set()
+        seconds: list[float] = sorted(latencies.get(timeout=60))
+        reader.join()
+
+        p99: float = seconds[int(0.99 * (len(seconds) - 1))]
+        print(f"\n{AppConfig.get_sqlite_profile().journal_mode}: ingestion {ingestion_seconds:.1f}s, {len(seconds)} reads "
+              f"p50 {seconds[len(seconds) // 2] * 1000:.2f}ms p99 {p99 * 1000:.2f}ms max {seconds[-1] * 1000:.1f}ms")
+        if AppConfig.get_sqlite_profile().journal_mode == "wal":
+            assert p99 < 0.05
+
+
+@pytest.fixture
+def sharded_rootfolders(request):
+    """two rootfolders in a database created with the sharded storage mode"""
+    AppConfig.set_storage_mode("sharded")
+    try:
+        rootfolder = request.getfixturevalue("rootfolder")
+        other = db_api.insert_rootfolder(dtos.RootFolderDTO(simulationdomain_id=rootfolder.simulationdomain_id, path="/teams/other"))
+        with Session(Database.get_engine()) as session:
+            cleanup_config = session.get(dtos.RootFolderDTO, other.id).get_cleanup_configuration(session)
+            cleanup_config.lead_time, cleanup_config.frequency = 14, 7
+            session.add(cleanup_config)
+            session.commit()
+        yield rootfolder, other
+    finally:
+        AppConfig.set_storage_mode(None)
+
+
+def add_domain(name: str):
+    def job(session: Session) -> None:
+        session.add(dtos.SimulationDomainDTO(name=name))
+    return job
+
+def insert_simulations(rootfolder_id: int, paths: list[str]) -> dict:
+    return db_api.insert_or_update_simulations_in_db(rootfolder_id, [FileInfo(path, datetime(2025, 1, 1), FolderTypeEnum.SIMULATION, ExternalRetentionTypes.NUMERIC) for path in paths])
+
+
+@pytest.mark.skipif(AppConfig.get_db_backend() != "sqlite", reason="SQLite shards")
+class TestShardedStorage:
+
+    def test_the_folders_are_stored_in_the_shard_of_their_rootfolder(self, sharded_rootfolders):
+        rootfolder, other = sharded_rootfolders
+        insert_simulations(rootfolder.id, ["/teams/root/a/sim1", "/teams/root/a/sim2"])
+        insert_simulations(other.id, ["/teams/other/sim3"])
+
+        db = Database.get_db()
+        assert os.path.exists(db.shard_file(rootfolder.id)) and os.path.exists(db.shard_file(other.id))
+        assert not inspect(Database.get_engine()).has_table(FolderNodeDTO.__tablename__)
+        assert sorted(folder.path for folder in db_api.read_folders(rootfolder.id)) == ["/teams/root", "/teams/root/a", "/teams/root/a/sim1", "/teams/root/a/sim2"]
+        assert sorted(folder.path for folder in db_api.read_folders(other.id)) == ["/teams/other", "/teams/other/sim3"]
+        assert db_api.read_folder_changes(other.id, 0).version > 0
+
+    def test_a_shard_reads_but_does_not_write_the_main_database(self, sharded_rootfolders):
+        rootfolder, _ = sharded_rootfolders
+        with Database.get_engine(rootfolder.id).connect() as connection:
+            assert connection.execute(text("SELECT count(*) FROM rootfolderdto")).scalar() == 2
+            with pytest.raises(OperationalError, match="readonly"):
+                connection.execute(text("UPDATE rootfolderdto SET owner = 'x'"))
+
+    def test_unknown_rootfolders_have_no_shard(self, sharded_rootfolders):
+        rootfolder, other = sharded_rootfolders
+        with pytest.raises(HTTPException) as error:
+            Database.get_engine(other.id + 100)
+        assert error.value.status_code == 404
+        assert not os.path.exists(Database.get_db().shard_file(other.id + 100))
+
+    def test_the_shards_are_written_in_parallel(self, sharded_rootfolders):
+        rootfolder, other = sharded_rootfolders
+        insert_simulations(rootfolder.id, ["/teams/root/sim1"])
+        started, release = threading.Event(), threading.Event()
+        blocked = WriteQueue.submit_exclusive(lambda: started.set() or release.wait(10), WriteQueue.BULK, rootfolder.id)
+        assert started.wait(10)
+        try:
+            # neither the other shard nor the main database wait for the blocked writer of the rootfolder's shard
+            assert insert_simulations(other.id, ["/teams/other/sim2"])["changed_count"] == 1
+            WriteQueue.run(add_domain("while a shard is blocked"), main_database=True)
+            assert WriteQueue.stats()["writers"] >= 3
+        finally:
+            release.set()
+        blocked.result(10)
+
+    def test_a_shard_writer_only_waits_for_the_main_writer(self, sharded_rootfolders):
+        rootfolder, other = sharded_rootfolders
+        WriteQueue.run_exclusive(lambda: WriteQueue.run(add_domain("from a shard"), main_database=True), WriteQueue.BULK, rootfolder.id)
+        with Session(Database.get_read_engine()) as session:
+            assert session.exec(select(dtos.SimulationDomainDTO).where(dtos.SimulationDomainDTO.name == "from a shard")).first() is not None
+
+        with pytest.raises(RuntimeError, match="must not wait for the writer of shard"):
+            WriteQueue.run_exclusive(lambda: insert_simulations(other.id, ["/teams/other/sim"]), WriteQueue.BULK, rootfolder.id)
+        with pytest.raises(RuntimeError, match="the main database must not wait"):
+            WriteQueue.run_exclusive(lambda: insert_simulations(other.id, ["/teams/other/sim"]), WriteQueue.BULK, main_database=True)
+
+    def test_a_single_file_database_is_not_upgraded_to_shards(self, request):
+        AppConfig.set_storage_mode("single")
+        try:
+            rootfolder = request.getfixturevalue("rootfolder")
+            insert_simulations(rootfolder.id, ["/teams/root/sim1"])
+            AppConfig.set_storage_mode("sharded")
+            Database._instance = None
+            with pytest.raises(ValueError, match="single storage mode"):
+                Database.get_db().upgrade_db()
+        finally:
+            AppConfig.set_storage_mode(None)
+
+
+class TestDatabaseBackends:
+
+    def test_database_url_from_the_environment(self, monkeypatch):
+        monkeypatch.setenv(AppConfig.DATABASE_URL_ENV, "postgresql+psycopg://vsm@localhost/vsm")
+        assert AppConfig.get_db_url() == "postgresql+psycopg://vsm@localhost/vsm"
+        assert AppConfig.get_db_backend() == "postgresql"
+        monkeypatch.delenv(AppConfig.DATABASE_URL_ENV)
+        AppConfig.set_test_mode(AppConfig.Mode.UNIT_TEST)
+        assert AppConfig.get_db_backend() == "sqlite"
+
+    def test_unsupported_database(self):
+        with pytest.raises(ValueError, match="unsupported database"):
+            object.__new__(Database)._initialize("mysql://vsm@localhost/vsm")
+
+    def test_path_keys_compare_by_byte_order_on_postgresql(self):
+        assert 'path_key VARCHAR COLLATE "C"' in str(CreateTable(FolderNodeDTO.__table__).compile(dialect=postgresql.dialect()))
+
+    def test_copy_rows(self, rootfolder, monkeypatch):
+        monkeypatch.setattr(db_api, "STAGING_CHUNK_SIZE", 4)
+        staging = db_api.retention_staging_table
+        with Session(Database.get_engine()) as session:
+            connection = session.connection()
+            staging.create(connection, checkfirst=True)
+            db_api.copy_rows(connection, staging, ((folder_id, folder_id % 3) for folder_id in range(1, 11)))
+            assert connection.execute(select(func.count(), func.sum(staging.c.retention_id)).select_from(staging)).one() == (10, 10)
+            session.rollback()
+
+    @pytest.mark.skipif(AppConfig.get_db_backend() != "postgresql", reason="PostgreSQL server")
+    def test_postgresql_readers_are_read_only(self, rootfolder):
+        with Database.get_read_engine().connect() as connection:
+            assert connection.execute(text("SELECT count(*) FROM rootfolderdto")).scalar() == 1
+            with pytest.raises(DBAPIError, match="read-only transaction"):
+                connection.execute(text("UPDATE rootfolderdto SET owner = 'x'"))
+
+    @pytest.mark.skipif(AppConfig.get_db_backend() != "postgresql", reason="PostgreSQL server")
+    def test_postgresql_inserts_the_new_folders_of_any_depth_with_one_copy(self, rootfolder):
+        def statements_of_insert(paths: list[str]) -> int:
+            query_count: int = RequestStats.query_count
+            db_api.insert_simulations_in_db(rootfolder, [FileInfo(path, datetime(2025, 1, 1), FolderTypeEnum.SIMULATION, ExternalRetentionTypes.NUMERIC) for path in paths])
+            return RequestStats.query_count - query_count
+
+        statements_of_insert(["/teams/root/sim0"])     # creates the staging table of the connection
+        shallow: int = statements_of_insert(["/teams/root/a/sim1", "/teams/root/b/sim2"])
+        deep: int    = statements_of_insert(["/teams/root/a/" + "/".join(f"level{i}" for i in range(12)) + "/sim3"])
+        assert deep == shallow
+
+        folders = {folder.id: folder for folder in db_api.read_folders(rootfolder.id)}
+        assert len(folders) == 1 + 1 + 2 + 2 + 12 + 1
+        for folder in folders.values():
+            parent_path_ids: str = folders[folder.parent_id].path_ids if folder.parent_id else ""
+            assert folder.path_ids == db_api.generate_path_ids(parent_path_ids, folder.id)
@@ -0,0 +1,580 @@
+import json
+from datetime import datetime, timedelta
+import numpy as np
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import update
+from sqlmodel import Session, select
+from app.app_config import AppConfig
+from db.database import Database
+from db import db_api
+from db.write_queue import WriteQueue
+from datamodel import dtos
+from datamodel.dtos import FileInfo, FolderTypeEnum, ExternalRetentionTypes, RootFolderDTO, FolderNodeDTO
+
+
+def make_simulations(paths: list[str]) -> list[FileInfo]:
+    return [FileInfo(filepath=path, modified_date=datetime(2025, 1, 1), nodetype=FolderTypeEnum.SIMULATION, external_retention=ExternalRetentionTypes.NUMERIC)
+            for path in paths]
+
+
+def read_nodes_by_path(rootfolder_id: int) -> dict[str, FolderNodeDTO]:
+    return {folder.path.lower(): folder for folder in db_api.read_folders(rootfolder_id)}
+
+
+class TestBulkHierarchicalInsert:
+
+    def test_insert_creates_shared_hierarchy_once(self, rootfolder):
+        paths = ["/teams/root/a/b/sim1", "/teams/root/a/b/sim2", "/teams/root/a/c/sim3"]
+        result = db_api.insert_simulations_in_db(rootfolder, make_simulations(paths))
+
+        assert result["inserted_hierarchy_count"] == 3
+        assert result["failed_path_count"] == 0
+        # root, a, b, c, sim1, sim2, sim3
+        assert result["inserted_node_count"] == 7
+
+        nodes = read_nodes_by_path(rootfolder.id)
+        assert len(nodes) == 7
+        root = nodes["/teams/root"]
+        a    = nodes["/teams/root/a"]
+        b    = nodes["/teams/root/a/b"]
+        sim1 = nodes["/teams/root/a/b/sim1"]
+        assert root.parent_id == 0
+        assert a.parent_id == root.id
+        assert sim1.parent_id == b.id
+        assert sim1.path_ids == f"{root.id}/{a.id}/{b.id}/{sim1.id}"
+
+        nodetypes = db_api.read_folder_type_dict_pr_domain_id(rootfolder.simulationdomain_id)
+        assert sim1.nodetype_id == nodetypes[FolderTypeEnum.SIMULATION].id
+        assert b.nodetype_id == nodetypes[FolderTypeEnum.INNERNODE].id
+
+    def test_insert_reuses_existing_nodes_case_insensitive(self, rootfolder):
+        db_api.insert_simulations_in_db(rootfolder, make_simulations(["/teams/root/a/b/sim1"]))
+        result = db_api.insert_simulations_in_db(rootfolder, make_simulations(["/teams/root/A/B/sim2", "/teams/root/a/b/SIM1"]))
+
+        assert result["inserted_hierarchy_count"] == 2
+        assert result["inserted_node_count"] == 1
+
+        nodes = read_nodes_by_path(rootfolder.id)
+        b    = nodes["/teams/root/a/b"]
+        sim2 = nodes["/teams/root/a/b/sim2"]
+        assert sim2.parent_id == b.id
+        assert sim2.path_ids == f"{b.path_ids}/{sim2.id}"
+
+    def test_insert_reports_paths_outside_rootfolder(self, rootfolder):
+        result = db_api.insert_simulations_in_db(rootfolder, make_simulations(["/other/root/sim1", "/teams/root/sim2"]))
+
+        assert result["inserted_hierarchy_count"] == 1
+        assert result["failed_paths"] == ["/other/root/sim1"]
+        assert "/teams/root/sim2" in read_nodes_by_path(rootfolder.id)
+
+
+class TestNormalizedPathKeys:
+
+    def test_keys_are_set_on_insert(self, rootfolder):
+        db_api.insert_simulations_in_db(rootfolder, make_simulations(["\\teams\\root\\Project\\SIM1"]))
+
+        nodes = read_nodes_by_path(rootfolder.id)
+        sim = nodes["/teams/root/project/sim1"]
+        assert sim.path_key == "/teams/root/project/sim1"
+        assert sim.name_key == "sim1"
+
+    def test_to_path_key_normalizes_separators_and_case(self):
+        assert dtos.to_path_key("\\Teams\\Root\\") == "/teams/root"
+        assert dtos.to_path_key("/teams//root/A") == "/teams/root/a"
+        assert dtos.to_path_key("") is None
+
+    def test_pathprotection_by_paths_is_case_insensitive(self, rootfolder):
+        db_api.insert_simulations_in_db(rootfolder, make_simulations(["/teams/root/a/sim1"]))
+        result = db_api.add_pathprotection_by_paths(rootfolder.id, ["/TEAMS/root/A", "/teams/root/missing"])
+
+        assert [p["path"] for p in result["added_protections"]] == ["/teams/root/a"]
+        assert [p["path"] for p in result["failed_paths"]] == ["/teams/root/missing"]
+
+    @pytest.mark.skipif(AppConfig.get_storage_mode() == "sharded", reason="upgrades a single file database")
+    def test_upgrade_db_backfills_keys(self, rootfolder):
+        from sqlalchemy import text
+        db_api.insert_simulations_in_db(rootfolder, make_simulations(["/teams/root/A/sim1"]))
+
+        # simulate a database created before the key columns existed
+        engine = Database.get_engine()
+        with engine.begin() as connection:
+            for index in FolderNodeDTO.__table__.indexes:
+                connection.execute(text(f"DROP INDEX {index.name}"))
+            connection.execute(text("ALTER TABLE foldernodedto DROP COLUMN path_key"))
+            connection.execute(text("ALTER TABLE foldernodedto DROP COLUMN name_key"))
+            connection.execute(text("ALTER TABLE foldernodedto DROP COLUMN change_version"))
+            connection.execute(text("DROP TABLE folderversiondto"))
+
+        Database.get_db().upgrade_db()
+
+        nodes = read_nodes_by_path(rootfolder.id)
+        assert nodes["/teams/root/a"].path_key == "/teams/root/a"
+        assert nodes["/teams/root/a"].name_key == "a"
+        assert nodes["/teams/root/a"].change_version == 0
+        assert db_api.read_folder_changes(rootfolder.id, 0).version == 0
+
+    @pytest.mark.skipif(AppConfig.get_storage_mode() == "sharded", reason="upgrades a single file database")
+    def test_upgrade_db_reports_keys_that_collide(self, rootfolder, capsys):
+        from sqlalchemy import inspect, text
+        db_api.insert_simulations_in_db(rootfolder, make_simulations(["/teams/root/A/sim1"]))
+        engine = Database.get_engine()
+        with engine.begin() as connection:
+            for index in FolderNodeDTO.__table__.indexes:
+                connection.execute(text(f"DROP INDEX {index.name}"))
+            connection.execute(text("ALTER TABLE foldernodedto DROP COLUMN path_key"))
+            connection.execute(text("ALTER TABLE foldernodedto DROP COLUMN name_key"))
+            # a folder from before the keys whose path only differs by case and separators from an existing folder
+            connection.execute(text("INSERT INTO foldernodedto (rootfolder_id, parent_id, name, path, path_ids, nodetype_id, retention_id, path_protection_id, change_version) "
+                                    "SELECT rootfolder_id, parent_id, 'a', '\\teams\\root\\a', path_ids, nodetype_id, retention_id, path_protection_id, change_version "
+                                    "FROM foldernodedto WHERE path = '/teams/root/A'"))
+
+        Database.get_db().upgrade_db()
+        assert "duplicate keys in foldernodedto prevent the unique index ix_foldernodedto_rootfolder_id_path_key" in capsys.readouterr().out
+        def unique_indexes() -> dict[str, bool]:
+            return {index["name"]: bool(index["unique"]) for index in inspect(engine).get_indexes("foldernodedto")}
+        assert unique_indexes()["ix_foldernodedto_rootfolder_id_path_key"] is False
+
+        with engine.begin() as connection:
+            connection.execute(text("DELETE FROM foldernodedto WHERE path = '\\teams\\root\\a'"))
+        Database.get_db().upgrade_db()
+        assert unique_indexes()["ix_foldernodedto_rootfolder_id_path_key"] is True
+        assert unique_indexes()["ix_foldernodedto_rootfolder_id_parent_id_name_key"] is True
+
+
+class TestStagedSimulationMatching:
+
+    def test_insert_or_update_in_chunks(self, rootfolder, monkeypatch):
+        monkeypatch.setattr(db_api, "STAGING_CHUNK_SIZE", 3)
+        paths = [f"/teams/root/p{i % 2}/sim{i}" for i in range(10)]
+        db_api.insert_or_update_simulations_in_db(rootfolder.id, make_simulations(paths))
+
+        nodes = read_nodes_by_path(rootfolder.id)
+        assert all(path in nodes for path in paths)
+        assert all(nodes[path].modified_date == datetime(2025, 1, 1) for path in paths)
+
+        # a second batch mixing existing (different case) and new simulations
+        updated = make_simulations([path.upper() for path in paths[:5]] + ["/teams/root/p2/sim10"])
+        for sim in updated:
+            sim.modified_date = datetime(2025, 2, 1)
+        db_api.insert_or_update_simulations_in_db(rootfolder.id, updated)
+
+        nodes = read_nodes_by_path(rootfolder.id)
+        assert len([n for n in nodes.values() if n.modified_date == datetime(2025, 2, 1)]) == 6
+        assert nodes["/teams/root/p0/sim6"].modified_date == datetime(2025, 1, 1)
+
+    def test_staging_table_is_empty_after_use(self, rootfolder):
+        with Session(Database.get_engine()) as session:
+            with db_api.staged_simulations(session, make_simulations(["/teams/root/a", "/teams/root/b"])) as staging:
+                assert session.execute(select(staging.c.path_key).order_by(staging.c.seq)).scalars().all() == ["/teams/root/a", "/teams/root/b"]
+            assert session.execute(select(staging.c.seq)).all() == []
+
+
+class TestChangeDetection:
+
+    def test_only_new_or_changed_simulations_are_selected(self, rootfolder):
+        paths = ["/teams/root/a/sim1", "/teams/root/a/sim2", "/teams/root/a/sim3"]
+        db_api.insert_or_update_simulations_in_db(rootfolder.id, make_simulations(paths))
+
+        rescan = make_simulations(paths + ["/teams/root/a/sim4"])
+        rescan[1].modified_date = datetime(2025, 3, 1)
+        rescan[2].external_retention = ExternalRetentionTypes.CLEAN
+        changed = db_api.select_new_or_changed_simulations(rootfolder.id, rescan)
+
+        assert [sim.filepath for sim in changed] == ["/teams/root/a/sim2", "/teams/root/a/sim3", "/teams/root/a/sim4"]
+
+    def test_fingerprints_with_null_match(self, rootfolder):
+        paths = ["/teams/root/a/sim1", "/teams/root/a/sim2"]
+        db_api.insert_or_update_simulations_in_db(rootfolder.id, make_simulations(paths))
+        sim1 = read_nodes_by_path(rootfolder.id)[paths[0]]
+        with Session(Database.get_engine(rootfolder.id)) as session:
+            session.connection().execute(update(FolderNodeDTO.__table__).where(FolderNodeDTO.__table__.c.id == sim1.id).values(modified_date=None))
+            session.commit()
+
+        rescan = make_simulations(paths)
+        rescan[0].modified_date = None
+        assert db_api.select_new_or_changed_simulations(rootfolder.id, rescan) == []
+
+        # a simulation without external retention does not match the folder's numeric retention
+        rescan[1].external_retention = None
+        assert [sim.filepath for sim in db_api.select_new_or_changed_simulations(rootfolder.id, rescan)] == [paths[1]]
+
+    def test_unchanged_rescan_is_skipped(self, rootfolder):
+        paths = ["/teams/root/a/sim1", "/teams/root/a/sim2"]
+        db_api.insert_or_update_simulations_in_db(rootfolder.id, make_simulations(paths))
+        result = db_api.insert_or_update_simulations_in_db(rootfolder.id, make_simulations(paths))
+
+        assert result["changed_count"] == 0
+        assert result["unchanged_count"] == 2
+
+    def test_failing_scan_is_rolled_back_entirely(self, rootfolder, monkeypatch):
+        paths = [f"/teams/root/a/sim{i}" for i in range(5)]
+        db_api.insert_or_update_simulations_in_db(rootfolder.id, make_simulations(paths[:1]))
+        version = db_api.read_folder_changes(rootfolder.id, 0).version
+
+        def failing_pathprotections(rootfolder_id: int):
+            raise RuntimeError("path protections failed")
+        monkeypatch.setattr(db_api, "apply_pathprotections", failing_pathprotections)
+        with pytest.raises(RuntimeError):
+            db_api.insert_or_update_simulations_in_db(rootfolder.id, make_simulations(paths))
+
+        assert sorted(read_nodes_by_path(rootfolder.id)) == ["/teams/root", "/teams/root/a", paths[0]]
+        assert db_api.read_folder_changes(rootfolder.id, 0).version == version
+
+
+class TestPathProtections:
+
+    def protections_by_path(self, rootfolder_id: int) -> dict[str, int]:
+        return {p.path.lower(): p.id for p in db_api.read_pathprotections(rootfolder_id)}
+
+    def test_most_specific_protection_wins(self, rootfolder):
+        db_api.insert_or_update_simulations_in_db(rootfolder.id, make_simulations(["/teams/root/a/sim1", "/teams/root/a/b/sim2", "/teams/root/c/sim3"]))
+        db_api.add_pathprotection_by_paths(rootfolder.id, ["/teams/root/a/b", "/teams/root/a"])
+        protections = self.protections_by_path(rootfolder.id)
+        path_retention_id = db_api.read_rootfolder_retentiontypes_dict(rootfolder.id)["path"].id
+
+        nodes = read_nodes_by_path(rootfolder.id)
+        assert nodes["/teams/root/a/sim1"].path_protection_id == protections["/teams/root/a"]
+        assert nodes["/teams/root/a/b/sim2"].path_protection_id == protections["/teams/root/a/b"]
+        assert nodes["/teams/root/a/b/sim2"].retention_id == path_retention_id
+        assert nodes["/teams/root/c/sim3"].retention_id != path_retention_id
+
+        # a full re-apply finds nothing to change
+        result = db_api.apply_pathprotections(rootfolder.id)
+        assert result["folders_modified"] == 0
+        assert result["folders_reset"] == 0
+
+    def test_add_pathprotection_applies_to_subtree(self, rootfolder):
+        db_api.insert_or_update_simulations_in_db(rootfolder.id, make_simulations(["/teams/root/a/sim1", "/teams/root/c/sim3"]))
+        nodes = read_nodes_by_path(rootfolder.id)
+        protection = db_api.add_pathprotection(rootfolder.id, dtos.PathProtectionDTO(rootfolder_id=rootfolder.id, folder_id=nodes["/teams/root/a"].id, path="/teams/root/a"))
+
+        nodes = read_nodes_by_path(rootfolder.id)
+        assert nodes["/teams/root/a/sim1"].path_protection_id == protection.id
+        assert nodes["/teams/root/c/sim3"].path_protection_id == 0
+
+    def test_delete_pathprotection_falls_back_to_parent_protection(self, rootfolder):
+        db_api.insert_or_update_simulations_in_db(rootfolder.id, make_simulations(["/teams/root/a/b/sim2", "/teams/root/c/sim3"]))
+        db_api.add_pathprotection_by_paths(rootfolder.id, ["/teams/root/a", "/teams/root/a/b", "/teams/root/c"])
+        protections = self.protections_by_path(rootfolder.id)
+        retention_types = db_api.read_rootfolder_retentiontypes_dict(rootfolder.id)
+
+        db_api.delete_pathprotection(rootfolder.id, protections["/teams/root/a/b"])
+        db_api.delete_pathprotection(rootfolder.id, protections["/teams/root/c"])
+
+        nodes = read_nodes_by_path(rootfolder.id)
+        assert nodes["/teams/root/a/b/sim2"].path_protection_id == protections["/teams/root/a"]
+        assert nodes["/teams/root/c/sim3"].path_protection_id == 0
+        assert nodes["/teams/root/c/sim3"].retention_id == retention_types["?"].id
+
+
+class TestSubtreeQueries:
+
+    def test_simulations_and_summary_of_subtree(self, rootfolder):
+        db_api.insert_or_update_simulations_in_db(rootfolder.id, make_simulations(["/teams/root/a/sim1", "/teams/root/a/b/sim2", "/teams/root/a-1/sim3"]))
+        db_api.add_pathprotection_by_paths(rootfolder.id, ["/teams/root/a/b"])
+        a = read_nodes_by_path(rootfolder.id)["/teams/root/a"]
+
+        simulations = db_api.read_simulations_in_subtree(rootfolder.id, a.id)
+        assert [sim.path for sim in simulations] == ["/teams/root/a/b/sim2", "/teams/root/a/sim1"]
+
+        summary = db_api.read_subtree_summary(rootfolder.id, a.id)
+        # a, b, sim1, sim2. The sibling a-1 is not part of the subtree
+        assert summary["node_count"] == 4
+        assert summary["simulation_count"] == 2
+        assert summary["simulations_by_retention"]["path"] == 1
+
+    def test_ancestors(self, rootfolder):
+        db_api.insert_or_update_simulations_in_db(rootfolder.id, make_simulations(["/teams/root/a/b/sim1"]))
+        nodes = read_nodes_by_path(rootfolder.id)
+
+        ancestors = db_api.read_ancestors(rootfolder.id, nodes["/teams/root/a/b/sim1"].id)
+        assert [folder.path for folder in ancestors] == ["/teams/root", "/teams/root/a", "/teams/root/a/b"]
+        assert db_api.read_ancestors(rootfolder.id, nodes["/teams/root"].id) == []
+
+    def test_unknown_folder_raises_404(self, rootfolder):
+        with pytest.raises(HTTPException) as error:
+            db_api.read_subtree_summary(rootfolder.id, 12345)
+        assert error.value.status_code == 404
+
+
+class TestFolderChangeVersions:
+
+    def changed_paths(self, rootfolder_id: int, since: int) -> list[str]:
+        return sorted(folder.path for folder in db_api.read_folder_changes(rootfolder_id, since).folders)
+
+    def test_changes_since_a_version(self, rootfolder):
+        paths = ["/teams/root/a/sim1", "/teams/root/a/sim2", "/teams/root/b/sim3"]
+        db_api.insert_or_update_simulations_in_db(rootfolder.id, make_simulations(paths))
+        snapshot = db_api.read_folder_changes(rootfolder.id, 0)
+        assert snapshot.is_full_snapshot
+        assert len(snapshot.folders) == 6
+        assert self.changed_paths(rootfolder.id, snapshot.version) == []
+
+        # change_retentions
+        nodes = read_nodes_by_path(rootfolder.id)
+        retention_types = db_api.read_rootfolder_retentiontypes_dict(rootfolder.id)
+        db_api.change_retentions(rootfolder.id, [dtos.FolderRetention(folder_id=nodes["/teams/root/a/sim1"].id, retention_id=retention_types["+90d"].id)])
+        changes = db_api.read_folder_changes(rootfolder.id, snapshot.version)
+        assert not changes.is_full_snapshot
+        assert [folder.path for folder in changes.folders] == ["/teams/root/a/sim1"]
+
+        # path protections
+        db_api.add_pathprotection_by_paths(rootfolder.id, ["/teams/root/b"])
+        assert self.changed_paths(rootfolder.id, changes.version) == ["/teams/root/b/sim3"]
+
+        # ingestion of new and changed simulations
+        version = db_api.read_folder_changes(rootfolder.id, 0).version
+        db_api.insert_or_update_simulations_in_db(rootfolder.id, [
+            FileInfo("/teams/root/a/sim2", datetime(2025, 2, 1), FolderTypeEnum.SIMULATION, ExternalRetentionTypes.NUMERIC),
+            FileInfo("/teams/root/c/sim4", datetime(2025, 2, 1), FolderTypeEnum.SIMULATION, ExternalRetentionTypes.NUMERIC)])
+        assert self.changed_paths(rootfolder.id, version) == ["/teams/root/a/sim2", "/teams/root/c", "/teams/root/c/sim4"]
+
+    def test_runs_without_changes_keep_the_version(self, rootfolder):
+        paths = ["/teams/root/a/sim1", "/teams/root/b/sim2"]
+        db_api.insert_or_update_simulations_in_db(rootfolder.id, make_simulations(paths))
+        db_api.add_pathprotection_by_paths(rootfolder.id, ["/teams/root/b"])
+        version = db_api.read_folder_changes(rootfolder.id, 0).version
+
+        db_api.insert_or_update_simulations_in_db(rootfolder.id, make_simulations(paths))
+        db_api.apply_pathprotections(rootfolder.id)
+        assert db_api.read_folder_changes(rootfolder.id, 0).version == version
+
+    def test_orm_writes_are_stamped(self, rootfolder):
+        db_api.insert_simulations_in_db(rootfolder, make_simulations(["/teams/root/a/sim1", "/teams/root/a/sim2"]))
+        version = db_api.read_folder_changes(rootfolder.id, 0).version
+        with Session(Database.get_engine(rootfolder.id)) as session:
+            folder = session.exec(select(FolderNodeDTO).where(FolderNodeDTO.path == "/teams/root/a/sim2")).one()
+            folder.expiration_date = datetime(2026, 1, 1)
+            session.add(folder)
+            session.commit()
+
+        changes = db_api.read_folder_changes(rootfolder.id, version)
+        assert changes.version == version + 1
+        assert [folder.path for folder in changes.folders] == ["/teams/root/a/sim2"]
+
+    def test_version_ahead_of_the_database_is_a_full_snapshot(self, rootfolder):
+        db_api.insert_simulations_in_db(rootfolder, make_simulations(["/teams/root/a/sim1"]))
+        changes = db_api.read_folder_changes(rootfolder.id, 1000)
+        assert changes.is_full_snapshot
+        assert len(changes.folders) == 3
+
+        with pytest.raises(HTTPException):
+            db_api.read_folder_changes(rootfolder.id + 100, 0)
+
+
+def counted_retentions(rootfolder_id: int) -> dict[tuple[int, int], int]:
+    # recount the simulations per retention in the subtree of every inner folder from the folders
+    simulation_type_id = db_api.read_folder_type_dict_pr_domain_id(1)[FolderTypeEnum.SIMULATION].id
+    expected: dict[tuple[int, int], int] = {}
+    for folder in db_api.read_folders(rootfolder_id):
+        if folder.nodetype_id == simulation_type_id and folder.retention_id:
+            for ancestor_id in folder.path_ids.split("/")[:-1]:
+                expected[(int(ancestor_id), folder.retention_id)] = expected.get((int(ancestor_id), folder.retention_id), 0) + 1
+    return expected
+
+def materialized_retentions(rootfolder_id: int) -> dict[tuple[int, int], int]:
+    db_api.read_retention_counts(rootfolder_id)  # refreshes the counts
+    with Session(Database.get_engine(rootfolder_id)) as session:
+        rows = session.exec(select(dtos.FolderRetentionCountDTO).where(dtos.FolderRetentionCountDTO.rootfolder_id == rootfolder_id)).all()
+        return {(row.folder_id, row.retention_id): row.simulation_count for row in rows if row.simulation_count != 0}
+
+
+class TestRetentionCounts:
+
+    def test_counts_follow_ingestion_retention_changes_and_protections(self, rootfolder):
+        paths = [f"/teams/root/p{i % 3}/q{i % 2}/sim{i}" for i in range(12)]
+        db_api.insert_or_update_simulations_in_db(rootfolder.id, make_simulations(paths))
+        assert materialized_retentions(rootfolder.id) == counted_retentions(rootfolder.id)
+
+        nodes = read_nodes_by_path(rootfolder.id)
+        retention_types = db_api.read_rootfolder_retentiontypes_dict(rootfolder.id)
+        db_api.change_retentions(rootfolder.id, [dtos.FolderRetention(folder_id=nodes[path].id, retention_id=retention_types["+90d"].id) for path in paths[:5]])
+        assert materialized_retentions(rootfolder.id) == counted_retentions(rootfolder.id)
+
+        db_api.add_pathprotection_by_paths(rootfolder.id, ["/teams/root/p1"])
+        assert materialized_retentions(rootfolder.id) == counted_retentions(rootfolder.id)
+        db_api.delete_pathprotection(rootfolder.id, db_api.read_pathprotections(rootfolder.id)[0].id)
+        assert materialized_retentions(rootfolder.id) == counted_retentions(rootfolder.id)
+
+        # an ORM write outside db_api is counted when the counts are read
+        with Session(Database.get_engine(rootfolder.id)) as session:
+            folder = session.get(FolderNodeDTO, nodes[paths[7]].id)
+            folder.retention_id = retention_types["issue"].id
+            session.add(folder)
+            session.commit()
+        assert materialized_retentions(rootfolder.id) == counted_retentions(rootfolder.id)
+
+    def test_read_retention_counts_of_children(self, rootfolder):
+        paths = ["/teams/root/a/sim1", "/teams/root/a/sim2", "/teams/root/b/sim3", "/teams/root/sim4"]
+        db_api.insert_or_update_simulations_in_db(rootfolder.id, make_simulations(paths))
+        nodes = read_nodes_by_path(rootfolder.id)
+        retention_types = db_api.read_rootfolder_retentiontypes_dict(rootfolder.id)
+        days90, issue = retention_types["+90d"].id, retention_types["issue"].id
+        db_api.change_retentions(rootfolder.id, [dtos.FolderRetention(folder_id=nodes[path].id, retention_id=days90) for path in paths[:3]] +
+                                                [dtos.FolderRetention(folder_id=nodes[paths[3]].id, retention_id=issue)])
+
+        top = db_api.read_retention_counts(rootfolder.id)
+        assert [(counts.folder_id, counts.retention_counts) for counts in top] == [(nodes["/teams/root"].id, {days90: 3, issue: 1})]
+
+        children = {counts.folder_id: counts.retention_counts for counts in db_api.read_retention_counts(rootfolder.id, nodes["/teams/root"].id)}
+        assert children == {nodes["/teams/root/a"].id: {days90: 2}, nodes["/teams/root/b"].id: {days90: 1}, nodes["/teams/root/sim4"].id: {issue: 1}}
+
+        with pytest.raises(HTTPException):
+            db_api.read_retention_counts(rootfolder.id + 100)
+
+    def test_stale_counts_are_refreshed_by_the_write_queue(self, rootfolder):
+        paths = ["/teams/root/a/sim1", "/teams/root/a/sim2"]
+        db_api.insert_or_update_simulations_in_db(rootfolder.id, make_simulations(paths))
+        db_api.read_retention_counts(rootfolder.id)
+        nodes = read_nodes_by_path(rootfolder.id)
+        with Session(Database.get_engine(rootfolder.id)) as session:
+            folder = session.get(FolderNodeDTO, nodes[paths[0]].id)
+            folder.retention_id = db_api.read_rootfolder_retentiontypes_dict(rootfolder.id)["issue"].id
+            session.add(folder)
+            session.commit()
+
+        WriteQueue.clear_stats()
+        db_api.read_retention_counts(rootfolder.id)
+        assert WriteQueue.stats()["commits"] == 1
+        db_api.read_retention_counts(rootfolder.id)     # the counts are current so there is nothing to write
+        assert WriteQueue.stats()["commits"] == 1
+        assert materialized_retentions(rootfolder.id) == counted_retentions(rootfolder.id)
+
+
+class TestChangeRetentionsByFilter:
+
+    @pytest.fixture
+    def simulations(self, rootfolder) -> dict[str, FolderNodeDTO]:
+        # a/sim1, a/sim2 and b/sim3 get +90d. c is protected
+        paths = ["/teams/root/a/sim1", "/teams/root/a/sim2", "/teams/root/b/sim3", "/teams/root/c/sim4"]
+        db_api.insert_or_update_simulations_in_db(rootfolder.id, [
+            FileInfo(filepath=path, modified_date=datetime(2025, 1, 1 + i), nodetype=FolderTypeEnum.SIMULATION, external_retention=ExternalRetentionTypes.NUMERIC)
+            for i, path in enumerate(paths)])
+        nodes = read_nodes_by_path(rootfolder.id)
+        days90 = db_api.read_rootfolder_retentiontypes_dict(rootfolder.id)["+90d"].id
+        db_api.change_retentions(rootfolder.id, [dtos.FolderRetention(folder_id=nodes[path].id, retention_id=days90) for path in paths[:3]])
+        db_api.add_pathprotection_by_paths(rootfolder.id, ["/teams/root/c"])
+        return read_nodes_by_path(rootfolder.id)
+
+    def test_subtree_and_current_retention_filter(self, rootfolder, simulations):
+        retention_types = db_api.read_rootfolder_retentiontypes_dict(rootfolder.id)
+        days90, days180 = retention_types["+90d"].id, retention_types["+180"].id
+        change = dtos.RetentionChangeByFilter(retention_id=days180, folder_id=simulations["/teams/root/a"].id, current_retention_ids=[days90])
+        result = db_api.change_retentions_by_filter(rootfolder.id, change)
+        assert result.count == 2
+
+        # the expiration date of the per simulation change. The cleanup round of an inactive configuration starts now so allow for the time in between
+        expected = db_api.change_retentions(rootfolder.id, [dtos.FolderRetention(folder_id=simulations["/teams/root/b/sim3"].id, retention_id=days180)])[0]
+        nodes = read_nodes_by_path(rootfolder.id)
+        assert [nodes[path].retention_id for path in ["/teams/root/a/sim1", "/teams/root/a/sim2"]] == [days180] * 2
+        assert nodes["/teams/root/a/sim1"].expiration_date == nodes["/teams/root/a/sim2"].expiration_date
+        assert abs(nodes["/teams/root/a/sim1"].expiration_date - expected.expiration_date) < timedelta(minutes=1)
+        assert sorted(folder.id for folder in db_api.read_folder_changes(rootfolder.id, result.change_version - 1).folders if folder.change_version == result.change_version) == \
+               sorted([nodes["/teams/root/a/sim1"].id, nodes["/teams/root/a/sim2"].id])
+        assert materialized_retentions(rootfolder.id) == counted_retentions(rootfolder.id)
+
+        # nothing changes the second time
+        assert db_api.change_retentions_by_filter(rootfolder.id, change).count == 0
+
+    def test_modified_date_filter_skips_protected_simulations(self, rootfolder, simulations):
+        issue = db_api.read_rootfolder_retentiontypes_dict(rootfolder.id)["issue"].id
+        result = db_api.change_retentions_by_filter(rootfolder.id, dtos.RetentionChangeByFilter(
+            retention_id=issue, modified_after=datetime(2025, 1, 2), modified_before=datetime(2025, 1, 10)))
+        # sim2 and sim3 are in the range. sim4 is in the range but protected
+        assert result.count == 2
+        nodes = read_nodes_by_path(rootfolder.id)
+        assert [nodes[f"/teams/root/{path}"].retention_id == issue for path in ["a/sim1", "a/sim2", "b/sim3", "c/sim4"]] == [False, True, True, False]
+        assert nodes["/teams/root/b/sim3"].expiration_date is None
+
+    def test_invalid_changes(self, rootfolder, simulations):
+        retention_types = db_api.read_rootfolder_retentiontypes_dict(rootfolder.id)
+        for change, status_code in [(dtos.RetentionChangeByFilter(retention_id=retention_types["path"].id), 400),
+                                    (dtos.RetentionChangeByFilter(retention_id=10000), 404),
+                                    (dtos.RetentionChangeByFilter(retention_id=retention_types["issue"].id, folder_id=10000), 404)]:
+            with pytest.raises(HTTPException) as error:
+                db_api.change_retentions_by_filter(rootfolder.id, change)
+            assert error.value.status_code == status_code
+
+
+class TestChangeRetentionsColumnar:
+
+    def test_binary_and_json_bodies_decode_to_the_same_columns(self):
+        folder_ids, retention_ids = [3, 1, 2], [7, 7, 9]
+        binary = db_api.decode_columnar_retentions("application/octet-stream", np.array([folder_ids, retention_ids], dtype="<i8").tobytes())
+        json_columns = db_api.decode_columnar_retentions("application/json; charset=utf-8", json.dumps({"folderIds": folder_ids, "retentionIds": retention_ids}).encode())
+        for folder_id_column, retention_id_column in [binary, json_columns]:
+            assert (folder_id_column.tolist(), retention_id_column.tolist()) == (folder_ids, retention_ids)
+
+    @pytest.mark.parametrize("content_type, body, status_code", [
+        ("application/octet-stream", b"\0" * 24, 400),
+        ("application/json", b'{"folderIds": [1, 2], "retentionIds": [1]}', 400),
+        ("application/json", b'{"folderIds": [1]}', 400),
+        ("application/json", b'[{"folderId": 1, "retentionId": 1}]', 400),
+        ("text/csv", b"1,1", 415)])
+    def test_invalid_bodies(self, content_type, body, status_code):
+        with pytest.raises(HTTPException) as error:
+            db_api.decode_columnar_retentions(content_type, body)
+        assert error.value.status_code == status_code
+
+    def test_change_retentions_columnar(self, rootfolder):
+        paths = [f"/teams/root/a/sim{i}" for i in range(4)]
+        db_api.insert_or_update_simulations_in_db(rootfolder.id, make_simulations(paths))
+        nodes = read_nodes_by_path(rootfolder.id)
+        retention_types = db_api.read_rootfolder_retentiontypes_dict(rootfolder.id)
+        days90, issue = retention_types["+90d"].id, retention_types["issue"].id
+        expected = db_api.change_retentions(rootfolder.id, [dtos.FolderRetention(folder_id=nodes[paths[3]].id, retention_id=days90)])[0]
+        db_api.change_retentions(rootfolder.id, [dtos.FolderRetention(folder_id=nodes[paths[3]].id, retention_id=issue)])
+
+        # sim0 occurs twice and gets the last retention. sim3 already has issue
+        folder_ids    = np.array([nodes[paths[0]].id, nodes[paths[1]].id, nodes[paths[2]].id, nodes[paths[0]].id, nodes[paths[3]].id])
+        retention_ids = np.array([days90, days90, issue, issue, issue])
+        result = db_api.change_retentions_columnar(rootfolder.id, folder_ids, retention_ids)
+        assert result.count == 3
+
+        nodes = read_nodes_by_path(rootfolder.id)
+        assert [nodes[path].retention_id for path in paths] == [issue, days90, issue, issue]
+        assert [nodes[path].expiration_date is None for path in paths] == [True, False, True, True]
+        assert abs(nodes[paths[1]].expiration_date - expected.expiration_date) < timedelta(minutes=1)
+        assert sorted(folder.id for folder in db_api.read_folder_changes(rootfolder.id, result.change_version - 1).folders) == \
+               sorted(nodes[path].id for path in paths[:3])
+        assert materialized_retentions(rootfolder.id) == counted_retentions(rootfolder.id)
+
+    def test_path_protected_simulations_and_inner_nodes_are_not_changed(self, rootfolder):
+        paths = ["/teams/root/a/sim1", "/teams/root/b/sim2"]
+        db_api.insert_or_update_simulations_in_db(rootfolder.id, make_simulations(paths))
+        db_api.add_pathprotection_by_paths(rootfolder.id, ["/teams/root/b"])
+        nodes = read_nodes_by_path(rootfolder.id)
+        retention_types = db_api.read_rootfolder_retentiontypes_dict(rootfolder.id)
+        issue, path_retention = retention_types["issue"].id, retention_types["path"].id
+        before = {path: nodes[path].retention_id for path in ["/teams/root/a", paths[1]]}
+
+        folder_ids = np.array([nodes["/teams/root/a"].id, nodes[paths[1]].id, nodes[paths[0]].id])
+        result = db_api.change_retentions_columnar(rootfolder.id, folder_ids, np.array([issue, issue, issue]))
+        assert result.count == 1
+
+        nodes = read_nodes_by_path(rootfolder.id)
+        assert nodes[paths[0]].retention_id == issue
+        assert {path: nodes[path].retention_id for path in before} == before
+        assert nodes[paths[1]].retention_id == path_retention and nodes[paths[1]].path_protection_id != 0
+
+        with pytest.raises(HTTPException) as error:
+            db_api.change_retentions_columnar(rootfolder.id, np.array([nodes[paths[0]].id]), np.array([path_retention]))
+        assert error.value.status_code == 400
+
+    def test_unknown_retentions_and_folders_of_other_rootfolders(self, rootfolder):
+        db_api.insert_or_update_simulations_in_db(rootfolder.id, make_simulations(["/teams/root/sim"]))
+        sim = read_nodes_by_path(rootfolder.id)["/teams/root/sim"]
+        with pytest.raises(HTTPException) as error:
+            db_api.change_retentions_columnar(rootfolder.id, np.array([sim.id]), np.array([10000]))
+        assert error.value.status_code == 404
+
+        other = db_api.insert_rootfolder(RootFolderDTO(simulationdomain_id=rootfolder.simulationdomain_id, path="/teams/other"))
+        with Session(Database.get_engine()) as session:
+            cleanup_config = session.get(RootFolderDTO, other.id).get_cleanup_configuration(session)
+            cleanup_config.lead_time, cleanup_config.frequency = 14, 7
+            session.add(cleanup_config)
+            session.commit()
+        issue = db_api.read_rootfolder_retentiontypes_dict(rootfolder.id)["issue"].id
+        assert db_api.change_retentions_columnar(other.id, np.array([sim.id]), np.array([issue])).count == 0
+        assert db_api.read_folder(rootfolder.id, sim.id).retention_id != issue
@@ -0,0 +1,165 @@
+from datetime import datetime
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import insert
+from sqlmodel import Session, select
+from app.app_config import AppConfig
+from db.database import Database
+from db import db_api
+from db.metadata_cache import MetadataCache
+from db.unit_of_work import UnitOfWork, db_session
+from db.write_queue import WriteQueue
+from datamodel import dtos
+from datamodel.dtos import FileInfo, FolderTypeEnum, ExternalRetentionTypes
+from datamodel.retentions import RetentionCalculator
+from cleanup.scheduler_dtos import CleanupCalendarDTO  # registers the calendar table that insert_or_update_cleanup_configuration deactivates
+from tests.unittests.db.test_write_queue import block_writer
+
+
+def stats_delta(before: dict[str, int]) -> dict[str, int]:
+    after = MetadataCache.stats()
+    return {"hits": after["hits"] - before["hits"], "misses": after["misses"] - before["misses"]}
+
+
+@pytest.fixture
+def protected_rootfolder(rootfolder) -> dtos.RootFolderDTO:
+    paths = [f"/teams/root/p{i}/sim" for i in range(3)]
+    db_api.insert_or_update_simulations_in_db(rootfolder.id, [FileInfo(path, datetime(2025, 1, 1), FolderTypeEnum.SIMULATION, ExternalRetentionTypes.NUMERIC) for path in paths])
+    db_api.add_pathprotection_by_paths(rootfolder.id, ["/teams/root/p0"])
+    return rootfolder
+
+
+def insert_protection_from_another_process(rootfolder_id: int, path: str) -> None:
+    # a Core insert is not seen by the flush listeners, like a commit of another server process
+    folder = next(folder for folder in db_api.read_folders(rootfolder_id) if folder.path == path)
+    with Session(Database.get_engine(rootfolder_id)) as session:
+        session.connection().execute(insert(dtos.PathProtectionDTO.__table__).values(rootfolder_id=rootfolder_id, folder_id=folder.id, path=path))
+        session.commit()
+
+
+class TestMetadataCache:
+
+    @pytest.mark.skipif(AppConfig.get_db_backend() != "sqlite", reason="the metadata cache is only used by a single server process")
+    def test_repeated_reads_are_served_from_the_cache(self, protected_rootfolder):
+        with Session(Database.get_engine()) as session:
+            RetentionCalculator(protected_rootfolder.id, protected_rootfolder.cleanup_config_id, session)
+
+            before = MetadataCache.stats()
+            calculator = RetentionCalculator(protected_rootfolder.id, protected_rootfolder.cleanup_config_id, session)
+            db_api.read_folder_type_dict_pr_domain_id(protected_rootfolder.simulationdomain_id)
+            assert stats_delta(before)["misses"] == 0
+            assert stats_delta(before)["hits"] > 0
+            assert calculator.leadtimedelta.days == 14
+            assert [protection[0] for protection in calculator.sorted_protections] == ["/teams/root/p0"]
+
+    def test_returned_lists_do_not_share_the_cached_list(self, protected_rootfolder):
+        db_api.read_pathprotections(protected_rootfolder.id).clear()
+        assert len(db_api.read_pathprotections(protected_rootfolder.id)) == 1
+
+    def test_path_protection_changes_invalidate_the_cache(self, protected_rootfolder):
+        assert [protection.path for protection in db_api.read_pathprotections(protected_rootfolder.id)] == ["/teams/root/p0"]
+
+        folder = next(folder for folder in db_api.read_folders(protected_rootfolder.id) if folder.path == "/teams/root/p1")
+        db_api.add_pathprotection(protected_rootfolder.id, dtos.PathProtectionDTO(rootfolder_id=protected_rootfolder.id, folder_id=folder.id, path=folder.path))
+        protections = db_api.read_pathprotections(protected_rootfolder.id)
+        assert sorted(protection.path for protection in protections) == ["/teams/root/p0", "/teams/root/p1"]
+
+        db_api.delete_pathprotection(protected_rootfolder.id, protections[0].id)
+        assert len(db_api.read_pathprotections(protected_rootfolder.id)) == 1
+
+    def test_cleanup_configuration_changes_invalidate_the_cache(self, rootfolder):
+        assert db_api.read_cleanup_configuration_snapshot(rootfolder.id).lead_time == 14
+
+        db_api.insert_or_update_cleanup_configuration(rootfolder.id, dtos.CleanupConfigurationDTO(rootfolder_id=rootfolder.id, lead_time=30, frequency=7, start_date=None))
+        assert db_api.read_cleanup_configuration_snapshot(rootfolder.id).lead_time == 30
+
+        # a commit of a changed configuration outside db_api is caught by the session events
+        with Session(Database.get_engine()) as session:
+            cleanup_config = session.get(dtos.CleanupConfigurationDTO, rootfolder.cleanup_config_id)
+            cleanup_config.progress = dtos.CleanupProgress.Progress.SCANNING.value
+            session.add(cleanup_config)
+            session.commit()
+        assert db_api.read_cleanup_configuration_snapshot(rootfolder.id).progress == dtos.CleanupProgress.Progress.SCANNING.value
+
+    def test_calculations_use_the_configuration_of_the_callers_transaction(self, rootfolder):
+        db_api.read_cleanup_configuration_snapshot(rootfolder.id)
+        with UnitOfWork():
+            with db_session() as session:
+                cleanup_config = session.get(dtos.CleanupConfigurationDTO, rootfolder.cleanup_config_id)
+                cleanup_config.lead_time = 30
+                session.add(cleanup_config)
+                session.commit()
+
+                calculator = RetentionCalculator(rootfolder.id, rootfolder.cleanup_config_id, session)
+                assert calculator.leadtimedelta.days == 30
+                assert db_api.read_cleanup_configuration_snapshot(rootfolder.id).lead_time == 14
+        assert db_api.read_cleanup_configuration_snapshot(rootfolder.id).lead_time == 30
+
+    @pytest.mark.skipif(AppConfig.get_db_backend() != "sqlite", reason="the metadata cache is only used by a single server process")
+    def test_rolled_back_changes_keep_the_cache(self, rootfolder):
+        db_api.read_cleanup_configuration_snapshot(rootfolder.id)
+        with Session(Database.get_engine()) as session:
+            cleanup_config = session.get(dtos.CleanupConfigurationDTO, rootfolder.cleanup_config_id)
+            cleanup_config.lead_time = 99
+            session.add(cleanup_config)
+            session.flush()
+            session.rollback()
+
+        before = MetadataCache.stats()
+        assert db_api.read_cleanup_configuration_snapshot(rootfolder.id).lead_time == 14
+        assert stats_delta(before) == {"hits": 1, "misses": 0}
+
+    @pytest.mark.skipif(AppConfig.get_storage_mode() == "sharded", reason="the path protections and the cleanup configuration are in different databases")
+    def test_a_failing_job_keeps_the_invalidations_of_its_group(self, protected_rootfolder):
+        assert [protection.path for protection in db_api.read_pathprotections(protected_rootfolder.id)] == ["/teams/root/p0"]
+        folder = next(folder for folder in db_api.read_folders(protected_rootfolder.id) if folder.path == "/teams/root/p1")
+
+        def add_protection(session: Session) -> None:
+            session.add(dtos.PathProtectionDTO(rootfolder_id=protected_rootfolder.id, folder_id=folder.id, path=folder.path))
+            session.flush()
+            MetadataCache.invalidate_rootfolder(protected_rootfolder.id)
+        def failing_job(session: Session) -> None:
+            db_api.read_pathprotections(protected_rootfolder.id)    # caches the protections committed before the group
+            cleanup_config = session.get(dtos.CleanupConfigurationDTO, protected_rootfolder.cleanup_config_id)
+            cleanup_config.lead_time = 99
+            session.add(cleanup_config)
+            session.flush()
+            raise ValueError("rolls back the job")
+
+        release = block_writer()
+        futures = [WriteQueue.submit(add_protection), WriteQueue.submit(failing_job)]
+        release.set()
+        futures[0].result(10)
+        with pytest.raises(ValueError):
+            futures[1].result(10)
+
+        assert sorted(protection.path for protection in db_api.read_pathprotections(protected_rootfolder.id)) == ["/teams/root/p0", "/teams/root/p1"]
+        assert db_api.read_cleanup_configuration_snapshot(protected_rootfolder.id).lead_time == 14
+
+    def test_the_cache_is_bypassed_when_other_processes_share_the_database(self, protected_rootfolder, monkeypatch):
+        monkeypatch.setattr(Database.get_db(), "is_single_process", False)
+        assert [protection.path for protection in db_api.read_pathprotections(protected_rootfolder.id)] == ["/teams/root/p0"]
+        insert_protection_from_another_process(protected_rootfolder.id, "/teams/root/p1")
+        assert sorted(protection.path for protection in db_api.read_pathprotections(protected_rootfolder.id)) == ["/teams/root/p0", "/teams/root/p1"]
+
+    def test_failed_loads_are_not_cached(self, rootfolder):
+        for _ in range(2):
+            before = MetadataCache.stats()
+            with pytest.raises(HTTPException):
+                db_api.read_rootfolder_retentiontypes_dict(rootfolder.id + 100)
+            assert stats_delta(before) == {"hits": 0, "misses": 1}
+
+    def test_versions_change_with_the_commits_that_change_the_metadata(self, rootfolder):
+        domain_version = MetadataCache.version(MetadataCache.DOMAIN, rootfolder.simulationdomain_id)
+        rootfolder_version = MetadataCache.version(MetadataCache.ROOTFOLDER, rootfolder.id)
+
+        with Session(Database.get_engine()) as session:
+            lead_time = session.exec(select(dtos.LeadTimeDTO).where(dtos.LeadTimeDTO.simulationdomain_id == rootfolder.simulationdomain_id)).first()
+            lead_time.days += 1
+            session.add(lead_time)
+            session.commit()
+        assert MetadataCache.version(MetadataCache.DOMAIN, rootfolder.simulationdomain_id)[0] > domain_version[0]
+        assert MetadataCache.version(MetadataCache.ROOTFOLDER, rootfolder.id) == rootfolder_version
+
+        db_api.insert_or_update_cleanup_configuration(rootfolder.id, dtos.CleanupConfigurationDTO(rootfolder_id=rootfolder.id, lead_time=30, frequency=7, start_date=None))
+        assert MetadataCache.version(MetadataCache.ROOTFOLDER, rootfolder.id)[0] > rootfolder_version[0]
@@ -0,0 +1,95 @@
+from datetime import datetime
+import pytest
+from sqlalchemy import event
+from sqlmodel import Session, select
+from app.metrics import RequestStats
+from db import db_api
+from db.database import Database
+from db.metadata_cache import MetadataCache
+from db.unit_of_work import UnitOfWork, db_session
+from db.write_queue import WriteQueue
+from datamodel import dtos
+from datamodel.dtos import FileInfo, FolderTypeEnum, ExternalRetentionTypes
+
+
+def insert_simulations(rootfolder_id: int, paths: list[str]) -> dict:
+    return db_api.insert_or_update_simulations_in_db(rootfolder_id, [FileInfo(path, datetime(2025, 1, 1), FolderTypeEnum.SIMULATION, ExternalRetentionTypes.NUMERIC) for path in paths])
+
+def protected_paths(rootfolder_id: int) -> list[str]:
+    return sorted(protection.path for protection in db_api.read_pathprotections(rootfolder_id))
+
+def domain_names() -> set[str]:
+    with Session(Database.get_engine()) as session:
+        return set(session.exec(select(dtos.SimulationDomainDTO.name)).all())
+
+
+class TestUnitOfWork:
+
+    def test_a_queued_write_uses_one_connection(self, rootfolder):
+        insert_simulations(rootfolder.id, ["/teams/root/a/sim1", "/teams/root/b/sim2"])
+        db_api.apply_pathprotections(rootfolder.id)    # loads the metadata into the cache
+
+        checkouts: list[int] = []
+        def count_checkout(dbapi_connection, connection_record, connection_proxy) -> None:
+            checkouts.append(1)
+        event.listen(Database.get_engine(rootfolder.id), "checkout", count_checkout)
+        try:
+            # change detection, the inserts and the re-apply of the path protections run in one transaction
+            result = insert_simulations(rootfolder.id, ["/teams/root/a/sim1", "/teams/root/c/sim3"])
+            assert len(checkouts) == 1
+        finally:
+            event.remove(Database.get_engine(rootfolder.id), "checkout", count_checkout)
+        assert result["changed_count"] == 1
+
+    def test_repeated_reads_come_from_the_identity_map(self, rootfolder):
+        with UnitOfWork(read_only=True) as unit:
+            with db_session(read_only=True) as session:
+                first = session.get(dtos.RootFolderDTO, rootfolder.id)
+            query_count: int = RequestStats.query_count
+            with db_session(read_only=True) as session:
+                assert session is unit.session
+                assert session.get(dtos.RootFolderDTO, rootfolder.id) is first
+            assert RequestStats.query_count == query_count
+        assert unit.session_requests == 2
+
+    def test_nested_commits_are_rolled_back_with_the_unit(self, rootfolder):
+        with pytest.raises(ValueError):
+            with UnitOfWork():
+                with db_session() as session:
+                    session.add(dtos.SimulationDomainDTO(name="uncommitted"))
+                    session.commit()
+                raise ValueError("rolls back the unit")
+        assert "uncommitted" not in domain_names()
+
+        with UnitOfWork():
+            with db_session() as session:
+                session.add(dtos.SimulationDomainDTO(name="committed"))
+                session.commit()
+        assert "committed" in domain_names()
+
+    def test_the_cache_only_sees_committed_changes(self, rootfolder):
+        insert_simulations(rootfolder.id, ["/teams/root/a/sim1"])
+        folder_id: int = next(folder.id for folder in db_api.read_folders(rootfolder.id) if folder.path == "/teams/root/a")
+        assert protected_paths(rootfolder.id) == []
+
+        with UnitOfWork(rootfolder_id=rootfolder.id):
+            with db_session(rootfolder_id=rootfolder.id) as session:
+                session.add(dtos.PathProtectionDTO(rootfolder_id=rootfolder.id, folder_id=folder_id, path="/teams/root/a"))
+                session.commit()
+            MetadataCache.invalidate_rootfolder(rootfolder.id)
+            assert protected_paths(rootfolder.id) == []
+        assert protected_paths(rootfolder.id) == ["/teams/root/a"]
+
+    def test_session_jobs_share_the_unit_of_their_group(self, rootfolder):
+        insert_simulations(rootfolder.id, ["/teams/root/a/sim1"])
+
+        def failing_job(session: Session):
+            with db_session(rootfolder_id=rootfolder.id) as unit_session:
+                assert unit_session is session
+            # the queued write runs inline in the group's unit, so it is rolled back with the job
+            db_api.add_pathprotection_by_paths(rootfolder.id, ["/teams/root/a"])
+            raise ValueError("rolls back the job")
+
+        with pytest.raises(ValueError):
+            WriteQueue.run(failing_job, rootfolder_id=rootfolder.id)
+        assert protected_paths(rootfolder.id) == []
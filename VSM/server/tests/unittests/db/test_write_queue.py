@@ -0,0 +1,119 @@
+import asyncio
+import threading
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from sqlmodel import Session, select
+from app.web_api import app
+from app.app_config import AppConfig
+from db.database import Database
+from db.write_queue import WriteQueue
+from datamodel.dtos import SimulationDomainDTO
+
+
+def add_domain(name: str):
+    def job(session: Session) -> str:
+        session.add(SimulationDomainDTO(name=name))
+        return name
+    return job
+
+def domain_names() -> set[str]:
+    with Session(Database.get_engine()) as session:
+        return set(session.exec(select(SimulationDomainDTO.name)).all())
+
+def block_writer() -> threading.Event:
+    # occupy the writer with an exclusive job until the returned event is set, so the following jobs queue up
+    started, release = threading.Event(), threading.Event()
+    WriteQueue.submit_exclusive(lambda: started.set() or release.wait(10))
+    assert started.wait(10)
+    return release
+
+
+class TestWriteQueue:
+
+    def setup_method(self):
+        WriteQueue.clear_stats()
+
+    def test_queued_jobs_are_committed_together(self, rootfolder):
+        release = block_writer()
+        futures = [WriteQueue.submit(add_domain(f"group{i}")) for i in range(5)]
+        assert WriteQueue.stats()["bulk_depth"] == 5
+        release.set()
+
+        assert [future.result(10) for future in futures] == [f"group{i}" for i in range(5)]
+        stats = WriteQueue.stats()
+        assert (stats["commits"], stats["committed_jobs"], stats["jobs_per_commit"]) == (1, 5, 5.0)
+        assert stats["bulk_depth"] == 0 and stats["max_depth"] == 5
+        assert {f"group{i}" for i in range(5)} <= domain_names()
+
+    def test_interactive_jobs_run_before_bulk_jobs(self, rootfolder):
+        order: list[str] = []
+        release = block_writer()
+        bulk        = WriteQueue.submit_exclusive(lambda: order.append("bulk"), WriteQueue.BULK)
+        interactive = WriteQueue.submit(lambda session: order.append("interactive"), WriteQueue.INTERACTIVE)
+        release.set()
+        bulk.result(10), interactive.result(10)
+        assert order == ["interactive", "bulk"]
+
+    @pytest.mark.skipif(AppConfig.get_storage_mode() == "sharded", reason="each shard has its own writer")
+    def test_bulk_jobs_are_taken_round_robin_by_rootfolder(self, rootfolder):
+        order: list[str] = []
+        release = block_writer()
+        futures = [WriteQueue.submit_exclusive(lambda name=name: order.append(name), WriteQueue.BULK, rootfolder_id)
+                   for name, rootfolder_id in [("1a", 1), ("1b", 1), ("1c", 1), ("2a", 2), ("none", None)]]
+        assert WriteQueue.stats()["bulk_lanes"] == 3
+        release.set()
+        for future in futures:
+            future.result(10)
+        # the scan of rootfolder 1 only delays the other rootfolders by one job
+        assert order == ["1a", "2a", "none", "1b", "1c"]
+
+    def test_bulk_jobs_yield_to_waiting_interactive_jobs(self, rootfolder):
+        order: list[str] = []
+        started, queued = threading.Event(), threading.Event()
+        def bulk_job():
+            order.append("chunk 1")
+            started.set()
+            assert queued.wait(10)
+            WriteQueue.yield_to_interactive()
+            order.append("chunk 2")
+        bulk = WriteQueue.submit_exclusive(bulk_job, WriteQueue.BULK)
+        assert started.wait(10)
+        interactive = WriteQueue.submit(lambda session: order.append("interactive"), WriteQueue.INTERACTIVE)
+        queued.set()
+        bulk.result(10), interactive.result(10)
+        assert order == ["chunk 1", "interactive", "chunk 2"]
+
+    def test_a_failing_job_only_fails_itself(self, rootfolder):
+        def failing_job(session: Session):
+            session.add(SimulationDomainDTO(name="rolled back"))
+            session.flush()
+            raise HTTPException(status_code=409, detail="conflict")
+
+        release = block_writer()
+        futures = [WriteQueue.submit(add_domain("before")), WriteQueue.submit(failing_job), WriteQueue.submit(add_domain("after"))]
+        release.set()
+
+        assert futures[0].result(10) == "before" and futures[2].result(10) == "after"
+        with pytest.raises(HTTPException, match="conflict"):
+            futures[1].result(10)
+        names = domain_names()
+        assert {"before", "after"} <= names and "rolled back" not in names
+        assert (WriteQueue.stats()["committed_jobs"], WriteQueue.stats()["failed_jobs"]) == (2, 1)
+
+    def test_jobs_submitted_from_the_writer_run_inline(self, rootfolder):
+        def session_job(session: Session) -> str:
+            # a nested session job joins the transaction of the group
+            return WriteQueue.run(add_domain("nested"))
+        assert WriteQueue.run_exclusive(lambda: WriteQueue.run(session_job)) == "nested"
+        assert "nested" in domain_names()
+
+    def test_run_async(self, rootfolder):
+        assert asyncio.run(WriteQueue.run_async(add_domain("async"))) == "async"
+        assert "async" in domain_names()
+
+    def test_stats_endpoint_and_metrics(self, rootfolder):
+        WriteQueue.run(add_domain("stats"))
+        client = TestClient(app)
+        assert client.get("/v1/write_queue/stats").json()["commits"] == 1
+        assert "vsm_write_queue_commits_total 1" in client.get("/metrics").text
@@ -1,4 +1,6 @@
+import pytest
 from sqlmodel import Session, select, asc
+from app.app_config import AppConfig
 from datamodel.dtos import (
     RootFolderDTO, 
     FolderNodeDTO, 
@@ -123,6 +125,7 @@ class TestRootFolderDTO:
         assert retrieved_folder.path == "/test/folder"
         assert retrieved_folder.owner == "JD"
 
+@pytest.mark.skipif(AppConfig.get_storage_mode() == "sharded", reason="the folders are in the shards, not in the session's database")
 class TestFolderNodeDTO:
     """Test FolderNodeDTO database operations"""
 
@@ -515,6 +518,7 @@ class TestRetentionDTO:
 class TestDTODatabaseIntegration:
     """Test integration scenarios across multiple DTOs"""
 
+    @pytest.mark.skipif(AppConfig.get_storage_mode() == "sharded", reason="the folders are in the shards, not in the session's database")
     def test_all_dtos_table_creation(self, test_session: Session):
         """Test that all DTO table schemas work together"""
         # Create simulation domain first
@@ -558,6 +562,7 @@ class TestDTODatabaseIntegration:
         assert root_folder.id is not None
         assert folder_node.id is not None
 
+    @pytest.mark.skipif(AppConfig.get_storage_mode() == "sharded", reason="the folders are in the shards, not in the session's database")
     def test_dto_field_data_integrity(self, test_session: Session, test_root_folder: RootFolderDTO):
         """Test that all field types preserve data correctly through database round-trip"""
         # Create simulation domain first
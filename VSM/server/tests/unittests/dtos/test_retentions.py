@@ -0,0 +1,123 @@
+import random
+import time
+from datetime import datetime, timedelta
+import numpy as np
+import pytest
+from sqlmodel import Session
+from db.database import Database
+from db import db_api
+from datamodel.dtos import FileInfo, FolderTypeEnum, ExternalRetentionTypes, Retention
+from datamodel.retentions import RetentionCalculator, PathProtectionMatcher, NO_RETENTION_ID, to_datetime64, from_datetime64
+
+
+@pytest.fixture
+def retention_calculator(rootfolder) -> RetentionCalculator:
+    paths = [f"/teams/root/p{i}/q{j}/sim" for i in range(3) for j in range(3)]
+    db_api.insert_or_update_simulations_in_db(rootfolder.id, [FileInfo(path, datetime(2025, 1, 1), FolderTypeEnum.SIMULATION, ExternalRetentionTypes.NUMERIC) for path in paths])
+    db_api.add_pathprotection_by_paths(rootfolder.id, ["/teams/root/p0", "/teams/root/p0/q1", "/teams/root/p2/q2/sim"])
+    with Session(Database.get_engine()) as session:
+        return RetentionCalculator(rootfolder.id, rootfolder.cleanup_config_id, session)
+
+
+def random_scan_rows(calculator: RetentionCalculator, count: int, seed: int) -> list[dict]:
+    rng = random.Random(seed)
+    start = calculator.cleanup_round_start_date
+    retention_ids = list(calculator.retention_type_id_dict.keys()) + [None, 0]
+    paths = [f"/teams/root/p{i}/q{j}/sim" for i in range(4) for j in range(4)] + ["/teams/root/p0", "/teams/root/P0/Q1/SIM", "/teams/root/p00/q1"]
+    rows = []
+    for _ in range(count):
+        db_modified_date = rng.choice([None, start - timedelta(days=rng.randint(0, 1500), hours=rng.randint(0, 23))])
+        rows.append({
+            "retention_id":       rng.choice(retention_ids),
+            "path_protection_id": rng.choice([0, 0, 1, 2]),
+            "expiration_date":    rng.choice([None, start + timedelta(days=rng.randint(-30, 1200), hours=rng.randint(0, 23))]),
+            "db_modified_date":   db_modified_date,
+            "sim_external":       rng.choice(list(ExternalRetentionTypes) + [None]),
+            "sim_modified_date":  rng.choice([db_modified_date or start, start - timedelta(days=rng.randint(0, 1500), minutes=rng.randint(0, 59))]),
+            "path":               rng.choice(paths),
+        })
+    return rows
+
+
+class TestBatchRetentionCalculation:
+
+    @pytest.mark.parametrize("is_starting_cleanup_round", [False, True])
+    def test_batch_is_equivalent_to_scalar(self, retention_calculator, is_starting_cleanup_round):
+        retention_calculator.is_starting_cleanup_round = is_starting_cleanup_round
+        rows = random_scan_rows(retention_calculator, 2000, seed=7)
+
+        expected = [retention_calculator.calculate_retention_from_scan(
+                        Retention(retention_id=row["retention_id"], path_protection_id=row["path_protection_id"], expiration_date=row["expiration_date"]),
+                        row["db_modified_date"], row["sim_external"], row["sim_modified_date"], row["path"])
+                    for row in rows]
+
+        retention_ids, path_protection_ids, expiration_dates, modified_dates = retention_calculator.calculate_retentions_from_scan_batch(
+            np.array([NO_RETENTION_ID if row["retention_id"] is None else row["retention_id"] for row in rows]),
+            np.array([row["path_protection_id"] for row in rows]),
+            to_datetime64([row["expiration_date"] for row in rows]),
+            to_datetime64([row["db_modified_date"] for row in rows]),
+            [row["sim_external"] for row in rows],
+            to_datetime64([row["sim_modified_date"] for row in rows]),
+            [row["path"] for row in rows])
+
+        actual = list(zip(retention_ids.tolist(), path_protection_ids.tolist(), from_datetime64(expiration_dates), from_datetime64(modified_dates)))
+        for row, (retention, modified_date), result in zip(rows, expected, actual):
+            assert (retention.retention_id, retention.path_protection_id, retention.expiration_date, modified_date) == result, row
+
+    def test_batch_raises_without_any_date(self, retention_calculator):
+        with pytest.raises(ValueError):
+            retention_calculator.calculate_retentions_from_scan_batch(
+                np.array([NO_RETENTION_ID]), np.array([0]), to_datetime64([None]), to_datetime64([None]),
+                [ExternalRetentionTypes.NUMERIC], to_datetime64([None]), ["/teams/root/p1/q1/sim"])
+
+
+def linear_match(sorted_protections: list[tuple[str, int]], path: str) -> int | None:
+    # the linear scan that RetentionCalculator.match used before PathProtectionMatcher
+    for pattern, protection_id in sorted_protections:
+        if path == pattern or path.startswith(pattern + "/"):
+            return protection_id
+    return None
+
+
+def random_protections_and_paths(protection_count: int, path_count: int, seed: int) -> tuple[list[tuple[str, int]], list[str]]:
+    rng = random.Random(seed)
+    def random_path(depth: int) -> str:
+        return "/teams/root/" + "/".join(f"r{rng.randint(0, 12)}" for _ in range(depth))
+    protections = sorted([(random_path(rng.randint(1, 4)), id) for id in range(1, protection_count + 1)], key=lambda item: item[0].count('/'), reverse=True)
+    paths = [random_path(rng.randint(1, 7)) for _ in range(path_count)]
+    return protections, paths
+
+
+class TestPathProtectionMatcher:
+
+    def test_most_specific_protection_and_segment_boundary(self):
+        matcher = PathProtectionMatcher([("/teams/root/r1/a", 2), ("/teams/root/r1", 1)])
+        assert matcher.match("/teams/root/r1") == 1
+        assert matcher.match("/teams/root/r1/a/sim") == 2
+        assert matcher.match("/teams/root/r1/ab/sim") == 1
+        assert matcher.match("/teams/root/r10/a") is None
+        assert PathProtectionMatcher([("", 5)]).match("/teams/root") == 5
+        assert PathProtectionMatcher([]).match("/teams/root") is None
+
+    def test_matcher_is_equivalent_to_linear_scan(self):
+        protections, paths = random_protections_and_paths(300, 5000, seed=11)
+        matcher = PathProtectionMatcher(protections)
+        assert [matcher.match(path) for path in paths] == [linear_match(protections, path) for path in paths]
+
+    @pytest.mark.benchmark
+    def test_benchmark_matcher_against_linear_scan(self):
+        protections, paths = random_protections_and_paths(500, 20000, seed=13)
+        matcher = PathProtectionMatcher(protections)
+
+        start = time.perf_counter()
+        expected = [linear_match(protections, path) for path in paths]
+        linear_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        actual = [matcher.match(path) for path in paths]
+        matcher_seconds = time.perf_counter() - start
+
+        print(f"\npath protection matching of {len(paths)} paths with {len(protections)} protections: "
+              f"linear scan {linear_seconds:.3f}s, prefix matcher {matcher_seconds:.3f}s ({linear_seconds / matcher_seconds:.0f}x)")
+        assert actual == expected
+        assert matcher_seconds * 5 < linear_seconds